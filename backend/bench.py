@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Callable, Dict, List, Tuple
+
+import httpx
+import numpy as np
+
+from search import name_trigrams
+
+# In-process load test: boots server.app against a local mongod (MONGO_URL, database
+# BENCH_DB), seeds a synthetic school, and drives concurrent scenarios through
+# httpx.ASGITransport. Results are per scenario and per route template, written as
+# sorted JSON so two runs can be diffed:
+#
+#     python bench.py run --out before.json
+#     python bench.py compare before.json after.json
+SUBJECTS = ["Matemática", "Português", "Física", "Química", "Biologia", "História"]
+
+
+async def seed(db, today: str, users: int, days: int, rng: random.Random):
+    now = datetime.now(timezone.utc)
+    today_date = datetime.strptime(today, "%Y-%m-%d")
+    clan_count = max(1, users // 20)
+    user_docs, sessions = [], []
+    for i in range(users):
+        user_docs.append({
+            "user_id": f"bench_{i}", "email": f"bench_{i}@bench.test", "name": f"Bench {i}",
+            "picture": "", "display_name": f"Bench{i}", "city": "Recife", "school": f"Escola {i % 40}",
+            "grade": "3", "subjects": rng.sample(SUBJECTS, 3), "bio": "", "level_xp": 0,
+            "total_xp": 0, "level": 0, "streak": 0, "last_activity_date": "",
+            "onboarding_complete": True, "rival_id": "", "clan_id": f"bench_clan_{i % clan_count}",
+            "inventory": [], "display_name_key": f"bench{i}",
+            "display_name_trigrams": name_trigrams(f"bench{i}"),
+            "created_at": (now - timedelta(days=days)).isoformat()})
+        sessions.append({"user_id": f"bench_{i}", "session_token": f"bench_token_{i}",
+                         "expires_at": now + timedelta(days=7), "created_at": now.isoformat()})
+    friends, pairs = [], set()
+    for i in range(users):
+        for j in rng.sample(range(users), min(10, users - 1)):
+            pair = (min(i, j), max(i, j))
+            if i != j and pair not in pairs:
+                pairs.add(pair)
+                friends.append({"request_id": f"bench_fr_{pair[0]}_{pair[1]}",
+                                "from_user_id": f"bench_{pair[0]}", "to_user_id": f"bench_{pair[1]}",
+                                "status": "accepted" if rng.random() < 0.9 else "pending",
+                                "created_at": now.isoformat()})
+    clans = [{"clan_id": f"bench_clan_{c}", "name": f"Clã {c}", "description": "", "photo": "",
+              "banner": "", "leader_id": f"bench_{c}", "total_xp": 0,
+              "members": [f"bench_{i}" for i in range(c, users, clan_count)],
+              "created_at": now.isoformat()} for c in range(clan_count)]
+    activities, daily_xp = [], []
+    for i, user in enumerate(user_docs):
+        streak = 0
+        for d in range(days, -1, -1):
+            day = (today_date - timedelta(days=d)).strftime("%Y-%m-%d")
+            done = 0 if d == 0 else (rng.randint(1, 3) if rng.random() < 0.7 else 0)
+            pending = 3 if d == 0 else 0
+            xp_total = 0
+            for n in range(done + pending):
+                xp = rng.randint(30, 150) if n < done else 0
+                xp_total += xp
+                activities.append({
+                    "activity_id": f"bench_act_{i}_{d}_{n}", "user_id": user["user_id"],
+                    "title": f"Estudo {n}", "subject": rng.choice(user["subjects"]),
+                    "description": "", "difficulty": rng.randint(1, 5),
+                    "estimated_time": rng.choice([15, 30, 45, 60]), "actual_time_start": None,
+                    "actual_time_end": None, "checklist": [], "image_url": "",
+                    "status": "completed" if n < done else "pending", "xp_earned": xp, "date": day,
+                    "created_at": (now - timedelta(days=d, minutes=n)).isoformat(),
+                    "completed_at": None})
+            if done:
+                daily_xp.append({"user_id": user["user_id"], "date": day, "xp": xp_total,
+                                 "display_name": user["display_name"], "picture": "", "updated_at": now})
+                user["total_xp"] += xp_total
+                user["level_xp"] += xp_total
+                user["last_activity_date"] = day
+                streak += 1
+            elif d:
+                streak = 0
+        user["streak"] = streak
+    for collection, docs in (("users", user_docs), ("user_sessions", sessions), ("friends", friends),
+                             ("clans", clans), ("activities", activities), ("daily_xp", daily_xp)):
+        for start in range(0, len(docs), 5000):
+            await db[collection].insert_many(docs[start:start + 5000], ordered=False)
+    return {"users": users, "friendships": len(friends), "clans": clan_count,
+            "activities": len(activities), "daily_xp": len(daily_xp)}
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[Tuple[float, int]]] = {}
+
+    async def request(self, http: httpx.AsyncClient, label: str, method: str, path: str,
+                      user: int = None, body: dict = None):
+        headers = {"Authorization": f"Bearer bench_token_{user}"} if user is not None else {}
+        started = time.perf_counter()
+        r = await http.request(method, path, json=body, headers=headers)
+        self.samples.setdefault(label, []).append((time.perf_counter() - started, r.status_code))
+
+    def report(self, wall_seconds: float) -> dict:
+        routes = {}
+        for label, samples in sorted(self.samples.items()):
+            latencies = np.array([s for s, _ in samples]) * 1000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            routes[label] = {"requests": len(samples), "errors": sum(1 for _, st in samples if st >= 400),
+                             "rps": round(len(samples) / wall_seconds, 1), "p50_ms": round(p50, 2),
+                             "p95_ms": round(p95, 2), "p99_ms": round(p99, 2)}
+        total = sum(r["requests"] for r in routes.values())
+        return {"seconds": round(wall_seconds, 2), "requests": total,
+                "rps": round(total / wall_seconds, 1), "routes": routes}
+
+
+async def drive(worker: Callable, concurrency: int, duration: float) -> float:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(w, lambda: loop.time() < deadline) for w in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def scenario_dashboard_polling(http, args, rng, server):
+    rec = Recorder()
+
+    async def worker(w, running):
+        while running():
+            user = rng.randrange(args.users)
+            await rec.request(http, "GET /api/dashboard", "GET", "/api/dashboard", user)
+            if rng.random() < 0.3:
+                await rec.request(http, "GET /api/missions", "GET", "/api/missions", user)
+    return rec.report(await drive(worker, args.concurrency, args.duration))
+
+
+async def scenario_completion_burst(http, args, rng, server):
+    rec = Recorder()
+    queue = [(i, n) for i in range(args.users) for n in range(3)]
+    rng.shuffle(queue)
+
+    async def worker(w, running):
+        while queue and running():
+            i, n = queue.pop()
+            await rec.request(http, "POST /api/activities/{activity_id}/complete", "POST",
+                              f"/api/activities/bench_act_{i}_0_{n}/complete", i)
+    return rec.report(await drive(worker, args.concurrency, args.duration))
+
+
+async def scenario_rollover_rankings(http, args, rng, server):
+    # Forgetting the board's date makes the next read rebuild it, as the first request
+    # after the platform midnight does if it beats the rollover job, while every worker
+    # is already hammering rankings.
+    server.daily_leaderboard.date = None
+    rec = Recorder()
+    routes = ["/api/rankings/global", "/api/rankings/global/around-me", "/api/rankings/friends",
+              "/api/rankings/streak", "/api/rankings/clans"]
+
+    async def worker(w, running):
+        while running():
+            path = rng.choice(routes)
+            await rec.request(http, f"GET {path}", "GET", path, rng.randrange(args.users))
+    return rec.report(await drive(worker, args.concurrency, args.duration))
+
+
+async def scenario_login(http, args, rng, server):
+    rec = Recorder()
+    counter = iter(range(10 ** 9))
+
+    async def worker(w, running):
+        while running():
+            session_id = f"bench_{rng.randrange(args.users)}_{next(counter)}"
+            await rec.request(http, "POST /api/auth/session", "POST", "/api/auth/session",
+                              body={"session_id": session_id})
+    return rec.report(await drive(worker, max(1, args.concurrency // 5), args.duration))
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def run(args) -> dict:
+    os.environ["DB_NAME"] = os.environ.get("BENCH_DB", "bench")
+    import server
+    import fake_oauth
+    if "OAUTH_SESSION_URL" not in os.environ:
+        # Logins never leave the process unless pointed at a running fake_oauth.py.
+        server.oauth_client.transport = httpx.ASGITransport(app=fake_oauth.app)
+    rng = random.Random(args.seed)
+    await server.client.drop_database(server.db.name)
+    await server.app.router.startup()
+    try:
+        today = server.get_today_str()
+        started = time.perf_counter()
+        dataset = await seed(server.db, today, args.users, args.days, rng)
+        dataset["seed_seconds"] = round(time.perf_counter() - started, 1)
+        await server.rebuild_leaderboard(today)
+        transport = httpx.ASGITransport(app=server.app)
+        results = {}
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as http:
+            for name in args.scenarios:
+                print(f"running {name}...", file=sys.stderr)
+                results[name] = await SCENARIOS[name](http, args, rng, server)
+        return {"commit": git_commit(), "started_at": datetime.now(timezone.utc).isoformat(),
+                "params": {"users": args.users, "days": args.days, "concurrency": args.concurrency,
+                           "duration": args.duration, "seed": args.seed},
+                "dataset": dataset, "scenarios": results}
+    finally:
+        await server.app.router.shutdown()
+
+
+SCENARIOS = {
+    "dashboard_polling": scenario_dashboard_polling,
+    "completion_burst": scenario_completion_burst,
+    "rollover_rankings": scenario_rollover_rankings,
+    "login": scenario_login,
+}
+
+
+def compare(before: dict, after: dict):
+    for name, scenario in after["scenarios"].items():
+        old_routes = before.get("scenarios", {}).get(name, {}).get("routes", {})
+        print(name)
+        for label, r in scenario["routes"].items():
+            old = old_routes.get(label)
+            if not old:
+                print(f"  {label}: new, p95 {r['p95_ms']}ms, {r['rps']} rps")
+                continue
+            delta = (r["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 if old["p95_ms"] else 0
+            print(f"  {label}: p95 {old['p95_ms']} -> {r['p95_ms']}ms ({delta:+.0f}%), "
+                  f"rps {old['rps']} -> {r['rps']}")
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="In-process load test for the API")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run")
+    run_parser.add_argument("--out", default="bench.json")
+    run_parser.add_argument("--users", type=int, default=2000)
+    run_parser.add_argument("--days", type=int, default=90)
+    run_parser.add_argument("--concurrency", type=int, default=50)
+    run_parser.add_argument("--duration", type=float, default=15.0)
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    compare_parser = sub.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        with open(args.before) as b, open(args.after) as a:
+            compare(json.load(b), json.load(a))
+        return 0
+    result = asyncio.run(run(args))
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True, ensure_ascii=False)
+    for name, scenario in result["scenarios"].items():
+        print(f"{name}: {scenario['requests']} requests, {scenario['rps']} rps")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,94 @@
+import os
+from datetime import datetime, time, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, NamedTuple, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Leaderboards and XP rollups run on this zone's day so everyone competes in the same
+# window; streaks, activity dates, missions and weekly goals follow each user's own zone.
+DEFAULT_TIMEZONE = os.environ.get("DEFAULT_TIMEZONE", "America/Sao_Paulo")
+
+
+class DayKeys(NamedTuple):
+    today: str
+    yesterday: str
+    week: str  # Monday of this week
+    month: str
+    last_7: Tuple[str, ...]  # oldest first, ending today
+    starts_at: datetime  # UTC bounds of `today`
+    ends_at: datetime
+
+
+@lru_cache(maxsize=None)
+def get_zone(name: str) -> ZoneInfo:
+    return ZoneInfo(name)
+
+
+def is_valid_timezone(name: Optional[str]) -> bool:
+    if not name:
+        return False
+    try:
+        get_zone(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+@lru_cache(maxsize=4096)
+def week_start(day: str) -> str:
+    d = datetime.strptime(day, "%Y-%m-%d")
+    return (d - timedelta(days=d.weekday())).strftime("%Y-%m-%d")
+
+
+# Keys for the current day of each zone, reused until `now` leaves that day.
+_current: Dict[str, DayKeys] = {}
+
+
+def day_keys(tz_name: str, now: datetime) -> DayKeys:
+    keys = _current.get(tz_name)
+    if keys is None or not keys.starts_at <= now < keys.ends_at:
+        keys = _current[tz_name] = _compute_day_keys(tz_name, now)
+    return keys
+
+
+def _compute_day_keys(tz_name: str, now: datetime) -> DayKeys:
+    zone = get_zone(tz_name)
+    local = now.astimezone(zone).date()
+    days = [(local - timedelta(days=i)).isoformat() for i in range(6, -1, -1)]
+    return DayKeys(
+        today=days[-1], yesterday=days[-2], week=week_start(days[-1]), month=days[-1][:7],
+        last_7=tuple(days),
+        starts_at=datetime.combine(local, time.min, zone).astimezone(timezone.utc),
+        ends_at=datetime.combine(local + timedelta(days=1), time.min, zone).astimezone(timezone.utc))
+
+
+class Clock:
+    # One request's view of time: `now` is read once and both the caller's day keys and
+    # the platform's (`board`) derive from it, so a request that straddles midnight
+    # still sees a single day.
+    __slots__ = ("now", "tz", "local", "board")
+
+    def __init__(self, tz_name: Optional[str] = None, now: Optional[datetime] = None):
+        self.now = now or datetime.now(timezone.utc)
+        self.tz = tz_name if is_valid_timezone(tz_name) else DEFAULT_TIMEZONE
+        self.local = day_keys(self.tz, self.now)
+        self.board = self.local if self.tz == DEFAULT_TIMEZONE else day_keys(DEFAULT_TIMEZONE, self.now)
+
+    @property
+    def today(self) -> str:
+        return self.local.today
+
+    @property
+    def yesterday(self) -> str:
+        return self.local.yesterday
+
+    @property
+    def week(self) -> str:
+        return self.local.week
+
+    @property
+    def board_day(self) -> str:
+        return self.board.today
+
+    def iso(self) -> str:
+        return self.now.isoformat()
@@ -0,0 +1,34 @@
+import asyncio
+import os
+
+from fastapi import FastAPI, Header, HTTPException
+
+# Local stand-in for the upstream OAuth session-data endpoint, for benchmarks and tests:
+#
+#     python fake_oauth.py      # listens on 127.0.0.1:FAKE_OAUTH_PORT (8099)
+#     OAUTH_SESSION_URL=http://127.0.0.1:8099/auth/v1/env/oauth/session-data uvicorn server:app
+#
+# A session id "<prefix>_<n>[_<anything>]" resolves to the user "<prefix>_<n>@<prefix>.test";
+# ids starting with "invalid" are rejected. FAKE_OAUTH_LATENCY_MS delays every answer to
+# mimic the real round trip.
+SESSION_PATH = "/auth/v1/env/oauth/session-data"
+LATENCY = float(os.environ.get("FAKE_OAUTH_LATENCY_MS", "0")) / 1000
+
+app = FastAPI()
+
+
+@app.get(SESSION_PATH)
+async def session_data(x_session_id: str = Header("")):
+    if LATENCY:
+        await asyncio.sleep(LATENCY)
+    prefix, _, rest = x_session_id.partition("_")
+    index = rest.split("_")[0]
+    if not prefix or not index or prefix == "invalid":
+        raise HTTPException(status_code=401, detail="invalid session")
+    return {"email": f"{prefix}_{index}@{prefix}.test", "name": f"{prefix.title()} {index}",
+            "picture": "", "session_token": f"{prefix}_oauth_{x_session_id}"}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.environ.get("FAKE_OAUTH_PORT", "8099")))
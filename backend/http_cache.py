@@ -0,0 +1,195 @@
+import gzip
+import hashlib
+import zlib
+from typing import Iterable, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+# Streamed bodies are only encoded for these; anything else streamed (SSE in particular,
+# which must be flushed event by event and would pin a compressor per connection) is
+# sent identity.
+STREAM_COMPRESSIBLE_TYPES = ("application/x-ndjson",)
+NEVER_COMPRESSED_TYPES = ("text/event-stream",)
+
+
+def body_etag(body: bytes) -> str:
+    # Weak: the same representation is served identity, gzip or br encoded.
+    return f'W/"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith("W/") else candidate) == opaque:
+            return True
+    return False
+
+
+def not_modified_headers(headers: Iterable[tuple]) -> list:
+    keep = {b"etag", b"cache-control", b"vary", b"expires", b"date"}
+    return [(k, v) for k, v in headers if k.lower() in keep]
+
+
+class ConditionalGetMiddleware:
+    # For GETs on the given route templates, buffers 200 responses, tags them with
+    # an ETag (the handler's own, or a hash of the body) and answers a matching
+    # If-None-Match with an empty 304. Other routes stream through untouched.
+    def __init__(self, app, routes: Iterable[str], cache_control: str = "private, no-cache"):
+        self.app = app
+        self.routes = set(routes)
+        self.cache_control = cache_control
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        if_none_match = Headers(scope=scope).get("if-none-match")
+        state = {"start": None, "body": [], "passthrough": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                route = getattr(scope.get("route"), "path", None)
+                if message["status"] != 200 or route not in self.routes:
+                    state["passthrough"] = True
+                    await send(message)
+                else:
+                    state["start"] = message
+                return
+            if state["passthrough"] or message["type"] != "http.response.body":
+                await send(message)
+                return
+            state["body"].append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            start = state["start"]
+            body = b"".join(state["body"])
+            headers = MutableHeaders(scope=start)
+            etag = headers.get("etag") or body_etag(body)
+            headers["etag"] = etag
+            if "cache-control" not in headers:
+                headers["cache-control"] = self.cache_control
+            if etag_matches(if_none_match, etag):
+                await send({"type": "http.response.start", "status": 304,
+                            "headers": not_modified_headers(start["headers"])})
+                await send({"type": "http.response.body", "body": b""})
+                return
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if coding and q > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class _Encoder:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=brotli_quality)
+            self._zlib = None
+        else:
+            self._br = None
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        # Flushed per chunk so streamed NDJSON rows reach the client as they are produced.
+        if self._br is not None:
+            return self._br.process(data) + self._br.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._br.finish() if self._br is not None else self._zlib.flush()
+
+
+class CompressionMiddleware:
+    # Brotli when the client accepts it and the module is installed, gzip otherwise.
+    # Whole bodies under `minimum_size` are sent as is; streamed bodies are encoded only
+    # for STREAM_COMPRESSIBLE_TYPES.
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _choose(self, scope) -> Optional[str]:
+        accepted = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        if brotli is not None and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        encoding = self._choose(scope) if scope["type"] == "http" else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        state = {"start": None, "encoder": None, "passthrough": False, "streamable": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                if ("content-encoding" in headers or message["status"] in (204, 304)
+                        or not content_type.startswith(COMPRESSIBLE_TYPES)
+                        or content_type.startswith(NEVER_COMPRESSED_TYPES)):
+                    state["passthrough"] = True
+                    await send(message)
+                else:
+                    state["start"] = message
+                    state["streamable"] = content_type.startswith(STREAM_COMPRESSIBLE_TYPES)
+                return
+            if state["passthrough"] or message["type"] != "http.response.body":
+                await send(message)
+                return
+            start, encoder = state["start"], state["encoder"]
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                headers = MutableHeaders(scope=start)
+                headers.add_vary_header("Accept-Encoding")
+                if (more_body and not state["streamable"]) or (not more_body and len(body) < self.minimum_size):
+                    state["passthrough"] = True
+                    await send(start)
+                    await send(message)
+                    return
+                headers["content-encoding"] = encoding
+                if not more_body:
+                    compressed = (brotli.compress(body, quality=self.brotli_quality) if encoding == "br"
+                                  else gzip.compress(body, self.gzip_level))
+                    headers["content-length"] = str(len(compressed))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                del headers["content-length"]
+                encoder = state["encoder"] = _Encoder(encoding, self.gzip_level, self.brotli_quality)
+                await send(start)
+            data = encoder.chunk(body) if body else b""
+            if not more_body:
+                data += encoder.finish()
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,177 @@
+import random
+from typing import Dict, Iterable, List, Optional
+
+
+class _Tail:
+    # Sentinel key that sorts after every real key.
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, height: int):
+        self.key = key
+        self.next: List[Optional["_Node"]] = [None] * height
+        self.width: List[int] = [1] * height
+
+
+class IndexableSkipList:
+    # Sorted set of comparable keys with O(log n) insert, remove, rank and
+    # positional lookup. Each link stores how many bottom-level nodes it spans.
+    MAX_LEVELS = 32
+
+    def __init__(self):
+        self._tail = _Node(_Tail(), 0)
+        self._head = _Node(None, self.MAX_LEVELS)
+        self._head.next = [self._tail] * self.MAX_LEVELS
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, key):
+        chain = [None] * self.MAX_LEVELS
+        steps_at_level = [0] * self.MAX_LEVELS
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        height = 1
+        while height < self.MAX_LEVELS and random.random() < 0.5:
+            height += 1
+        new = _Node(key, height)
+        steps = 0
+        for level in range(height):
+            prev = chain[level]
+            new.next[level] = prev.next[level]
+            prev.next[level] = new
+            new.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(height, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+        self._size += 1
+
+    def remove(self, key):
+        chain = [None] * self.MAX_LEVELS
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target is self._tail or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self._size -= 1
+
+    def index(self, key) -> int:
+        node = self._head
+        position = 0
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        found = node.next[0]
+        if found is self._tail or found.key != key:
+            raise KeyError(key)
+        return position
+
+    def slice(self, start: int, stop: int) -> list:
+        start = max(0, start)
+        stop = min(self._size, stop)
+        if start >= stop:
+            return []
+        node = self._head
+        remaining = start + 1
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        keys = []
+        for _ in range(stop - start):
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class DailyLeaderboard:
+    # Today's daily_xp ordered by (xp desc, user_id). Daily XP only grows, so an
+    # update carrying a lower xp than we already hold is a stale read and is ignored.
+    def __init__(self):
+        self.date: Optional[str] = None
+        self.synced_at = None
+        self._xp: Dict[str, int] = {}
+        self._profiles: Dict[str, dict] = {}
+        self._order = IndexableSkipList()
+
+    def __len__(self) -> int:
+        return len(self._xp)
+
+    def reset(self, date: str, docs: Iterable[dict], synced_at=None):
+        self.date = date
+        self.synced_at = synced_at
+        self._xp = {}
+        self._profiles = {}
+        self._order = IndexableSkipList()
+        for doc in docs:
+            self.update(doc)
+
+    def update(self, doc: dict):
+        if doc.get("date", self.date) != self.date:
+            return
+        user_id = doc["user_id"]
+        xp = doc.get("xp", 0)
+        self._profiles[user_id] = {"display_name": doc.get("display_name", ""),
+                                   "picture": doc.get("picture", "")}
+        old = self._xp.get(user_id)
+        if old is not None:
+            if xp <= old:
+                return
+            self._order.remove((-old, user_id))
+        self._order.insert((-xp, user_id))
+        self._xp[user_id] = xp
+
+    def increment(self, user_id: str, date: str, delta: int, profile: dict):
+        self.update({"user_id": user_id, "date": date,
+                     "xp": self._xp.get(user_id, 0) + delta, **profile})
+
+    def score(self, user_id: str) -> Optional[int]:
+        return self._xp.get(user_id)
+
+    def rank(self, user_id: str) -> int:
+        xp = self._xp.get(user_id)
+        if xp is None:
+            return 0
+        return self._order.index((-xp, user_id)) + 1
+
+    def top(self, n: int) -> List[dict]:
+        return self._rows(self._order.slice(0, n), 1)
+
+    def around(self, user_id: str, radius: int) -> List[dict]:
+        position = self.rank(user_id)
+        if not position:
+            return []
+        start = max(0, position - 1 - radius)
+        return self._rows(self._order.slice(start, position + radius), start + 1)
+
+    def select(self, user_ids: Iterable[str], limit: int) -> List[dict]:
+        keys = sorted((-self._xp[uid], uid) for uid in set(user_ids) if uid in self._xp)
+        return self._rows(keys[:limit], 1)
+
+    def _rows(self, keys: list, first_position: int) -> List[dict]:
+        return [{"user_id": user_id, "date": self.date, "xp": -neg_xp,
+                 **self._profiles[user_id], "position": first_position + i}
+                for i, (neg_xp, user_id) in enumerate(keys)]
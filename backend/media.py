@@ -0,0 +1,152 @@
+import asyncio
+import base64
+import binascii
+import io
+import re
+import uuid
+from typing import AsyncIterator, Iterable, Optional, Tuple
+
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Every upload is re-encoded into fixed boxes per kind: "full" is fitted inside its box,
+# "thumb" is center-cropped to exactly its size. Listings and avatars use the thumb.
+MEDIA_KINDS = {
+    "avatar": {"full": (512, 512), "thumb": (96, 96)},
+    "banner": {"full": (1500, 500), "thumb": (600, 200)},
+}
+MEDIA_VARIANTS = ("full", "thumb")
+MEDIA_ID_RE = re.compile(r"^media_[0-9a-f]{12}$")
+CONTENT_TYPE = "image/webp"
+
+
+class InvalidMedia(ValueError):
+    pass
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def decode_data_url(value: str) -> bytes:
+    header, _, payload = value.partition(",")
+    if not header.startswith("data:image/") or not header.endswith(";base64"):
+        raise InvalidMedia("Imagem inválida")
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise InvalidMedia("Imagem inválida")
+
+
+def render_variants(data: bytes, kind: str, max_pixels: int) -> dict:
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # The header is read lazily, so oversized images are refused before decoding.
+            if img.width * img.height > max_pixels:
+                raise InvalidMedia("Imagem com resolução muito alta")
+            img = ImageOps.exif_transpose(img)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        raise InvalidMedia("Imagem inválida")
+    alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+    img = img.convert("RGBA" if alpha else "RGB")
+    sizes = MEDIA_KINDS[kind]
+    full = img.copy()
+    full.thumbnail(sizes["full"], Image.LANCZOS)
+    thumb = ImageOps.fit(img, sizes["thumb"], Image.LANCZOS)
+    return {"full": _encode(full), "thumb": _encode(thumb)}
+
+
+def _encode(img) -> bytes:
+    out = io.BytesIO()
+    img.save(out, "WEBP", quality=82, method=4)
+    return out.getvalue()
+
+
+def parse_byte_range(header: Optional[str], length: int) -> Optional[Tuple[int, int]]:
+    # Single ranges only; anything else (absent, malformed, multipart) gets the whole body.
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise RangeNotSatisfiable()
+            return max(0, length - suffix), length - 1
+        start = int(first)
+        end = min(int(last), length - 1) if last else length - 1
+    except ValueError:
+        return None
+    if start >= length or end < start:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+class MediaStore:
+    # Images live in a GridFS bucket, one file per variant with _id "<media_id>/<variant>",
+    # so serving one is a lookup by _id. Users and clans only keep the short `ref`.
+    def __init__(self, db, bucket: str = "media", url_prefix: str = "/api/media",
+                 max_bytes: int = 5 * 1024 * 1024, max_pixels: int = 40_000_000):
+        self.files = db[f"{bucket}.files"]
+        self.chunks = db[f"{bucket}.chunks"]
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket)
+        self.url_prefix = url_prefix
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+
+    def ref(self, media_id: str) -> str:
+        return f"{self.url_prefix}/{media_id}"
+
+    def media_id(self, ref: Optional[str]) -> Optional[str]:
+        if not ref or not ref.startswith(self.url_prefix + "/"):
+            return None
+        media_id = ref[len(self.url_prefix) + 1:]
+        return media_id if MEDIA_ID_RE.match(media_id) else None
+
+    async def save(self, data: bytes, kind: str, owner: str) -> str:
+        if kind not in MEDIA_KINDS:
+            raise InvalidMedia("Tipo de imagem inválido")
+        if not data:
+            raise InvalidMedia("Imagem inválida")
+        if len(data) > self.max_bytes:
+            raise InvalidMedia(f"Imagem maior que {self.max_bytes // (1024 * 1024)} MB")
+        variants = await asyncio.to_thread(render_variants, data, kind, self.max_pixels)
+        media_id = f"media_{uuid.uuid4().hex[:12]}"
+        for variant, body in variants.items():
+            await self.bucket.upload_from_stream_with_id(
+                f"{media_id}/{variant}", f"{media_id}-{variant}.webp", body,
+                metadata={"media_id": media_id, "variant": variant, "kind": kind,
+                          "owner": owner, "content_type": CONTENT_TYPE})
+        return media_id
+
+    async def open(self, media_id: str, variant: str):
+        if not MEDIA_ID_RE.match(media_id) or variant not in MEDIA_VARIANTS:
+            return None
+        try:
+            return await self.bucket.open_download_stream(f"{media_id}/{variant}")
+        except NoFile:
+            return None
+
+    @staticmethod
+    async def stream(grid_out, start: int, end: int) -> AsyncIterator[bytes]:
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.read(min(remaining, grid_out.chunk_size))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    async def delete_refs(self, refs: Iterable[Optional[str]], owner: str):
+        # Only the uploader's own media is removed; a ref copied from someone else stays.
+        ids = [f"{media_id}/{variant}" for media_id in filter(None, map(self.media_id, refs))
+               for variant in MEDIA_VARIANTS]
+        if not ids:
+            return
+        owned = [d["_id"] for d in await self.files.find(
+            {"_id": {"$in": ids}, "metadata.owner": owner}, {"_id": 1}).to_list(len(ids))]
+        if owned:
+            await self.files.delete_many({"_id": {"$in": owned}})
+            await self.chunks.delete_many({"files_id": {"$in": owned}})
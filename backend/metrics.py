@@ -0,0 +1,196 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+from starlette.datastructures import MutableHeaders
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMAND_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class RequestStats:
+    # Mongo work attributed to one in-flight request. Motor runs commands on executor
+    # threads with a copy of the request's context, so they reach this object through
+    # `current_request` and update it from those threads.
+    __slots__ = ("commands", "_lock")
+
+    def __init__(self):
+        self.commands: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, command: str, seconds: float):
+        with self._lock:
+            entry = self.commands.setdefault(command, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    @property
+    def command_count(self) -> int:
+        return sum(int(n) for n, _ in self.commands.values())
+
+    @property
+    def command_seconds(self) -> float:
+        return sum(s for _, s in self.commands.values())
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{k}="{str(v)}"' for k, v in labels.items())
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_latency: Dict[tuple, Histogram] = {}
+        self.request_commands: Dict[tuple, Histogram] = {}
+        self.mongo_commands: Dict[tuple, List[float]] = {}
+        self._collectors: List[Callable[[], List[tuple]]] = []
+
+    def add_collector(self, collector: Callable[[], List[tuple]]):
+        # A collector returns (name, labels dict, value) gauges sampled at scrape time.
+        self._collectors.append(collector)
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float,
+                        stats: RequestStats):
+        with self._lock:
+            key = (method, route, status)
+            if key not in self.request_latency:
+                self.request_latency[key] = Histogram(LATENCY_BUCKETS)
+            self.request_latency[key].observe(seconds)
+            key = (method, route)
+            if key not in self.request_commands:
+                self.request_commands[key] = Histogram(COMMAND_COUNT_BUCKETS)
+            self.request_commands[key].observe(stats.command_count)
+            for command, (count, command_seconds) in stats.commands.items():
+                self._add_command(route, command, count, command_seconds)
+
+    def observe_background_command(self, command: str, seconds: float):
+        with self._lock:
+            self._add_command("background", command, 1, seconds)
+
+    def _add_command(self, route: str, command: str, count: int, seconds: float):
+        entry = self.mongo_commands.setdefault((route, command), [0, 0.0])
+        entry[0] += count
+        entry[1] += seconds
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            self._render_histograms(lines, "http_request_duration_seconds",
+                                    "Request latency by route template and status.",
+                                    self.request_latency, ("method", "route", "status"))
+            self._render_histograms(lines, "http_request_mongo_commands",
+                                    "Mongo commands issued per request.",
+                                    self.request_commands, ("method", "route"))
+            lines.append("# HELP mongo_commands_total Mongo commands by route and command name.")
+            lines.append("# TYPE mongo_commands_total counter")
+            for (route, command), (count, _) in sorted(self.mongo_commands.items()):
+                lines.append(f"mongo_commands_total{{{_labels(route=route, command=command)}}} {count}")
+            lines.append("# HELP mongo_command_seconds_total Time spent in Mongo commands.")
+            lines.append("# TYPE mongo_command_seconds_total counter")
+            for (route, command), (_, seconds) in sorted(self.mongo_commands.items()):
+                lines.append(f"mongo_command_seconds_total{{{_labels(route=route, command=command)}}} {seconds:.6f}")
+        gauges: Dict[str, List[str]] = {}
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                label_str = f"{{{_labels(**labels)}}}" if labels else ""
+                gauges.setdefault(name, []).append(f"{name}{label_str} {value}")
+        for name, samples in sorted(gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_histograms(lines: List[str], name: str, help_text: str,
+                           histograms: Dict[tuple, Histogram], label_names: Tuple[str, ...]):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, h in sorted(histograms.items()):
+            labels = _labels(**dict(zip(label_names, key)))
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {h.count}')
+            lines.append(f"{name}_sum{{{labels}}} {h.total:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {h.count}")
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        seconds = event.duration_micros / 1e6
+        stats = current_request.get()
+        if stats is not None:
+            stats.add(event.command_name, seconds)
+        else:
+            self.registry.observe_background_command(event.command_name, seconds)
+
+
+class MetricsMiddleware:
+    # Pure ASGI middleware: times every HTTP request, labels it with the matched route
+    # template (so /api/profile/{user_id} is one series) and optionally reports the
+    # request's Mongo time in a Server-Timing header.
+    def __init__(self, app, registry: MetricsRegistry, server_timing: bool = False):
+        self.app = app
+        self.registry = registry
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if self.server_timing:
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    MutableHeaders(scope=message).append("Server-Timing", (
+                        f'app;dur={elapsed_ms:.1f}, db;dur={stats.command_seconds * 1000:.1f};'
+                        f'desc="{stats.command_count} mongo commands"'))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            self.registry.observe_request(
+                scope["method"], getattr(route, "path", "unmatched"), status["code"],
+                time.perf_counter() - started, stats)
+            current_request.reset(token)
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import socket
+import sys
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, List, NamedTuple
+
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_COLLECTION = "schema_migrations"
+# The lock holder renews the lock every LOCK_HEARTBEAT while a migration runs, so a
+# long migration keeps it and a crashed worker's lock frees up within LOCK_TTL.
+LOCK_TTL = timedelta(seconds=float(os.environ.get("MIGRATION_LOCK_TTL_SECONDS", "60")))
+LOCK_HEARTBEAT = LOCK_TTL.total_seconds() / 4
+FOLLOWER_POLL = 1.0
+FOLLOWER_TIMEOUT = float(os.environ.get("MIGRATION_WAIT_SECONDS", "1800"))
+# Migrations and rollups use $dateTrunc (5.0), $unionWith (4.4) and $merge (4.2).
+MIN_SERVER_VERSION = (5, 0)
+
+
+class MigrationError(RuntimeError):
+    pass
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[], Awaitable[None]]
+
+
+async def check_server_version(db):
+    info = await db.command("buildInfo")
+    version = tuple(info.get("versionArray", [])[:2])
+    if version < MIN_SERVER_VERSION:
+        raise MigrationError(f"MongoDB {info.get('version')} is not supported; "
+                             f"{'.'.join(map(str, MIN_SERVER_VERSION))} or newer is required")
+
+
+async def get_schema_version(db) -> int:
+    doc = await db[MIGRATIONS_COLLECTION].find_one({"_id": "version"})
+    return doc["version"] if doc else 0
+
+
+async def acquire_lock(db, owner: str) -> bool:
+    now = datetime.now(timezone.utc)
+    try:
+        await db[MIGRATIONS_COLLECTION].find_one_and_update(
+            {"_id": "lock", "$or": [{"expires_at": {"$lt": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "expires_at": now + LOCK_TTL}}, upsert=True)
+        return True
+    except DuplicateKeyError:
+        # Someone else holds an unexpired lock, so the upsert collided with it.
+        return False
+
+
+async def release_lock(db, owner: str):
+    await db[MIGRATIONS_COLLECTION].delete_one({"_id": "lock", "owner": owner})
+
+
+async def migrate(db, migrations: List[Migration], target: int = None) -> int:
+    # Applies pending migrations in version order. Only the worker that holds the lock
+    # runs them; the others wait for the schema version to catch up, take over if the
+    # lock is freed before it does, and raise rather than start on an old schema.
+    await check_server_version(db)
+    migrations = sorted(migrations, key=lambda m: m.version)
+    target = migrations[-1].version if target is None else target
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FOLLOWER_TIMEOUT
+    while True:
+        version = await get_schema_version(db)
+        if version >= target:
+            return version
+        if await acquire_lock(db, owner):
+            return await apply_migrations(db, migrations, target, owner)
+        if loop.time() > deadline:
+            raise MigrationError(f"Schema is at version {version}, expected {target}; "
+                                 f"gave up waiting for the migration lock after {FOLLOWER_TIMEOUT:.0f}s")
+        await asyncio.sleep(FOLLOWER_POLL)
+
+
+async def apply_migrations(db, migrations: List[Migration], target: int, owner: str) -> int:
+    heartbeat = LockHeartbeat(db, owner, asyncio.current_task())
+    try:
+        version = await get_schema_version(db)
+        for m in migrations:
+            if m.version <= version or m.version > target:
+                continue
+            logger.info(f"Applying migration {m.version:03d} {m.name}")
+            await m.apply()
+            await db[MIGRATIONS_COLLECTION].update_one({"_id": "version"}, {
+                "$set": {"version": m.version},
+                "$push": {"applied": {"version": m.version, "name": m.name,
+                                      "applied_at": datetime.now(timezone.utc)}}
+            }, upsert=True)
+            version = m.version
+        return version
+    except asyncio.CancelledError:
+        if heartbeat.lost:
+            raise MigrationError(f"Lost the migration lock while applying migrations up to {target}")
+        raise
+    finally:
+        heartbeat.stop()
+        await release_lock(db, owner)
+
+
+class LockHeartbeat:
+    # Renews the migration lock in the background. If it finds the lock taken over,
+    # the migrating task is cancelled rather than left racing another worker.
+    def __init__(self, db, owner: str, holder: asyncio.Task):
+        self.db = db
+        self.owner = owner
+        self.holder = holder
+        self.lost = False
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(LOCK_HEARTBEAT)
+            try:
+                result = await self.db[MIGRATIONS_COLLECTION].update_one(
+                    {"_id": "lock", "owner": self.owner},
+                    {"$set": {"expires_at": datetime.now(timezone.utc) + LOCK_TTL}})
+            except Exception:
+                logger.exception("Migration lock renewal failed")
+                continue
+            if not result.matched_count:
+                logger.error(f"Migration lock held by {self.owner} expired and was taken over")
+                self.lost = True
+                self.holder.cancel()
+                return
+
+
+async def drop_duplicates(collection, keys: List[str]) -> int:
+    # Keeps the first document of every duplicate key group so a unique index can be built.
+    groups = await collection.aggregate([
+        {"$group": {"_id": {k: f"${k}" for k in keys}, "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ], allowDiskUse=True).to_list(None)
+    extra = [i for g in groups for i in g["ids"][1:]]
+    if extra:
+        await collection.delete_many({"_id": {"$in": extra}})
+    return len(extra)
+
+
+def collscan_stages(plan: dict) -> List[str]:
+    stages = []
+    if plan.get("stage") == "COLLSCAN":
+        stages.append("COLLSCAN")
+    for child_key in ("inputStage", "queryPlan"):
+        if child_key in plan:
+            stages += collscan_stages(plan[child_key])
+    for child in plan.get("inputStages", []):
+        stages += collscan_stages(child)
+    return stages
+
+
+async def explain_hot_queries(db, hot_queries: List[dict]) -> List[str]:
+    failures = []
+    for q in hot_queries:
+        command = {"find": q["collection"], "filter": q["filter"]}
+        if q.get("sort"):
+            command["sort"] = q["sort"]
+        result = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        if collscan_stages(result["queryPlanner"]["winningPlan"]):
+            failures.append(q["name"])
+    return failures
+
+
+async def main(argv: List[str]) -> int:
+    import server
+    command = argv[0] if argv else "status"
+    if command == "status":
+        version = await get_schema_version(server.db)
+        pending = [m for m in server.MIGRATIONS if m.version > version]
+        print(f"schema version {version}, {len(pending)} pending")
+        for m in pending:
+            print(f"  {m.version:03d} {m.name}")
+        return 0
+    if command == "migrate":
+        target = int(argv[1]) if len(argv) > 1 else None
+        print(f"schema version {await migrate(server.db, server.MIGRATIONS, target)}")
+        return 0
+    if command == "explain":
+        failures = await explain_hot_queries(server.db, server.HOT_QUERIES)
+        for name in failures:
+            print(f"COLLSCAN: {name}")
+        print(f"{len(server.HOT_QUERIES) - len(failures)}/{len(server.HOT_QUERIES)} hot queries use an index")
+        return 1 if failures else 0
+    if command == "backfill-rollups":
+        await server.backfill_xp_rollups(argv[1] if len(argv) > 1 else None)
+        print("xp rollups rebuilt" + (f" from {argv[1]}" if len(argv) > 1 else ""))
+        return 0
+    print("usage: python migrations.py [status | migrate [version] | explain | backfill-rollups [since]]")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(sys.argv[1:])))
@@ -0,0 +1,110 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (httpx needs it for http2=True)
+except ImportError:  # HTTP/1.1 keep-alive only
+    h2 = None
+
+DEFAULT_SESSION_URL = "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data"
+
+
+class OAuthUnavailable(Exception):
+    pass
+
+
+class OAuthSessionClient:
+    # Exchanges OAuth session ids for profile data over one pooled client per worker.
+    # In-flight exchanges are capped by a semaphore (a login waits at most
+    # `queue_timeout` for a slot), connection failures on a reused keep-alive socket are
+    # retried, timeouts are not. Successful exchanges are cached for `cache_ttl` seconds,
+    # so a double-submitted or retried login does not go upstream twice.
+    def __init__(self, url: str = DEFAULT_SESSION_URL, timeout: float = 5.0, connect_timeout: float = 2.0,
+                 max_concurrency: int = 32, queue_timeout: float = 2.0, max_connections: int = 64,
+                 cache_ttl: float = 60.0, cache_size: int = 10000, retries: int = 1,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.url = url
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_connections, keepalive_expiry=30)
+        self.queue_timeout = queue_timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.retries = retries
+        self.transport = transport
+        self.client: Optional[httpx.AsyncClient] = None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.rejected = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._cache: OrderedDict = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(http2=h2 is not None and self.transport is None,
+                                            timeout=self.timeout, limits=self.limits,
+                                            transport=self.transport)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors,
+                "rejected": self.rejected, "cached": len(self._cache), "inflight": len(self._inflight)}
+
+    async def session_data(self, session_id: str) -> Optional[dict]:
+        # None when upstream rejects the id; OAuthUnavailable when it cannot be asked.
+        cached = self._cache.get(session_id)
+        if cached is not None and cached[0] > time.monotonic():
+            self.hits += 1
+            return cached[1]
+        future = self._inflight.get(session_id)
+        if future is None:
+            self.misses += 1
+            future = self._inflight[session_id] = asyncio.ensure_future(self._exchange(session_id))
+            future.add_done_callback(lambda f: self._inflight.pop(session_id, None))
+        return await asyncio.shield(future)
+
+    async def _exchange(self, session_id: str) -> Optional[dict]:
+        self.start()
+        try:
+            async with asyncio.timeout(self.queue_timeout):
+                await self._semaphore.acquire()
+        except TimeoutError:
+            self.rejected += 1
+            raise OAuthUnavailable("too many concurrent exchanges")
+        try:
+            resp = await self._get(session_id)
+        finally:
+            self._semaphore.release()
+        if resp.status_code >= 500:
+            self.errors += 1
+            raise OAuthUnavailable(f"upstream returned {resp.status_code}")
+        if resp.status_code != 200:
+            return None
+        data = resp.json()
+        self._cache[session_id] = (time.monotonic() + self.cache_ttl, data)
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    async def _get(self, session_id: str) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.client.get(self.url, headers={"X-Session-ID": session_id})
+            except httpx.TimeoutException as e:
+                self.errors += 1
+                raise OAuthUnavailable(f"upstream timed out: {e!r}") from e
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    self.errors += 1
+                    raise OAuthUnavailable(f"upstream unreachable: {e!r}") from e
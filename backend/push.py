@@ -0,0 +1,263 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(topic: str, data) -> str:
+    return f"event: {topic}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+
+class Subscriber:
+    # One open stream. Updates are kept per topic, so a subscriber that has not drained
+    # its last update (slow client, paused transport) holds at most one per topic.
+    __slots__ = ("user_id", "rival_id", "clan_id", "top_version", "rank", "rival",
+                 "clan_total", "pending", "wake")
+
+    def __init__(self, user_id: str, rival_id: str, clan_id: str):
+        self.user_id = user_id
+        self.rival_id = rival_id
+        self.clan_id = clan_id
+        self.top_version = 0
+        self.rank = None
+        self.rival = None
+        self.clan_total = None
+        self.pending: Dict[str, object] = {}
+        self.wake = asyncio.Event()
+
+
+class PushHub:
+    # Fans leaderboard, rank, rival and clan updates out to SSE subscribers. Writers only
+    # bump a version or a clan total; a single tick every `interval` seconds turns that
+    # into per-subscriber updates, so each subscriber gets at most one update per topic
+    # per interval however many completions landed in between. The top-N snapshot and
+    # its deltas are computed once per version and shared by every subscriber. A tick
+    # yields to the event loop every `chunk_size` subscribers, so fanning out to tens of
+    # thousands of streams does not stall request handling.
+    def __init__(self, get_board: Callable[[], Awaitable], load_clan_totals: Callable[[List[str]], Awaitable],
+                 interval: float = 1.0, clan_refresh: float = 5.0, heartbeat: float = 25.0,
+                 top_n: int = 10, max_subscribers: int = 50000, history: int = 8, chunk_size: int = 500):
+        self.get_board = get_board
+        self.load_clan_totals = load_clan_totals
+        self.interval = interval
+        self.clan_refresh = clan_refresh
+        self.heartbeat = heartbeat
+        self.top_n = top_n
+        self.max_subscribers = max_subscribers
+        self.history = history
+        self.chunk_size = chunk_size
+        self.version = 1
+        self.clan_totals: Dict[str, int] = {}
+        self.published = 0
+        self.coalesced = 0
+        self._tick_version = 0
+        self._snapshots: OrderedDict = OrderedDict()
+        self._deltas: Dict[tuple, dict] = {}
+        self._dirty_clans: Set[str] = set()
+        self._subscribers: Set[Subscriber] = set()
+        self._by_user: Dict[str, Set[Subscriber]] = {}
+        self._by_clan: Dict[str, Set[Subscriber]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def full(self) -> bool:
+        return len(self._subscribers) >= self.max_subscribers
+
+    def notify_leaderboard(self):
+        self.version += 1
+
+    def notify_clan_xp(self, clan_id: str, xp: int):
+        # Only clans someone is watching are tracked; the periodic refresh picks up
+        # other workers' and write-behind increments.
+        if clan_id in self.clan_totals:
+            self.clan_totals[clan_id] += xp
+            self._dirty_clans.add(clan_id)
+
+    def update_user(self, user_id: str, **fields):
+        for sub in self._by_user.get(user_id, ()):
+            if "rival_id" in fields:
+                sub.rival_id = fields["rival_id"]
+                sub.rival = None
+            if "clan_id" in fields and fields["clan_id"] != sub.clan_id:
+                self._unindex_clan(sub)
+                sub.clan_id = fields["clan_id"]
+                sub.clan_total = None
+                self._index_clan(sub)
+        if "clan_id" in fields:
+            self._dirty_clans.add(fields["clan_id"])
+        self.version += 1
+
+    async def stream(self, user: dict):
+        sub = Subscriber(user["user_id"], user.get("rival_id", ""), user.get("clan_id", ""))
+        self._subscribers.add(sub)
+        self._by_user.setdefault(sub.user_id, set()).add(sub)
+        self._index_clan(sub)
+        try:
+            if sub.clan_id and sub.clan_id not in self.clan_totals:
+                await self._refresh_clans([sub.clan_id])
+            self._publish_board(sub, await self.get_board(), {})
+            self._publish_clan(sub)
+            while True:
+                if not sub.pending:
+                    try:
+                        async with asyncio.timeout(self.heartbeat):
+                            await sub.wake.wait()
+                    except TimeoutError:
+                        yield ": keepalive\n\n"
+                        continue
+                yield self._drain(sub)
+        finally:
+            self._remove(sub)
+
+    @staticmethod
+    def _drain(sub: Subscriber) -> str:
+        # Kept out of the generator so an idle stream's frame holds no drained payloads.
+        sub.wake.clear()
+        pending, sub.pending = sub.pending, {}
+        top = pending.get("top") or pending.get("top_delta")
+        if top is not None:
+            sub.top_version = top["version"]
+        return "".join(sse_event(topic, data) for topic, data in pending.items())
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def metrics(self) -> dict:
+        return {"subscribers": len(self._subscribers), "watched_clans": len(self.clan_totals),
+                "published": self.published, "coalesced": self.coalesced, "version": self.version}
+
+    async def tick(self):
+        if self.version != self._tick_version and self._subscribers:
+            board = await self.get_board()
+            self._tick_version = self.version
+            self._deltas = {}
+            positions, version = {}, self.version
+            async for subs in self._chunks(list(self._subscribers)):
+                if version != self.version:
+                    # The board moved while we yielded, so memoized positions are stale.
+                    # _tick_version stays behind and the next tick covers everyone again.
+                    positions, version = {}, self.version
+                for sub in subs:
+                    self._publish_board(sub, board, positions)
+        dirty, self._dirty_clans = self._dirty_clans, set()
+        watching = [sub for clan_id in dirty for sub in self._by_clan.get(clan_id, ())]
+        async for subs in self._chunks(watching):
+            for sub in subs:
+                self._publish_clan(sub)
+
+    async def _chunks(self, subs: List[Subscriber]):
+        for i in range(0, len(subs), self.chunk_size):
+            if i:
+                await asyncio.sleep(0)
+            yield subs[i:i + self.chunk_size]
+
+    async def _run(self):
+        since_refresh = 0.0
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                since_refresh += self.interval
+                if since_refresh >= self.clan_refresh and self._by_clan:
+                    since_refresh = 0.0
+                    await self._refresh_clans(list(self._by_clan))
+                await self.tick()
+            except Exception:
+                logger.exception("Push hub tick failed")
+
+    async def _refresh_clans(self, clan_ids: List[str]):
+        totals = await self.load_clan_totals(clan_ids)
+        for clan_id in clan_ids:
+            total = totals.get(clan_id, 0)
+            if self.clan_totals.get(clan_id) != total:
+                self.clan_totals[clan_id] = total
+                self._dirty_clans.add(clan_id)
+
+    def _publish_board(self, sub: Subscriber, board, positions: dict):
+        if sub.top_version != self.version:
+            # Always relative to what the client has received, so replacing an unsent
+            # update never drops changes.
+            if sub.pending.pop("top", None) or sub.pending.pop("top_delta", None):
+                self.coalesced += 1
+            topic, data = self._top_update(sub.top_version, board)
+            if topic == "top" or data["changed"] or data["removed"]:
+                self._push(sub, topic, data)
+            else:
+                sub.top_version = self.version
+        rank = self._position(board, sub.user_id, positions)
+        if rank != sub.rank:
+            sub.rank = rank
+            self._push(sub, "rank", {"position": rank[0], "xp": rank[1]})
+        if sub.rival_id:
+            rival = self._position(board, sub.rival_id, positions)
+            if rival != sub.rival:
+                sub.rival = rival
+                self._push(sub, "rival", {"user_id": sub.rival_id, "position": rival[0], "xp": rival[1]})
+
+    @staticmethod
+    def _position(board, user_id: str, positions: dict) -> tuple:
+        # Memoized per tick: rivals and top players are shared by many subscribers.
+        if user_id not in positions:
+            positions[user_id] = (board.rank(user_id), board.score(user_id) or 0)
+        return positions[user_id]
+
+    def _publish_clan(self, sub: Subscriber):
+        total = self.clan_totals.get(sub.clan_id) if sub.clan_id else None
+        if total is not None and total != sub.clan_total:
+            sub.clan_total = total
+            self._push(sub, "clan", {"clan_id": sub.clan_id, "total_xp": total})
+
+    def _top_update(self, since_version: int, board) -> tuple:
+        if self.version not in self._snapshots:
+            rows = board.top(self.top_n)
+            self._snapshots[self.version] = ({r["user_id"]: r for r in rows},
+                                             {"version": self.version, "entries": rows})
+            while len(self._snapshots) > self.history:
+                self._snapshots.popitem(last=False)
+        current, full = self._snapshots[self.version]
+        previous = self._snapshots.get(since_version, (None,))[0]
+        if previous is None:
+            return "top", full
+        key = (since_version, self.version)
+        if key not in self._deltas:
+            self._deltas[key] = {
+                "version": self.version,
+                "changed": [r for uid, r in current.items() if previous.get(uid) != r],
+                "removed": [uid for uid in previous if uid not in current]}
+        return "top_delta", self._deltas[key]
+
+    def _push(self, sub: Subscriber, topic: str, data):
+        if topic in sub.pending:
+            self.coalesced += 1
+        sub.pending[topic] = data
+        self.published += 1
+        sub.wake.set()
+
+    def _index_clan(self, sub: Subscriber):
+        if sub.clan_id:
+            self._by_clan.setdefault(sub.clan_id, set()).add(sub)
+
+    def _unindex_clan(self, sub: Subscriber):
+        subs = self._by_clan.get(sub.clan_id)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self._by_clan[sub.clan_id]
+                self.clan_totals.pop(sub.clan_id, None)
+
+    def _remove(self, sub: Subscriber):
+        self._subscribers.discard(sub)
+        subs = self._by_user.get(sub.user_id)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self._by_user[sub.user_id]
+        self._unindex_clan(sub)
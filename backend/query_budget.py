@@ -0,0 +1,391 @@
+import asyncio
+import functools
+import os
+import sys
+import threading
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+from search import name_trigrams, normalize_name
+
+# Worst-case Mongo commands per request for every route in api_router, with a cold
+# session cache and a leaderboard rebuild included. Lower a budget when a handler gets
+# cheaper; raising one needs a reason in the commit that does it.
+QUERY_BUDGETS: Dict[Tuple[str, str], int] = {
+    ("POST", "/api/auth/session"): 5,
+    ("GET", "/api/auth/me"): 2,
+    ("POST", "/api/auth/logout"): 1,
+    ("POST", "/api/onboarding"): 4,
+    ("GET", "/api/profile"): 2,
+    ("PUT", "/api/profile"): 15,
+    ("POST", "/api/media"): 10,
+    ("GET", "/api/media/{media_id}"): 2,
+    ("GET", "/api/media/{media_id}/{variant}"): 2,
+    ("GET", "/api/profile/{user_id}"): 1,
+    ("GET", "/api/subjects"): 2,
+    ("POST", "/api/subjects"): 3,
+    ("DELETE", "/api/subjects/{name}"): 3,
+    ("POST", "/api/activities"): 5,
+    ("GET", "/api/activities"): 4,
+    ("PUT", "/api/activities/{activity_id}"): 5,
+    ("POST", "/api/activities/{activity_id}/complete"): 19,
+    ("DELETE", "/api/activities/{activity_id}"): 3,
+    ("GET", "/api/dashboard"): 12,
+    ("GET", "/api/stream"): 4,
+    ("GET", "/api/write-behind/stats"): 0,
+    ("GET", "/api/rankings/global"): 2,
+    ("GET", "/api/rankings/global/around-me"): 3,
+    ("GET", "/api/rankings/streak"): 1,
+    ("GET", "/api/rankings/friends"): 5,
+    ("GET", "/api/rankings/clans"): 2,
+    ("GET", "/api/rankings/schools"): 1,
+    ("GET", "/api/shop"): 3,
+    ("POST", "/api/shop/buy/{item_id}"): 5,
+    ("GET", "/api/friends"): 4,
+    ("POST", "/api/friends/request"): 5,
+    ("POST", "/api/friends/respond"): 4,
+    ("POST", "/api/friends/rival/{target_user_id}"): 3,
+    ("GET", "/api/friends/search"): 4,
+    ("GET", "/api/clans"): 1,
+    ("POST", "/api/clans"): 12,
+    ("GET", "/api/clans/{clan_id}"): 2,
+    ("POST", "/api/clans/{clan_id}/join"): 5,
+    ("POST", "/api/clans/{clan_id}/leave"): 9,
+    ("GET", "/api/missions"): 6,
+    ("POST", "/api/missions/{mission_id}/claim"): 9,
+    ("GET", "/api/goals"): 5,
+    ("PUT", "/api/goals"): 6,
+    ("GET", "/api/badges"): 3,
+    ("GET", "/api/cache/stats"): 0,
+    ("GET", "/api/metrics"): 0,
+}
+MAX_REPEATS = int(os.environ.get("QUERY_BUDGET_MAX_REPEATS", "3"))
+DATA_COMMANDS = {"find", "getMore", "aggregate", "count", "distinct", "insert", "update",
+                 "delete", "findAndModify"}
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryLog:
+    # Data commands seen while one request (or one `query_budget` block) was active.
+    def __init__(self):
+        self.shapes: List[str] = []
+        self._lock = threading.Lock()
+
+    def add(self, shape: str):
+        with self._lock:
+            self.shapes.append(shape)
+
+    def __len__(self) -> int:
+        return len(self.shapes)
+
+    def repeated(self, max_repeats: int) -> Dict[str, int]:
+        return {s: n for s, n in Counter(self.shapes).items() if n > max_repeats}
+
+
+current_log: ContextVar[Optional[QueryLog]] = ContextVar("current_query_log", default=None)
+
+
+def _shape(value) -> str:
+    # Keeps field names and operators, drops the values, so the same query issued for
+    # different ids has the same shape.
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{k}:{_shape(v)}" for k, v in sorted(value.items())) + "}"
+    if isinstance(value, list):
+        return "[" + (_shape(value[0]) if value else "") + "]"
+    return "?"
+
+
+def query_shape(command_name: str, collection: str, query: Optional[dict]) -> str:
+    return f"{command_name} {collection} {_shape(query or {})}"
+
+
+def _command_query(command_name: str, command: dict) -> Optional[dict]:
+    if command_name == "find":
+        return command.get("filter")
+    if command_name == "aggregate":
+        pipeline = command.get("pipeline") or [{}]
+        return pipeline[0].get("$match")
+    if command_name in ("count", "distinct", "findAndModify"):
+        return command.get("query")
+    if command_name == "update":
+        return (command.get("updates") or [{}])[0].get("q")
+    if command_name == "delete":
+        return (command.get("deletes") or [{}])[0].get("q")
+    return None
+
+
+class QueryBudgetListener(monitoring.CommandListener):
+    def started(self, event):
+        log = current_log.get()
+        if log is None or event.command_name not in DATA_COMMANDS:
+            return
+        command = event.command
+        collection = command.get("collection") if event.command_name == "getMore" \
+            else command.get(event.command_name)
+        log.add(query_shape(event.command_name, collection,
+                            _command_query(event.command_name, command)))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+_installed = False
+
+
+def install():
+    # Must run before `server` is imported: pymongo only attaches globally registered
+    # listeners to clients created afterwards.
+    global _installed
+    if not _installed:
+        monitoring.register(QueryBudgetListener())
+        _installed = True
+
+
+def budget_problems(label: str, log: QueryLog, budget: Optional[int],
+                    max_repeats: int = MAX_REPEATS) -> List[str]:
+    problems = []
+    if budget is None:
+        problems.append(f"{label}: no query budget declared")
+    elif len(log) > budget:
+        problems.append(f"{label}: {len(log)} Mongo commands, budget is {budget}")
+    for shape, count in log.repeated(max_repeats).items():
+        problems.append(f"{label}: query repeated {count} times (possible N+1): {shape}")
+    return problems
+
+
+class query_budget:
+    # Context manager / decorator for code outside a request:
+    #     with query_budget(3): await rebuild_leaderboard(today)
+    #     @query_budget(12) async def test_dashboard(): ...
+    def __init__(self, max_commands: int, max_repeats: int = MAX_REPEATS, label: str = "block"):
+        self.max_commands = max_commands
+        self.max_repeats = max_repeats
+        self.label = label
+        self.log = QueryLog()
+
+    def __enter__(self) -> QueryLog:
+        install()
+        self.log = QueryLog()
+        self._token = current_log.set(self.log)
+        return self.log
+
+    def __exit__(self, exc_type, exc, tb):
+        current_log.reset(self._token)
+        if exc_type is None:
+            problems = budget_problems(self.label, self.log, self.max_commands, self.max_repeats)
+            if problems:
+                raise QueryBudgetExceeded("\n".join(problems))
+
+    def __call__(self, func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with query_budget(self.max_commands, self.max_repeats, func.__name__):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with query_budget(self.max_commands, self.max_repeats, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class QueryBudgetGuard:
+    # Wraps the ASGI app handed to an in-process client (httpx.ASGITransport) and checks
+    # every request against QUERY_BUDGETS by its matched route template. With `strict`
+    # the offending request raises; otherwise violations are collected for a report.
+    def __init__(self, app, budgets: Dict[Tuple[str, str], int] = QUERY_BUDGETS,
+                 max_repeats: int = MAX_REPEATS, strict: bool = True):
+        install()
+        self.app = app
+        self.budgets = budgets
+        self.max_repeats = max_repeats
+        self.strict = strict
+        self.violations: List[str] = []
+        self.observed: Dict[Tuple[str, str], int] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        log = QueryLog()
+        token = current_log.set(log)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_log.reset(token)
+        route = getattr(scope.get("route"), "path", None)
+        if route is None:
+            return
+        key = (scope["method"], route)
+        self.observed[key] = max(self.observed.get(key, 0), len(log))
+        problems = budget_problems(f"{key[0]} {key[1]}", log, self.budgets.get(key), self.max_repeats)
+        self.violations += problems
+        if problems and self.strict:
+            raise QueryBudgetExceeded("\n".join(problems))
+
+
+def undeclared_routes(app, budgets: Dict[Tuple[str, str], int] = QUERY_BUDGETS) -> List[str]:
+    declared = set()
+    for route in app.routes:
+        for method in getattr(route, "methods", None) or ():
+            if method != "HEAD" and route.path.startswith("/api/"):
+                declared.add((method, route.path))
+    missing = [f"{m} {p}: no query budget declared" for m, p in sorted(declared - set(budgets))]
+    stale = [f"{m} {p}: budget for a route that does not exist" for m, p in sorted(set(budgets) - declared)]
+    return missing + stale
+
+
+# ── Local budget run ──
+# `python query_budget.py` boots the app in-process against MONGO_URL, seeds a throwaway
+# database and walks every route once. Exits 1 on any budget violation.
+FRIENDS = 12
+
+
+async def seed(db, today: str, friends: int = FRIENDS):
+    # qb_0 with `friends` accepted friends, who are also the members of qb_clan.
+    now = datetime.now(timezone.utc)
+    users = [{"user_id": f"qb_{i}", "email": f"qb_{i}@budget.test", "name": "", "picture": "",
+              "display_name": f"Budget {i}", "subjects": ["Matemática"], "level_xp": 100 * i,
+              "total_xp": 100000 if i == 0 else 100 * i, "level": 0, "streak": i,
+              "last_activity_date": "", "onboarding_complete": True, "rival_id": "",
+              "clan_id": "" if i == 0 else "qb_clan", "inventory": [],
+              "display_name_key": normalize_name(f"Budget {i}"),
+              "display_name_trigrams": name_trigrams(normalize_name(f"Budget {i}"))}
+             for i in range(friends + 3)]
+    await db.users.insert_many(users)
+    await db.user_sessions.insert_one({"user_id": "qb_0", "session_token": "qb_token",
+                                       "expires_at": now + timedelta(days=1)})
+    await db.friends.insert_many(
+        [{"request_id": f"qb_fr_{i}", "from_user_id": "qb_0", "to_user_id": f"qb_{i}",
+          "status": "accepted", "created_at": now.isoformat()} for i in range(1, friends + 1)]
+        + [{"request_id": "qb_fr_pending", "from_user_id": f"qb_{friends + 1}", "to_user_id": "qb_0",
+            "status": "pending", "created_at": now.isoformat()}])
+    await db.clans.insert_one({"clan_id": "qb_clan", "name": "Budget Clan", "name_key": "budget clan",
+                               "description": "",
+                               "photo": "", "banner": "", "leader_id": "qb_1", "total_xp": 0,
+                               "members": [f"qb_{i}" for i in range(1, friends + 1)],
+                               "created_at": now.isoformat()})
+    await db.daily_xp.insert_many([{"user_id": f"qb_{i}", "date": today, "xp": 10 * i,
+                                    "display_name": f"Budget {i}", "picture": "", "updated_at": now}
+                                   for i in range(1, friends + 1)])
+    await db.activities.insert_many(
+        [{"activity_id": f"qb_act_{i}", "user_id": "qb_0", "title": f"Estudo {i}",
+          "subject": "Matemática", "description": "", "difficulty": 3, "estimated_time": 30,
+          "actual_time_start": None, "actual_time_end": None, "checklist": [], "image_url": "",
+          "status": "completed" if i < 3 else "pending", "xp_earned": 50 if i < 3 else 0,
+          "date": today, "created_at": (now - timedelta(minutes=i)).isoformat(), "completed_at": None}
+         for i in range(6)])
+
+
+# A 4x4 PNG, enough to drive an inline upload through the media store.
+TINY_PNG = ("data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAQAAAAECAIAAAAmkwkpAAAAEElEQVR4nGP8xYAATAxEcQAy0gECGiP7agAAAABJRU5ErkJggg==")
+
+
+def budget_scenario() -> List[tuple]:
+    onboarding = {"display_name": "Budget Zero", "city": "Recife", "school": "Escola",
+                  "grade": "3", "subjects": ["Matemática"]}
+    activity = {"title": "Revisar geometria", "subject": "Matemática"}
+    return [
+        ("GET", "/api/auth/me", None),
+        ("POST", "/api/onboarding", onboarding),
+        ("GET", "/api/profile", None),
+        ("PUT", "/api/profile", {"bio": "orçamento"}),
+        ("PUT", "/api/profile", {"profile_photo": TINY_PNG}),
+        ("PUT", "/api/profile", {"profile_photo": TINY_PNG}),
+        ("GET", "/api/profile/qb_1", None),
+        ("GET", "/api/subjects", None),
+        ("POST", "/api/subjects", {"name": "Química"}),
+        ("DELETE", "/api/subjects/Química", None),
+        ("POST", "/api/activities", activity),
+        ("GET", "/api/activities", None),
+        ("PUT", "/api/activities/qb_act_3", {"description": "capítulo 2"}),
+        ("POST", "/api/activities/qb_act_3/complete", None),
+        ("DELETE", "/api/activities/qb_act_4", None),
+        ("GET", "/api/dashboard", None),
+        ("GET", "/api/write-behind/stats", None),
+        ("GET", "/api/rankings/global", None),
+        ("GET", "/api/rankings/global/around-me", None),
+        ("GET", "/api/rankings/streak", None),
+        ("GET", "/api/rankings/friends", None),
+        ("GET", "/api/rankings/clans", None),
+        ("GET", "/api/rankings/global?period=week", None),
+        ("GET", "/api/rankings/friends?period=month", None),
+        ("GET", "/api/rankings/clans?period=week", None),
+        ("GET", "/api/rankings/schools?period=month", None),
+        ("GET", "/api/shop", None),
+        ("POST", "/api/shop/buy/frame_basic", None),
+        ("GET", "/api/friends", None),
+        ("POST", "/api/friends/request", {"to_user_id": f"qb_{FRIENDS + 2}"}),
+        ("POST", "/api/friends/respond", {"request_id": "qb_fr_pending", "action": "accept"}),
+        ("POST", "/api/friends/rival/qb_1", None),
+        ("GET", "/api/friends/search?q=Budget", None),
+        ("GET", "/api/friends/search?q=get 1", None),
+        ("GET", "/api/clans", None),
+        ("GET", "/api/clans/qb_clan", None),
+        ("POST", "/api/clans/qb_clan/join", None),
+        ("POST", "/api/clans/qb_clan/leave", None),
+        ("POST", "/api/clans", {"name": "Budget Zero Clan", "photo": TINY_PNG}),
+        ("GET", "/api/missions", None),
+        ("POST", "/api/missions/m1/claim", None),
+        ("GET", "/api/goals", None),
+        ("PUT", "/api/goals", {"xp_goal": 800}),
+        ("GET", "/api/badges", None),
+        ("GET", "/api/cache/stats", None),
+        ("GET", "/api/metrics", None),
+        ("POST", "/api/auth/logout", None),
+        ("POST", "/api/auth/session", {"session_id": "qb_0_login"}),
+    ]
+
+
+async def run_budgets(server) -> List[str]:
+    import httpx
+    await server.client.drop_database(server.db.name)
+    if "OAUTH_SESSION_URL" not in os.environ:
+        import fake_oauth
+        server.oauth_client.transport = httpx.ASGITransport(app=fake_oauth.app)
+    await server.app.router.startup()
+    try:
+        await seed(server.db, server.get_today_str())
+        guard = QueryBudgetGuard(server.app, strict=False)
+        problems = undeclared_routes(server.app)
+        transport = httpx.ASGITransport(app=guard)
+        async with httpx.AsyncClient(transport=transport, base_url="http://budget") as http:
+            for method, path, body in budget_scenario():
+                server.session_cache.invalidate_token("qb_token")
+                r = await http.request(method, path, json=body, cookies={"session_token": "qb_token"})
+                if r.status_code >= 400:
+                    problems.append(f"{method} {path}: HTTP {r.status_code} {r.text[:120]}")
+        for (method, route), count in sorted(guard.observed.items()):
+            print(f"{count:3d}/{guard.budgets.get((method, route), '-'):<3} {method} {route}")
+        unexercised = set(QUERY_BUDGETS) - set(guard.observed)
+        for method, route in sorted(unexercised):
+            print(f"  -/{QUERY_BUDGETS[(method, route)]:<3} {method} {route} (not exercised)")
+        return problems + guard.violations
+    finally:
+        await server.app.router.shutdown()
+
+
+async def main() -> int:
+    os.environ["DB_NAME"] = os.environ.get("QUERY_BUDGET_DB", "query_budget_test")
+    install()
+    import server
+    problems = await run_budgets(server)
+    for p in problems:
+        print(f"FAIL {p}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
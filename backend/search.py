@@ -0,0 +1,40 @@
+import re
+import unicodedata
+from typing import List
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_name(text: str) -> str:
+    # "  João  DA Silva" -> "joao da silva": case-folded, accents stripped, spaces collapsed.
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+    return _SPACES.sub(" ", folded).strip()
+
+
+def name_trigrams(key: str) -> List[str]:
+    return sorted({key[i:i + 3] for i in range(len(key) - 2)})
+
+
+def prefix_pattern(key: str) -> str:
+    # Anchored and escaped, so Mongo turns it into index bounds on the key.
+    return f"^{re.escape(key)}"
+
+
+def match_quality(key: str, query: str) -> int:
+    # 0 exact, 1 prefix, 2 start of a later word, 3 anywhere, 4 no match.
+    if key == query:
+        return 0
+    if key.startswith(query):
+        return 1
+    position = key.find(query)
+    if position < 0:
+        return 4
+    return 2 if key[position - 1] == " " else 3
+
+
+def rank_matches(docs: List[dict], query: str, key_field: str, limit: int) -> List[dict]:
+    scored = [(match_quality(d.get(key_field, ""), query), -d.get("level", 0), d.get(key_field, ""), i)
+              for i, d in enumerate(docs)]
+    ranked = sorted(s for s in scored if s[0] < 4)
+    return [docs[s[3]] for s in ranked[:limit]]
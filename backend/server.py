@@ -1,23 +1,48 @@
-from fastapi import FastAPI, APIRouter, Request, Response, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, Request, Response, HTTPException, Depends, File, UploadFile
 from dotenv import load_dotenv
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, DeleteOne, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
+import json
 import logging
 import re
 import random
-import httpx
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uuid
+import copy
+import bisect
+import numpy as np
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
+from leaderboard import DailyLeaderboard
+from write_behind import OPS_FIELD, WriteBehindCounter
+from migrations import Migration, drop_duplicates, migrate
+from metrics import MetricsMiddleware, MetricsRegistry, MongoCommandListener
+from http_cache import CompressionMiddleware, ConditionalGetMiddleware, body_etag, etag_matches
+from push import PushHub
+from oauth_client import DEFAULT_SESSION_URL, OAuthSessionClient, OAuthUnavailable
+from search import name_trigrams, normalize_name, prefix_pattern, rank_matches
+from clock import DEFAULT_TIMEZONE, Clock, DayKeys, day_keys, is_valid_timezone, week_start
+from media import MEDIA_KINDS, InvalidMedia, MediaStore, RangeNotSatisfiable, decode_data_url, parse_byte_range
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+metrics_registry = MetricsRegistry()
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandListener(metrics_registry)])
 db = client[os.environ['DB_NAME']]
 
 app = FastAPI()
@@ -33,6 +58,7 @@ class OnboardingData(BaseModel):
     school: str
     grade: str
     subjects: List[str]
+    timezone: Optional[str] = None
 
 class ProfileUpdate(BaseModel):
     bio: Optional[str] = None
@@ -44,6 +70,7 @@ class ProfileUpdate(BaseModel):
     frame: Optional[str] = None
     active_badge: Optional[str] = None
     social_links: Optional[Dict[str, str]] = None
+    timezone: Optional[str] = None
 
 class ActivityCreate(BaseModel):
     title: str
@@ -102,27 +129,49 @@ def calculate_xp(duration_minutes: int, difficulty: int, streak_days: int, activ
         xp += 50
     return xp
 
+# Reaching level L costs 100 + 200 + ... + 100*L = 50*L*(L+1) level XP, capped at level 100.
+MAX_LEVEL = 100
+LEVEL_THRESHOLDS = [50 * level * (level + 1) for level in range(MAX_LEVEL + 1)]
+RANK_LEVELS = [25, 50, 75, 100]
+RANK_NAMES = ["Bronze", "Prata", "Ouro", "Rubi", "Platina Lendário"]
+_LEVEL_THRESHOLDS_NP = np.array(LEVEL_THRESHOLDS, dtype=np.int64)
+_RANK_LEVELS_NP = np.array(RANK_LEVELS, dtype=np.int64)
+_RANK_NAMES_NP = np.array(RANK_NAMES, dtype=object)
+
 def get_level_info(total_level_xp: int) -> dict:
-    level = 0
-    xp_remaining = total_level_xp
-    while level < 100 and xp_remaining >= (level + 1) * 100:
-        xp_remaining -= (level + 1) * 100
-        level += 1
-    next_level_xp = (level + 1) * 100 if level < 100 else 0
-    rank = "Bronze"
-    if level >= 100:
-        rank = "Platina Lendário"
-    elif level >= 75:
-        rank = "Rubi"
-    elif level >= 50:
-        rank = "Ouro"
-    elif level >= 25:
-        rank = "Prata"
-    return {"level": level, "current_xp": xp_remaining, "next_level_xp": next_level_xp, "rank": rank}
+    level = max(0, bisect.bisect_right(LEVEL_THRESHOLDS, total_level_xp) - 1)
+    next_level_xp = (level + 1) * 100 if level < MAX_LEVEL else 0
+    rank = RANK_NAMES[bisect.bisect_right(RANK_LEVELS, level)]
+    return {"level": level, "current_xp": total_level_xp - LEVEL_THRESHOLDS[level],
+            "next_level_xp": next_level_xp, "rank": rank}
+
+def get_level_info_batch(total_level_xp) -> Dict[str, np.ndarray]:
+    xp = np.asarray(total_level_xp, dtype=np.int64)
+    level = np.maximum(np.searchsorted(_LEVEL_THRESHOLDS_NP, xp, side="right") - 1, 0)
+    return {
+        "level": level,
+        "current_xp": xp - _LEVEL_THRESHOLDS_NP[level],
+        "next_level_xp": np.where(level < MAX_LEVEL, (level + 1) * 100, 0),
+        "rank": _RANK_NAMES_NP[np.searchsorted(_RANK_LEVELS_NP, level, side="right")],
+    }
+
+async def recompute_user_levels(batch_size: int = 1000) -> int:
+    updated = 0
+    cursor = db.users.find({}, {"_id": 0, "user_id": 1, "level_xp": 1, "level": 1})
+    while True:
+        users = await cursor.to_list(batch_size)
+        if not users:
+            return updated
+        levels = get_level_info_batch([u.get("level_xp", 0) for u in users])["level"]
+        ops = [UpdateOne({"user_id": u["user_id"]}, {"$set": {"level": int(level)}})
+               for u, level in zip(users, levels) if u.get("level") != level]
+        if ops:
+            await db.users.bulk_write(ops, ordered=False)
+            updated += len(ops)
 
 def get_today_str():
-    utc_now = datetime.now(timezone.utc) - timedelta(hours=3)
-    return utc_now.strftime("%Y-%m-%d")
+    # The platform day that leaderboards and XP rollups run on; per-user days come from get_clock.
+    return day_keys(DEFAULT_TIMEZONE, datetime.now(timezone.utc)).today
 
 def validate_title(title: str) -> str:
     if len(title) < 4:
@@ -140,6 +189,266 @@ def validate_url(url: str) -> bool:
     pattern = r'^https?://[^\s/$.?#].[^\s]*$'
     return bool(re.match(pattern, url))
 
+# ── Session Cache ──
+# Bounded LRU of session_token -> user so authenticated routes skip Mongo on a hit.
+# Entries live at most `ttl` seconds (writes from other workers show up after that)
+# and are dropped eagerly whenever this process mutates the user.
+class SessionCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._tokens_by_user: Dict[str, set] = {}
+
+    def get(self, token: str) -> Optional[dict]:
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        cached_until, session_expires_at, user = entry
+        if cached_until < time.monotonic() or session_expires_at < datetime.now(timezone.utc):
+            self._drop(token)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return copy.deepcopy(user)
+
+    def put(self, token: str, session_expires_at: datetime, user: dict, generation: int):
+        # A write that invalidated while we were reading Mongo makes this snapshot stale.
+        if self.max_size <= 0 or generation != self.generation:
+            return
+        self._drop(token)
+        self._entries[token] = (time.monotonic() + self.ttl, session_expires_at, copy.deepcopy(user))
+        self._tokens_by_user.setdefault(user["user_id"], set()).add(token)
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def invalidate_token(self, token: str):
+        self.generation += 1
+        self._drop(token)
+
+    def invalidate_user(self, user_id: str):
+        self.generation += 1
+        for token in list(self._tokens_by_user.get(user_id, ())):
+            self._drop(token)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries), "max_size": self.max_size, "ttl": self.ttl,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+    def _drop(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[2]["user_id"]
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user_id]
+
+session_cache = SessionCache(
+    max_size=int(os.environ.get("SESSION_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("SESSION_CACHE_TTL", "30")),
+)
+
+# ── Response Cache ──
+# Public responses that are identical for every caller. A fresh entry is served as is;
+# for `stale_ttl` seconds past expiry the old value is still served while a single task
+# reloads it; on a miss every concurrent caller awaits the same load (single-flight).
+class ResponseCache:
+    def __init__(self, ttl: float, stale_ttl: float):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.loads = 0
+        self.load_errors = 0
+        self.invalidations = 0
+        self._entries: Dict[str, tuple] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._generations: Dict[str, int] = {}
+
+    async def get(self, key: str, loader):
+        if self.ttl <= 0:
+            return await loader()
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                self.hits += 1
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                if key not in self._inflight:
+                    self._start_load(key, loader).add_done_callback(self._log_refresh_failure)
+                return entry[1]
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._start_load(key, loader)
+        # Shielded so a caller that disconnects does not cancel the load the others await.
+        return await asyncio.shield(task)
+
+    def invalidate(self, *keys: str):
+        self.invalidations += 1
+        for key in keys:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.pop(key, None)
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries), "ttl": self.ttl, "stale_ttl": self.stale_ttl,
+            "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses,
+            "coalesced": self.coalesced, "loads": self.loads, "load_errors": self.load_errors,
+            "invalidations": self.invalidations, "inflight": len(self._inflight),
+            "hit_ratio": round((lookups - self.loads) / lookups, 4) if lookups else 0.0
+        }
+
+    def _start_load(self, key: str, loader) -> asyncio.Task:
+        task = asyncio.create_task(self._load(key, loader, self._generations.get(key, 0)))
+        self._inflight[key] = task
+        return task
+
+    async def _load(self, key: str, loader, generation: int):
+        self.loads += 1
+        try:
+            value = await loader()
+        except Exception:
+            self.load_errors += 1
+            raise
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+        # A write that invalidated the key while we were loading makes this value stale.
+        if generation == self._generations.get(key, 0):
+            self._entries[key] = (time.monotonic(), value)
+        return value
+
+    @staticmethod
+    def _log_refresh_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Response cache refresh failed: {task.exception()!r}")
+
+response_cache = ResponseCache(
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", "5")),
+    stale_ttl=float(os.environ.get("RESPONSE_CACHE_STALE_TTL", "30")),
+)
+RANKING_CACHE_KEYS = ("rankings:global", "rankings:streak")
+CLAN_CACHE_KEYS = ("rankings:clans", "clans")
+
+async def cached_response(request: Request, key: str, loader) -> Response:
+    # Entries hold the rendered body and its ETag, so hits and 304s skip serialization.
+    async def render():
+        body = JSONResponse(jsonable_encoder(await loader())).body
+        return body, body_etag(body)
+    body, etag = await response_cache.get(key, render)
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+# ── Signed Session Tokens ──
+# With SESSION_TOKEN_MODE=signed, /auth/session issues "st1.<payload>.<hmac>" tokens that
+# carry user_id and expiry, so get_current_user can verify them without user_sessions.
+# Logout revokes the token's jti through an in-memory denylist mirrored in revoked_tokens.
+SESSION_TOKEN_MODE = os.environ.get("SESSION_TOKEN_MODE", "opaque")
+SESSION_SECRET = os.environ.get("SESSION_SECRET", "")
+SESSION_LIFETIME = timedelta(days=7)
+SIGNED_TOKEN_PREFIX = "st1"
+DENYLIST_SYNC_INTERVAL = float(os.environ.get("DENYLIST_SYNC_INTERVAL", "30"))
+
+if SESSION_TOKEN_MODE == "signed" and not SESSION_SECRET:
+    raise RuntimeError("SESSION_SECRET must be set when SESSION_TOKEN_MODE=signed")
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _sign(message: str) -> str:
+    return _b64encode(hmac.new(SESSION_SECRET.encode(), message.encode(), hashlib.sha256).digest())
+
+def issue_signed_token(user_id: str, expires_at: datetime) -> str:
+    payload = f"{user_id}|{int(expires_at.timestamp())}|{uuid.uuid4().hex[:16]}"
+    body = f"{SIGNED_TOKEN_PREFIX}.{_b64encode(payload.encode())}"
+    return f"{body}.{_sign(body)}"
+
+def is_signed_token(token: str) -> bool:
+    return token.startswith(SIGNED_TOKEN_PREFIX + ".")
+
+def verify_signed_token(token: str) -> Optional[dict]:
+    if not SESSION_SECRET:
+        return None
+    body, _, signature = token.rpartition(".")
+    if not body or not hmac.compare_digest(_sign(body), signature):
+        return None
+    try:
+        user_id, expires, jti = _b64decode(body.split(".", 1)[1]).decode().split("|")
+        expires_at = datetime.fromtimestamp(int(expires), timezone.utc)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return None
+    return {"user_id": user_id, "expires_at": expires_at, "jti": jti}
+
+class TokenDenylist:
+    def __init__(self):
+        self._revoked: Dict[str, datetime] = {}
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    async def revoke(self, jti: str, expires_at: datetime):
+        self._revoked[jti] = expires_at
+        await db.revoked_tokens.update_one(
+            {"jti": jti}, {"$set": {"jti": jti, "expires_at": expires_at}}, upsert=True)
+
+    async def sync(self):
+        now = datetime.now(timezone.utc)
+        docs = await db.revoked_tokens.find(
+            {"expires_at": {"$gt": now}}, {"_id": 0, "jti": 1, "expires_at": 1}).to_list(None)
+        revoked = {}
+        for d in docs:
+            expires_at = d["expires_at"]
+            if expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=timezone.utc)
+            revoked[d["jti"]] = expires_at
+        # Keep local revocations whose write may not be visible yet; drop expired ones.
+        for jti, expires_at in self._revoked.items():
+            if jti not in revoked and expires_at > now:
+                revoked[jti] = expires_at
+        self._revoked = revoked
+
+token_denylist = TokenDenylist()
+
+async def denylist_sync_loop():
+    while True:
+        await asyncio.sleep(DENYLIST_SYNC_INTERVAL)
+        try:
+            await token_denylist.sync()
+        except Exception:
+            logger.exception("Token denylist sync failed")
+
 # ── Auth Middleware ──
 async def get_current_user(request: Request) -> dict:
     token = None
@@ -151,12 +460,19 @@ async def get_current_user(request: Request) -> dict:
         token = auth_header.split(" ")[1]
     if not token:
         raise HTTPException(status_code=401, detail="Não autenticado")
-    session = await db.user_sessions.find_one({"session_token": token}, {"_id": 0})
-    if not session:
-        raise HTTPException(status_code=401, detail="Sessão inválida")
+    cached = session_cache.get(token)
+    if cached is not None:
+        return cached
+    generation = session_cache.generation
+    if is_signed_token(token):
+        session = verify_signed_token(token)
+        if not session or session["jti"] in token_denylist:
+            raise HTTPException(status_code=401, detail="Sessão inválida")
+    else:
+        session = await db.user_sessions.find_one({"session_token": token}, {"_id": 0})
+        if not session:
+            raise HTTPException(status_code=401, detail="Sessão inválida")
     expires_at = session["expires_at"]
-    if isinstance(expires_at, str):
-        expires_at = datetime.fromisoformat(expires_at)
     if expires_at.tzinfo is None:
         expires_at = expires_at.replace(tzinfo=timezone.utc)
     if expires_at < datetime.now(timezone.utc):
@@ -164,23 +480,48 @@ async def get_current_user(request: Request) -> dict:
     user = await db.users.find_one({"user_id": session["user_id"]}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=401, detail="Usuário não encontrado")
+    session_cache.put(token, expires_at, user, generation)
     return user
 
+async def get_clock(user: dict = Depends(get_current_user)) -> Clock:
+    # Read `now` once per request, in the caller's timezone (DEFAULT_TIMEZONE if unset).
+    return Clock(user.get("timezone"))
+
+# ── Profile Hydration ──
+async def fetch_users_by_id(user_ids, projection: dict) -> Dict[str, dict]:
+    ids = list(dict.fromkeys(user_ids))
+    if not ids:
+        return {}
+    docs = await db.users.find(
+        {"user_id": {"$in": ids}}, {**projection, "_id": 0, "user_id": 1}).to_list(len(ids))
+    return {d["user_id"]: d for d in docs}
+
+async def hydrate_users(user_ids, projection: dict) -> List[dict]:
+    by_id = await fetch_users_by_id(user_ids, projection)
+    return [by_id[uid] for uid in user_ids if uid in by_id]
+
 # ── AUTH ROUTES ──
+# One pooled client per worker for the OAuth session-data endpoint; OAUTH_SESSION_URL
+# points it at a local stand-in (`python fake_oauth.py`) for benchmarks and tests.
+oauth_client = OAuthSessionClient(
+    url=os.environ.get("OAUTH_SESSION_URL", DEFAULT_SESSION_URL),
+    timeout=float(os.environ.get("OAUTH_TIMEOUT", "5")),
+    max_concurrency=int(os.environ.get("OAUTH_MAX_CONCURRENCY", "32")),
+    cache_ttl=float(os.environ.get("OAUTH_SESSION_CACHE_TTL", "60")))
+
 @api_router.post("/auth/session")
 async def exchange_session(request: Request, response: Response):
     body = await request.json()
     session_id = body.get("session_id")
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id obrigatório")
-    async with httpx.AsyncClient() as http_client:
-        resp = await http_client.get(
-            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-            headers={"X-Session-ID": session_id}
-        )
-        if resp.status_code != 200:
-            raise HTTPException(status_code=401, detail="Sessão inválida")
-        data = resp.json()
+    try:
+        data = await oauth_client.session_data(session_id)
+    except OAuthUnavailable as e:
+        logger.warning(f"OAuth session exchange failed: {e}")
+        raise HTTPException(status_code=503, detail="Login indisponível, tente novamente")
+    if data is None:
+        raise HTTPException(status_code=401, detail="Sessão inválida")
     user_id = None
     existing = await db.users.find_one({"email": data["email"]}, {"_id": 0})
     if existing:
@@ -204,13 +545,18 @@ async def exchange_session(request: Request, response: Response):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
         await db.users.insert_one(new_user)
-    session_token = data.get("session_token", f"sess_{uuid.uuid4().hex}")
-    await db.user_sessions.delete_many({"user_id": user_id})
-    await db.user_sessions.insert_one({
-        "user_id": user_id, "session_token": session_token,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
-    })
+    expires_at = datetime.now(timezone.utc) + SESSION_LIFETIME
+    session_cache.invalidate_user(user_id)
+    if SESSION_TOKEN_MODE == "signed":
+        session_token = issue_signed_token(user_id, expires_at)
+    else:
+        session_token = data.get("session_token", f"sess_{uuid.uuid4().hex}")
+        await db.user_sessions.delete_many({"user_id": user_id})
+        await db.user_sessions.insert_one({
+            "user_id": user_id, "session_token": session_token,
+            "expires_at": expires_at,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
     response.set_cookie(key="session_token", value=session_token, httponly=True,
                         secure=True, samesite="none", path="/", max_age=7*24*3600)
     user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
@@ -224,27 +570,42 @@ async def auth_me(user: dict = Depends(get_current_user)):
 async def logout(request: Request, response: Response):
     token = request.cookies.get("session_token")
     if token:
-        await db.user_sessions.delete_many({"session_token": token})
+        if is_signed_token(token):
+            claims = verify_signed_token(token)
+            if claims:
+                await token_denylist.revoke(claims["jti"], claims["expires_at"])
+        else:
+            await db.user_sessions.delete_many({"session_token": token})
+        session_cache.invalidate_token(token)
     response.delete_cookie("session_token", path="/", secure=True, samesite="none")
     return {"message": "Logout realizado"}
 
 # ── ONBOARDING ──
 @api_router.post("/onboarding")
 async def complete_onboarding(data: OnboardingData, user: dict = Depends(get_current_user)):
+    if data.timezone is not None and not is_valid_timezone(data.timezone):
+        raise HTTPException(status_code=400, detail="Fuso horário inválido")
     if len(data.display_name) < 3:
         raise HTTPException(status_code=400, detail="Nome deve ter pelo menos 3 caracteres")
     if len(data.display_name) > 20:
         raise HTTPException(status_code=400, detail="Nome deve ter no máximo 20 caracteres")
-    existing = await db.users.find_one(
-        {"display_name": {"$regex": f"^{re.escape(data.display_name)}$", "$options": "i"},
-         "user_id": {"$ne": user["user_id"]}}, {"_id": 0})
-    if existing:
+    # Uniqueness is case- and accent-insensitive, enforced by the unique display_name_key index.
+    key = normalize_name(data.display_name)
+    if not key:
+        raise HTTPException(status_code=400, detail="Nome de exibição inválido")
+    try:
+        await db.users.update_one({"user_id": user["user_id"]}, {"$set": {
+            "display_name": data.display_name, "city": data.city,
+            "school": data.school, "grade": data.grade,
+            "subjects": data.subjects, "onboarding_complete": True,
+            "school_key": normalize_name(data.school),
+            "display_name_key": key, "display_name_trigrams": name_trigrams(key),
+            **({"timezone": data.timezone} if data.timezone else {})
+        }})
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Nome de exibição já em uso")
-    await db.users.update_one({"user_id": user["user_id"]}, {"$set": {
-        "display_name": data.display_name, "city": data.city,
-        "school": data.school, "grade": data.grade,
-        "subjects": data.subjects, "onboarding_complete": True
-    }})
+    session_cache.invalidate_user(user["user_id"])
+    response_cache.invalidate(*RANKING_CACHE_KEYS)
     updated = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0})
     return updated
 
@@ -263,9 +624,17 @@ async def update_profile(data: ProfileUpdate, user: dict = Depends(get_current_u
             for platform, url in value.items():
                 if url and not validate_url(url):
                     raise HTTPException(status_code=400, detail=f"URL inválida para {platform}")
+        if field == "timezone" and not is_valid_timezone(value):
+            raise HTTPException(status_code=400, detail="Fuso horário inválido")
+        if field in PROFILE_MEDIA_FIELDS:
+            value = await media_field(value, PROFILE_MEDIA_FIELDS[field], user["user_id"])
         update_data[field] = value
     if update_data:
         await db.users.update_one({"user_id": user["user_id"]}, {"$set": update_data})
+        session_cache.invalidate_user(user["user_id"])
+        await media_store.delete_refs(
+            [user.get(f) for f in PROFILE_MEDIA_FIELDS if f in update_data and update_data[f] != user.get(f)],
+            user["user_id"])
     updated = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0})
     updated["level_info"] = get_level_info(updated.get("level_xp", 0))
     return updated
@@ -278,6 +647,67 @@ async def get_user_profile(user_id: str):
     user["level_info"] = get_level_info(user.get("level_xp", 0))
     return user
 
+# ── MEDIA ──
+# Photos and banners are uploaded here and referenced from users/clans by URL
+# ("/api/media/<id>", "/thumb" appended for the fixed-size thumbnail), so the auth
+# path, the session cache and the listings never carry image bytes.
+media_store = MediaStore(db, url_prefix=os.environ.get("MEDIA_URL_PREFIX", "/api/media"),
+                         max_bytes=int(os.environ.get("MEDIA_MAX_BYTES", str(5 * 1024 * 1024))),
+                         max_pixels=int(os.environ.get("MEDIA_MAX_PIXELS", "40000000")))
+MEDIA_REF_MAX_LENGTH = 2048
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+PROFILE_MEDIA_FIELDS = {"profile_photo": "avatar", "banner": "banner"}
+CLAN_MEDIA_FIELDS = {"photo": "avatar", "banner": "banner"}
+
+async def media_field(value: str, kind: str, owner: str) -> str:
+    # Older clients send inline data URLs; those are stored and replaced by a reference.
+    if value.startswith("data:"):
+        try:
+            return media_store.ref(await media_store.save(decode_data_url(value), kind, owner))
+        except InvalidMedia as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if len(value) > MEDIA_REF_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail="Envie a imagem por /api/media")
+    return value
+
+@api_router.post("/media")
+async def upload_media(file: UploadFile = File(...), kind: str = "avatar",
+                       user: dict = Depends(get_current_user)):
+    if kind not in MEDIA_KINDS:
+        raise HTTPException(status_code=400, detail="Tipo de imagem inválido")
+    data = await file.read(media_store.max_bytes + 1)
+    try:
+        media_id = await media_store.save(data, kind, user["user_id"])
+    except InvalidMedia as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    url = media_store.ref(media_id)
+    return {"media_id": media_id, "url": url, "thumbnail_url": f"{url}/thumb"}
+
+@api_router.get("/media/{media_id}")
+@api_router.get("/media/{media_id}/{variant}")
+async def get_media(media_id: str, request: Request, variant: str = "full"):
+    grid_out = await media_store.open(media_id, variant)
+    if grid_out is None:
+        raise HTTPException(status_code=404, detail="Imagem não encontrada")
+    # Media is immutable (a new upload gets a new id), so the id is a strong validator.
+    etag = f'"{media_id}-{variant}"'
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    length = grid_out.length
+    byte_range = None
+    if request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = parse_byte_range(request.headers.get("range"), length)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{length}"})
+    start, end = byte_range or (0, length - 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(media_store.stream(grid_out, start, end), status_code=206 if byte_range else 200,
+                             media_type=grid_out.metadata["content_type"], headers=headers)
+
 # ── SUBJECTS ──
 @api_router.get("/subjects")
 async def get_subjects(user: dict = Depends(get_current_user)):
@@ -289,34 +719,38 @@ async def add_subject(request: Request, user: dict = Depends(get_current_user)):
     name = body.get("name", "").strip()
     if not name or len(name) < 2:
         raise HTTPException(status_code=400, detail="Nome da matéria inválido")
-    subjects = user.get("subjects", [])
-    if name in subjects:
+    # Atomic on the stored list: the session snapshot may predate another worker's change.
+    updated = await db.users.find_one_and_update(
+        {"user_id": user["user_id"], "subjects": {"$ne": name}}, {"$addToSet": {"subjects": name}},
+        projection={"_id": 0, "subjects": 1}, return_document=ReturnDocument.AFTER)
+    if updated is None:
         raise HTTPException(status_code=400, detail="Matéria já existe")
-    subjects.append(name)
-    await db.users.update_one({"user_id": user["user_id"]}, {"$set": {"subjects": subjects}})
-    return {"subjects": subjects}
+    session_cache.invalidate_user(user["user_id"])
+    return {"subjects": updated.get("subjects", [])}
 
 @api_router.delete("/subjects/{name}")
 async def remove_subject(name: str, user: dict = Depends(get_current_user)):
-    subjects = user.get("subjects", [])
-    subjects = [s for s in subjects if s != name]
-    await db.users.update_one({"user_id": user["user_id"]}, {"$set": {"subjects": subjects}})
-    return {"subjects": subjects}
+    updated = await db.users.find_one_and_update(
+        {"user_id": user["user_id"]}, {"$pull": {"subjects": name}},
+        projection={"_id": 0, "subjects": 1}, return_document=ReturnDocument.AFTER)
+    session_cache.invalidate_user(user["user_id"])
+    return {"subjects": (updated or {}).get("subjects", [])}
 
 # ── ACTIVITIES ──
 @api_router.post("/activities")
-async def create_activity(data: ActivityCreate, user: dict = Depends(get_current_user)):
+async def create_activity(data: ActivityCreate, user: dict = Depends(get_current_user),
+                          clock: Clock = Depends(get_clock)):
     error = validate_title(data.title)
     if error:
         raise HTTPException(status_code=400, detail=error)
-    today = get_today_str()
+    today = clock.today
     existing = await db.activities.find_one(
         {"user_id": user["user_id"], "title": data.title, "date": today}, {"_id": 0})
     if existing:
         raise HTTPException(status_code=400, detail="Já existe uma atividade com este título hoje")
     week_count = await db.activities.count_documents(
         {"user_id": user["user_id"], "title": data.title,
-         "created_at": {"$gte": (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()}})
+         "created_at": {"$gte": (clock.now - timedelta(days=7)).isoformat()}})
     if week_count >= 5:
         raise HTTPException(status_code=400, detail="Muitas atividades com o mesmo título esta semana")
     activity = {
@@ -326,15 +760,43 @@ async def create_activity(data: ActivityCreate, user: dict = Depends(get_current
         "actual_time_start": None, "actual_time_end": None,
         "checklist": data.checklist or [], "image_url": "",
         "status": "pending", "xp_earned": 0, "date": today,
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": clock.iso(),
         "completed_at": None
     }
     await db.activities.insert_one(activity)
     return {k: v for k, v in activity.items() if k != "_id"}
 
+# Activities are listed newest first by (created_at, activity_id). A page's X-Next-Cursor
+# header is the opaque key of its last row; passing it back continues strictly after that
+# key, so deep pages cost the same index seek as the first one.
+ACTIVITY_PAGE_SIZE = 200
+ACTIVITY_SORT = [("created_at", -1), ("activity_id", -1)]
+
+def encode_activity_cursor(activity: dict) -> str:
+    return _b64encode(json.dumps([activity["created_at"], activity["activity_id"]]).encode())
+
+def decode_activity_cursor(cursor: str) -> dict:
+    try:
+        key = json.loads(_b64decode(cursor))
+    except (ValueError, TypeError, binascii.Error):
+        key = None
+    # Only the [created_at, activity_id] strings encode_activity_cursor writes; anything
+    # else (an operator dict, a dict whose keys would unpack) never reaches the query.
+    if not (isinstance(key, list) and len(key) == 2 and all(isinstance(v, str) for v in key)):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+    created_at, activity_id = key
+    return {"$or": [{"created_at": {"$lt": created_at}},
+                    {"created_at": created_at, "activity_id": {"$lt": activity_id}}]}
+
+async def stream_ndjson(cursor):
+    async for doc in cursor:
+        yield json.dumps(doc, ensure_ascii=False, default=str) + "\n"
+
 @api_router.get("/activities")
-async def list_activities(status: Optional[str] = None, subject: Optional[str] = None,
-                          date: Optional[str] = None, user: dict = Depends(get_current_user)):
+async def list_activities(response: Response, status: Optional[str] = None,
+                          subject: Optional[str] = None, date: Optional[str] = None,
+                          cursor: Optional[str] = None, limit: Optional[int] = None,
+                          stream: bool = False, user: dict = Depends(get_current_user)):
     query = {"user_id": user["user_id"]}
     if status:
         query["status"] = status
@@ -342,7 +804,19 @@ async def list_activities(status: Optional[str] = None, subject: Optional[str] =
         query["subject"] = subject
     if date:
         query["date"] = date
-    activities = await db.activities.find(query, {"_id": 0}).sort("created_at", -1).to_list(200)
+    if cursor:
+        query.update(decode_activity_cursor(cursor))
+    if stream:
+        activities = db.activities.find(query, {"_id": 0}).sort(ACTIVITY_SORT).batch_size(100)
+        if limit:
+            activities = activities.limit(max(1, limit))
+        return StreamingResponse(stream_ndjson(activities), media_type="application/x-ndjson")
+    limit = max(1, min(limit or ACTIVITY_PAGE_SIZE, ACTIVITY_PAGE_SIZE))
+    activities = await db.activities.find(query, {"_id": 0}).sort(ACTIVITY_SORT).limit(
+        limit + 1).to_list(limit + 1)
+    if len(activities) > limit:
+        activities = activities[:limit]
+        response.headers["X-Next-Cursor"] = encode_activity_cursor(activities[-1])
     return activities
 
 @api_router.put("/activities/{activity_id}")
@@ -367,9 +841,17 @@ async def update_activity(activity_id: str, data: ActivityUpdate,
     return updated
 
 @api_router.post("/activities/{activity_id}/complete")
-async def complete_activity(activity_id: str, user: dict = Depends(get_current_user)):
-    activity = await db.activities.find_one(
-        {"activity_id": activity_id, "user_id": user["user_id"]}, {"_id": 0})
+async def complete_activity(activity_id: str, user: dict = Depends(get_current_user),
+                            clock: Clock = Depends(get_clock)):
+    today = clock.today
+    activity, activities_today, all_today_pending, _ = await asyncio.gather(
+        db.activities.find_one({"activity_id": activity_id, "user_id": user["user_id"]}, {"_id": 0}),
+        db.activities.count_documents(
+            {"user_id": user["user_id"], "date": today, "status": "completed"}),
+        db.activities.count_documents(
+            {"user_id": user["user_id"], "date": today, "status": "pending"}),
+        ensure_user_stats(user),
+    )
     if not activity:
         raise HTTPException(status_code=404, detail="Atividade não encontrada")
     if activity["status"] == "completed":
@@ -383,57 +865,69 @@ async def complete_activity(activity_id: str, user: dict = Depends(get_current_u
             if diff > 480:
                 await db.fraud_logs.insert_one({
                     "user_id": user["user_id"], "activity_id": activity_id,
-                    "reason": "duration_exceeded", "timestamp": datetime.now(timezone.utc).isoformat()
+                    "reason": "duration_exceeded", "timestamp": clock.iso()
                 })
                 raise HTTPException(status_code=400, detail="Tempo registrado excede o limite")
             if diff > 0:
                 duration = int(diff)
         except (ValueError, TypeError):
             pass
-    today = get_today_str()
-    activities_today = await db.activities.count_documents(
-        {"user_id": user["user_id"], "date": today, "status": "completed"})
     streak = user.get("streak", 0)
     last_date = user.get("last_activity_date", "")
-    yesterday = (datetime.now(timezone.utc) - timedelta(hours=3) - timedelta(days=1)).strftime("%Y-%m-%d")
     if last_date == today:
         pass
-    elif last_date == yesterday:
+    elif last_date == clock.yesterday:
         streak += 1
     else:
         streak = 1
     xp = calculate_xp(duration, activity.get("difficulty", 3), streak, activities_today)
-    all_today_pending = await db.activities.count_documents(
-        {"user_id": user["user_id"], "date": today, "status": "pending"})
     if all_today_pending <= 1:
         xp += 75
-    now = datetime.now(timezone.utc).isoformat()
-    await db.activities.update_one({"activity_id": activity_id}, {"$set": {
-        "status": "completed", "xp_earned": xp, "completed_at": now
-    }})
-    new_level_xp = user.get("level_xp", 0) + xp
-    new_total_xp = user.get("total_xp", 0) + xp
-    old_level = get_level_info(user.get("level_xp", 0))["level"]
-    new_level_info = get_level_info(new_level_xp)
-    leveled_up = new_level_info["level"] > old_level
-    await db.users.update_one({"user_id": user["user_id"]}, {"$set": {
-        "level_xp": new_level_xp, "total_xp": new_total_xp,
-        "level": new_level_info["level"], "streak": streak,
-        "last_activity_date": today
-    }})
-    await db.daily_xp.update_one(
-        {"user_id": user["user_id"], "date": today},
-        {"$inc": {"xp": xp}, "$set": {"display_name": user.get("display_name", ""),
-                                        "picture": user.get("picture", "")}},
-        upsert=True
-    )
+    # The pending -> completed transition is the gate: of several concurrent requests
+    # for the same activity only one matches, and only that one awards XP.
+    claimed = await db.activities.find_one_and_update(
+        {"activity_id": activity_id, "user_id": user["user_id"], "status": "pending"},
+        {"$set": {"status": "completed", "xp_earned": xp,
+                  "completed_at": clock.iso()}},
+        projection={"_id": 0, "activity_id": 1})
+    if not claimed:
+        raise HTTPException(status_code=400, detail="Atividade já concluída")
+    writes = [
+        db.users.find_one_and_update({"user_id": user["user_id"]}, {
+            "$inc": {"level_xp": xp, "total_xp": xp,
+                     "stats.completed_activities": 1, "stats.total_minutes": duration},
+            "$set": {"streak": streak, "last_activity_date": today},
+            "$max": {"stats.max_streak": streak}
+        }, projection={**BADGE_USER_PROJECTION, "level_xp": 1, "total_xp": 1},
+            return_document=ReturnDocument.AFTER),
+        award_daily_xp(user, clock.board_day, xp),
+        record_weekly_progress(user["user_id"], clock.week, xp=xp,
+                               minutes=activity.get("estimated_time") or 0, activities=1),
+        record_mission_progress(user, today, activity_id, activity.get("estimated_time") or 0),
+    ]
     if user.get("clan_id"):
-        await db.clans.update_one({"clan_id": user["clan_id"]}, {"$inc": {"total_xp": xp}})
-    await check_badges(user["user_id"])
+        writes.append(clan_xp_counter.increment({"clan_id": user["clan_id"]}, {"total_xp": xp}))
+        push_hub.notify_clan_xp(user["clan_id"], xp)
+    updated_user, _, weekly, *_ = await asyncio.gather(*writes)
+    new_level_info = get_level_info(updated_user.get("level_xp", 0))
+    leveled_up = new_level_info["level"] > get_level_info(updated_user.get("level_xp", 0) - xp)["level"]
+    if new_level_info["level"] > updated_user.get("level", 0):
+        # $max keeps the highest level when concurrent completions finish out of order.
+        await db.users.update_one({"user_id": user["user_id"]},
+                                   {"$max": {"level": new_level_info["level"]}})
+        updated_user["level"] = new_level_info["level"]
+    session_cache.invalidate_user(user["user_id"])
+    response_cache.invalidate("rankings:streak")  # award_daily_xp invalidated rankings:global
+    changed = {"completed_activities", "total_minutes", "weekly_goals"}
+    if streak != user.get("streak", 0):
+        changed.add("max_streak")
+    if leveled_up:
+        changed.add("level")
+    await award_badges(updated_user, weekly, changed)
     return {
         "xp_earned": xp, "leveled_up": leveled_up,
         "new_level": new_level_info["level"], "level_info": new_level_info,
-        "streak": streak, "total_xp": new_total_xp
+        "streak": streak, "total_xp": updated_user.get("total_xp", 0)
     }
 
 @api_router.delete("/activities/{activity_id}")
@@ -446,60 +940,283 @@ async def delete_activity(activity_id: str, user: dict = Depends(get_current_use
 
 # ── DASHBOARD ──
 @api_router.get("/dashboard")
-async def get_dashboard(user: dict = Depends(get_current_user)):
-    today = get_today_str()
-    today_xp_doc = await db.daily_xp.find_one(
-        {"user_id": user["user_id"], "date": today}, {"_id": 0})
-    today_xp = today_xp_doc["xp"] if today_xp_doc else 0
-    pending = await db.activities.find(
-        {"user_id": user["user_id"], "status": "pending"}, {"_id": 0}).to_list(20)
-    today_activities = await db.activities.count_documents(
-        {"user_id": user["user_id"], "date": today, "status": "completed"})
+async def get_dashboard(user: dict = Depends(get_current_user), clock: Clock = Depends(get_clock)):
+    # daily_xp and the board are keyed by platform day; activities by the user's own day.
+    chart_days = clock.board.last_7
+    (chart_docs, pending, today_activities, board,
+     subject_stats, missions, goals) = await asyncio.gather(
+        db.daily_xp.find({"user_id": user["user_id"], "date": {"$gte": chart_days[0], "$lte": chart_days[-1]}},
+                         {"_id": 0, "date": 1, "xp": 1}).to_list(7),
+        db.activities.find(
+            {"user_id": user["user_id"], "status": "pending"}, {"_id": 0}).to_list(20),
+        db.activities.count_documents(
+            {"user_id": user["user_id"], "date": clock.today, "status": "completed"}),
+        get_leaderboard(),
+        db.activities.aggregate([
+            {"$match": {"user_id": user["user_id"], "status": "completed"}},
+            {"$group": {"_id": "$subject", "count": {"$sum": 1}, "total_xp": {"$sum": "$xp_earned"}}}
+        ]).to_list(50),
+        get_daily_missions(user, clock.today),
+        get_weekly_goals_data(user, clock.week),
+    )
+    xp_by_date = {d["date"]: d["xp"] for d in chart_docs}
+    last_7 = [{"date": d, "xp": xp_by_date.get(d, 0)} for d in chart_days]
+    today_xp = xp_by_date.get(clock.board_day, 0)
     level_info = get_level_info(user.get("level_xp", 0))
-    global_rank_cursor = db.daily_xp.find({"date": today}, {"_id": 0}).sort("xp", -1).limit(10)
-    global_rank = await global_rank_cursor.to_list(10)
-    user_rank_pos = 0
-    all_today = await db.daily_xp.find({"date": today}, {"_id": 0}).sort("xp", -1).to_list(1000)
-    for i, r in enumerate(all_today):
-        if r["user_id"] == user["user_id"]:
-            user_rank_pos = i + 1
-            break
-    last_7 = []
-    for i in range(6, -1, -1):
-        d = (datetime.now(timezone.utc) - timedelta(hours=3) - timedelta(days=i)).strftime("%Y-%m-%d")
-        doc = await db.daily_xp.find_one({"user_id": user["user_id"], "date": d}, {"_id": 0})
-        last_7.append({"date": d, "xp": doc["xp"] if doc else 0})
-    subject_stats = await db.activities.aggregate([
-        {"$match": {"user_id": user["user_id"], "status": "completed"}},
-        {"$group": {"_id": "$subject", "count": {"$sum": 1}, "total_xp": {"$sum": "$xp_earned"}}}
-    ]).to_list(50)
-    missions = await generate_daily_missions(user)
-    goals = await get_weekly_goals_data(user)
     return {
         "today_xp": today_xp, "level_info": level_info,
         "total_xp": user.get("total_xp", 0), "level_xp": user.get("level_xp", 0),
-        "streak": user.get("streak", 0), "global_rank": user_rank_pos,
-        "global_top": global_rank, "pending_activities": pending,
+        "streak": user.get("streak", 0), "global_rank": board.rank(user["user_id"]),
+        "global_top": board.top(10), "pending_activities": pending,
         "today_activities_count": today_activities,
         "productivity_chart": last_7, "subject_stats": subject_stats,
         "missions": missions, "weekly_goals": goals
     }
 
+# ── LEADERBOARD ──
+# Each worker mirrors today's daily_xp in an order-statistics structure. Its own
+# writes are applied immediately; other workers' writes arrive through a delta sync
+# on daily_xp.updated_at, and the board is rebuilt when the platform day rolls over
+# (by the rollover job, or by the first read of a new day if that has not run yet).
+LEADERBOARD_SYNC_INTERVAL = float(os.environ.get("LEADERBOARD_SYNC_INTERVAL", "5"))
+LEADERBOARD_SYNC_OVERLAP = timedelta(seconds=10)
+daily_leaderboard = DailyLeaderboard()
+leaderboard_lock = asyncio.Lock()
+
+async def rebuild_leaderboard(today: str):
+    started = datetime.now(timezone.utc)
+    docs = await db.daily_xp.find({"date": today}, {"_id": 0}).to_list(None)
+    daily_leaderboard.reset(today, docs, synced_at=started)
+    push_hub.notify_leaderboard()
+    logger.info(f"Leaderboard rebuilt for {today} with {len(daily_leaderboard)} entries")
+
+async def get_leaderboard() -> DailyLeaderboard:
+    today = get_today_str()
+    if daily_leaderboard.date != today:
+        async with leaderboard_lock:
+            if daily_leaderboard.date != today:
+                await rebuild_leaderboard(today)
+    return daily_leaderboard
+
+async def sync_leaderboard():
+    board = await get_leaderboard()
+    started = datetime.now(timezone.utc)
+    docs = await db.daily_xp.find(
+        {"date": board.date, "updated_at": {"$gte": board.synced_at - LEADERBOARD_SYNC_OVERLAP}},
+        {"_id": 0}).to_list(None)
+    for d in docs:
+        board.update(d)
+    board.synced_at = started
+    if docs:
+        push_hub.notify_leaderboard()
+
+async def leaderboard_sync_loop():
+    while True:
+        await asyncio.sleep(LEADERBOARD_SYNC_INTERVAL)
+        try:
+            await sync_leaderboard()
+        except Exception:
+            logger.exception("Leaderboard sync failed")
+
+# ── WRITE-BEHIND COUNTERS ──
+# Hot $inc targets can be buffered and flushed in bulk. A counter whose interval is 0
+# writes through synchronously; clan totals are buffered by default because every
+# member's completion lands on the same clan document.
+daily_xp_counter = WriteBehindCounter(
+    "daily_xp", db.daily_xp, float(os.environ.get("WRITE_BEHIND_DAILY_XP_SECONDS", "0")),
+    max_keys=int(os.environ.get("WRITE_BEHIND_MAX_KEYS", "500")), upsert=True)
+clan_xp_counter = WriteBehindCounter(
+    "clan_xp", db.clans, float(os.environ.get("WRITE_BEHIND_CLAN_XP_SECONDS", "1")),
+    max_keys=int(os.environ.get("WRITE_BEHIND_MAX_KEYS", "500")),
+    on_write=lambda: response_cache.invalidate(*CLAN_CACHE_KEYS))
+CLAN_PROJECTION = {"_id": 0, OPS_FIELD: 0}
+
+# ── XP ROLLUPS ──
+# Running XP totals per (user, clan or school) and week or month, kept next to daily_xp:
+# weekly_xp/monthly_xp, clan_weekly_xp/clan_monthly_xp and school_weekly_xp/
+# school_monthly_xp. Every award increments them through buffered counters, and each
+# collection has a (period, xp) index, so a period's top-N is one indexed sorted find.
+ROLLUP_SCOPES = {"user": "user_id", "clan": "clan_id", "school": "school_key"}
+ROLLUP_PERIODS = {"week": "weekly", "month": "monthly"}
+rollup_counters = {
+    (scope, period): WriteBehindCounter(
+        name, db[name], float(os.environ.get("WRITE_BEHIND_ROLLUP_SECONDS", "2")),
+        max_keys=int(os.environ.get("WRITE_BEHIND_MAX_KEYS", "500")), upsert=True)
+    for scope in ROLLUP_SCOPES for period, prefix in ROLLUP_PERIODS.items()
+    for name in [f"{'' if scope == 'user' else scope + '_'}{prefix}_xp"]
+}
+WRITE_BEHIND_COUNTERS = [daily_xp_counter, clan_xp_counter, *rollup_counters.values()]
+
+def get_period_key(period: str, day: str) -> str:
+    if period == "week":
+        return week_start(day)
+    if period == "month":
+        return day[:7]
+    return day
+
+def rollup_collection(scope: str, period: str):
+    # daily_xp doubles as the per-user "day" rollup, keyed by date.
+    if period == "day":
+        return db.daily_xp
+    return rollup_counters[(scope, period)].collection
+
+def rollup_period_field(period: str) -> str:
+    return "date" if period == "day" else period
+
+async def award_rollup_xp(user: dict, day: str, xp: int):
+    subjects = [("user", user["user_id"], None)]
+    if user.get("clan_id"):
+        subjects.append(("clan", user["clan_id"], None))
+    school_key = normalize_name(user.get("school", ""))
+    if school_key:
+        subjects.append(("school", school_key, {"school": user["school"].strip()}))
+    await asyncio.gather(*(
+        rollup_counters[(scope, period)].increment(
+            {ROLLUP_SCOPES[scope]: subject, period: get_period_key(period, day)}, {"xp": xp}, fields)
+        for scope, subject, fields in subjects for period in ROLLUP_PERIODS))
+
+async def backfill_xp_rollups(since: Optional[str] = None):
+    # Recomputes rollups from daily_xp (from `since` on, else all history); totals are
+    # replaced, not added to. Clan and school totals follow each user's current
+    # membership, since daily_xp does not record past clans or schools.
+    for period in ROLLUP_PERIODS:
+        period_expr = {"$substrCP": ["$date", 0, 7]} if period == "month" else {
+            "$dateToString": {"format": "%Y-%m-%d", "date": {
+                "$dateTrunc": {"date": {"$dateFromString": {"dateString": "$date"}},
+                               "unit": "week", "startOfWeek": "monday"}}}}
+        match = {"date": {"$gte": get_period_key(period, since)}} if since else {}
+        await db.daily_xp.aggregate([
+            {"$match": match},
+            {"$group": {"_id": {"user_id": "$user_id", "period": period_expr}, "xp": {"$sum": "$xp"}}},
+            {"$project": {"_id": 0, "user_id": "$_id.user_id", period: "$_id.period", "xp": 1}},
+            {"$merge": {"into": rollup_collection("user", period).name, "on": ["user_id", period],
+                        "whenMatched": [{"$set": {"xp": "$$new.xp"}}], "whenNotMatched": "insert"}},
+        ], allowDiskUse=True).to_list(None)
+        user_match = {period: {"$gte": get_period_key(period, since)}} if since else {}
+        for scope in ("clan", "school"):
+            key_field = ROLLUP_SCOPES[scope]
+            await rollup_collection("user", period).aggregate([
+                {"$match": user_match},
+                {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "user_id", "as": "u",
+                             "pipeline": [{"$project": {"_id": 0, key_field: 1, "school": 1}}]}},
+                {"$unwind": "$u"},
+                {"$match": {f"u.{key_field}": {"$gt": ""}}},
+                {"$group": {"_id": {"subject": f"$u.{key_field}", "period": f"${period}"},
+                            "xp": {"$sum": "$xp"},
+                            **({"school": {"$first": "$u.school"}} if scope == "school" else {})}},
+                {"$project": {"_id": 0, key_field: "$_id.subject", period: "$_id.period", "xp": 1,
+                              **({"school": 1} if scope == "school" else {})}},
+                {"$merge": {"into": rollup_collection(scope, period).name, "on": [key_field, period],
+                            "whenMatched": [{"$set": {"xp": "$$new.xp"}}], "whenNotMatched": "insert"}},
+            ], allowDiskUse=True).to_list(None)
+
+async def award_daily_xp(user: dict, today: str, xp: int):
+    await award_rollup_xp(user, today, xp)
+    profile = {"display_name": user.get("display_name", ""), "picture": user.get("picture", "")}
+    doc = await daily_xp_counter.increment({"user_id": user["user_id"], "date": today}, {"xp": xp}, profile)
+    response_cache.invalidate("rankings:global")
+    board = await get_leaderboard()
+    if doc:
+        board.update(doc)
+    else:
+        board.increment(user["user_id"], today, xp, profile)
+    push_hub.notify_leaderboard()
+
+# ── PUSH ──
+# GET /api/stream is a Server-Sent Events feed of top-N deltas, the caller's rank, their
+# rival and their clan's total, replacing polling of rankings and dashboard. Updates are
+# coalesced to at most one per topic every PUSH_INTERVAL seconds per subscriber.
+async def load_clan_totals(clan_ids: List[str]) -> Dict[str, int]:
+    docs = await db.clans.find({"clan_id": {"$in": clan_ids}},
+                               {"_id": 0, "clan_id": 1, "total_xp": 1}).to_list(len(clan_ids))
+    return {d["clan_id"]: d.get("total_xp", 0) for d in docs}
+
+push_hub = PushHub(
+    get_leaderboard, load_clan_totals,
+    interval=float(os.environ.get("PUSH_INTERVAL", "1")),
+    clan_refresh=float(os.environ.get("PUSH_CLAN_REFRESH", "5")),
+    max_subscribers=int(os.environ.get("PUSH_MAX_SUBSCRIBERS", "50000")),
+    chunk_size=int(os.environ.get("PUSH_CHUNK_SIZE", "500")))
+
+@api_router.get("/stream")
+async def push_stream(user: dict = Depends(get_current_user)):
+    if push_hub.full:
+        raise HTTPException(status_code=503, detail="Muitas conexões, tente novamente")
+    return StreamingResponse(push_hub.stream(user), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@api_router.get("/write-behind/stats")
+async def write_behind_stats():
+    return {c.name: c.metrics() for c in WRITE_BEHIND_COUNTERS}
+
 # ── RANKINGS ──
-@api_router.get("/rankings/global")
-async def global_ranking():
+# Boards take ?period= (day, week or month; clans also "all") and an optional ?date= that
+# selects the period containing it, up to RANKING_HISTORY_DAYS back. Today's daily board
+# comes from the in-memory leaderboard; every other board is read from its rollup.
+RANKING_HISTORY_DAYS = int(os.environ.get("RANKING_HISTORY_DAYS", "370"))
+
+def resolve_period(period: str, date: Optional[str], allowed: tuple) -> str:
+    if period not in allowed:
+        raise HTTPException(status_code=400, detail="Período inválido")
     today = get_today_str()
-    ranking = await db.daily_xp.find({"date": today}, {"_id": 0}).sort("xp", -1).to_list(50)
-    result = []
-    for i, r in enumerate(ranking):
-        user = await db.users.find_one({"user_id": r["user_id"]},
-            {"_id": 0, "user_id": 1, "display_name": 1, "picture": 1, "level": 1, "frame": 1})
-        if user:
-            result.append({**r, **user, "position": i + 1})
-    return result
+    day = date or today
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Data inválida")
+    oldest = (datetime.strptime(today, "%Y-%m-%d") - timedelta(days=RANKING_HISTORY_DAYS)).strftime("%Y-%m-%d")
+    if not oldest <= day <= today:
+        raise HTTPException(status_code=400, detail="Data fora do intervalo")
+    return get_period_key(period, day)
+
+async def load_period_ranking(scope: str, period: str, key: str, subjects: Optional[list] = None) -> List[dict]:
+    key_field, period_field = ROLLUP_SCOPES[scope], rollup_period_field(period)
+    query = {period_field: key}
+    if subjects is not None:
+        query[key_field] = {"$in": subjects}
+    rows = await rollup_collection(scope, period).find(
+        query, {"_id": 0, "updated_at": 0, OPS_FIELD: 0}).sort("xp", -1).to_list(50)
+    if scope == "user":
+        details = await fetch_users_by_id([r["user_id"] for r in rows],
+            {"display_name": 1, "picture": 1, "level": 1, "frame": 1})
+    elif scope == "clan":
+        clans = await db.clans.find({"clan_id": {"$in": [r["clan_id"] for r in rows]}},
+                                    {"_id": 0, "clan_id": 1, "name": 1, "photo": 1}).to_list(len(rows))
+        details = {c["clan_id"]: c for c in clans}
+    else:
+        details = {r[key_field]: {} for r in rows}
+    rows = [{**r, **details[r[key_field]]} for r in rows if r[key_field] in details]
+    for i, r in enumerate(rows):
+        r["position"] = i + 1
+    return rows
+
+@api_router.get("/rankings/global")
+async def global_ranking(request: Request, period: str = "day", date: Optional[str] = None):
+    key = resolve_period(period, date, ("day", "week", "month"))
+    if period == "day" and key == get_today_str():
+        return await cached_response(request, "rankings:global", load_global_ranking)
+    return await cached_response(request, f"rankings:global:{period}:{key}",
+                                 lambda: load_period_ranking("user", period, key))
+
+async def load_global_ranking():
+    ranking = (await get_leaderboard()).top(50)
+    users = await fetch_users_by_id([r["user_id"] for r in ranking],
+        {"display_name": 1, "picture": 1, "level": 1, "frame": 1})
+    return [{**r, **users[r["user_id"]], "position": i + 1}
+            for i, r in enumerate(ranking) if r["user_id"] in users]
+
+@api_router.get("/rankings/global/around-me")
+async def global_ranking_around_me(radius: int = 5, user: dict = Depends(get_current_user)):
+    board = await get_leaderboard()
+    radius = max(0, min(radius, 25))
+    return {"position": board.rank(user["user_id"]),
+            "ranking": board.around(user["user_id"], radius)}
 
 @api_router.get("/rankings/streak")
-async def streak_ranking():
+async def streak_ranking(request: Request):
+    return await cached_response(request, "rankings:streak", load_streak_ranking)
+
+async def load_streak_ranking():
     users = await db.users.find(
         {"onboarding_complete": True},
         {"_id": 0, "user_id": 1, "display_name": 1, "picture": 1, "streak": 1, "level": 1}
@@ -509,7 +1226,9 @@ async def streak_ranking():
     return users
 
 @api_router.get("/rankings/friends")
-async def friends_ranking(user: dict = Depends(get_current_user)):
+async def friends_ranking(period: str = "day", date: Optional[str] = None,
+                          user: dict = Depends(get_current_user)):
+    key = resolve_period(period, date, ("day", "week", "month"))
     friends = await db.friends.find(
         {"$or": [{"from_user_id": user["user_id"]}, {"to_user_id": user["user_id"]}],
          "status": "accepted"}, {"_id": 0}).to_list(200)
@@ -519,25 +1238,34 @@ async def friends_ranking(user: dict = Depends(get_current_user)):
         friend_ids.add(f["to_user_id"])
     friend_ids.discard(user["user_id"])
     friend_ids.add(user["user_id"])
-    today = get_today_str()
-    ranking = await db.daily_xp.find(
-        {"date": today, "user_id": {"$in": list(friend_ids)}}, {"_id": 0}
-    ).sort("xp", -1).to_list(50)
-    result = []
-    for i, r in enumerate(ranking):
-        u = await db.users.find_one({"user_id": r["user_id"]},
-            {"_id": 0, "user_id": 1, "display_name": 1, "picture": 1, "level": 1})
-        if u:
-            result.append({**r, **u, "position": i + 1})
-    return result
+    if period != "day" or key != get_today_str():
+        return await load_period_ranking("user", period, key, list(friend_ids))
+    ranking = (await get_leaderboard()).select(friend_ids, 50)
+    users = await fetch_users_by_id([r["user_id"] for r in ranking],
+        {"display_name": 1, "picture": 1, "level": 1})
+    return [{**r, **users[r["user_id"]], "position": i + 1}
+            for i, r in enumerate(ranking) if r["user_id"] in users]
 
 @api_router.get("/rankings/clans")
-async def clan_ranking():
-    clans = await db.clans.find({}, {"_id": 0}).sort("total_xp", -1).to_list(50)
+async def clan_ranking(request: Request, period: str = "all", date: Optional[str] = None):
+    key = resolve_period(period, date, ("all", "week", "month"))
+    if period == "all":
+        return await cached_response(request, "rankings:clans", load_clan_ranking)
+    return await cached_response(request, f"rankings:clans:{period}:{key}",
+                                 lambda: load_period_ranking("clan", period, key))
+
+async def load_clan_ranking():
+    clans = await db.clans.find({}, CLAN_PROJECTION).sort("total_xp", -1).to_list(50)
     for i, c in enumerate(clans):
         c["position"] = i + 1
     return clans
 
+@api_router.get("/rankings/schools")
+async def school_ranking(request: Request, period: str = "week", date: Optional[str] = None):
+    key = resolve_period(period, date, ("week", "month"))
+    return await cached_response(request, f"rankings:schools:{period}:{key}",
+                                 lambda: load_period_ranking("school", period, key))
+
 # ── SHOP ──
 @api_router.get("/shop")
 async def get_shop(user: dict = Depends(get_current_user)):
@@ -552,14 +1280,17 @@ async def buy_item(item_id: str, user: dict = Depends(get_current_user)):
     item = await db.shop_items.find_one({"item_id": item_id}, {"_id": 0})
     if not item:
         raise HTTPException(status_code=404, detail="Item não encontrado")
-    if item_id in user.get("inventory", []):
-        raise HTTPException(status_code=400, detail="Item já adquirido")
-    if user.get("total_xp", 0) < item["price"]:
+    # Balance and ownership are checked by the update itself, not on the cached user, so
+    # concurrent purchases can neither overdraw total_xp nor add the item twice.
+    result = await db.users.update_one(
+        {"user_id": user["user_id"], "total_xp": {"$gte": item["price"]}, "inventory": {"$ne": item_id}},
+        {"$inc": {"total_xp": -item["price"]}, "$addToSet": {"inventory": item_id}})
+    if not result.modified_count:
+        current = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0, "inventory": 1})
+        if item_id in (current or {}).get("inventory", []):
+            raise HTTPException(status_code=400, detail="Item já adquirido")
         raise HTTPException(status_code=400, detail="XP insuficiente")
-    await db.users.update_one({"user_id": user["user_id"]}, {
-        "$inc": {"total_xp": -item["price"]},
-        "$push": {"inventory": item_id}
-    })
+    session_cache.invalidate_user(user["user_id"])
     return {"message": "Item comprado!", "item": item}
 
 # ── FRIENDS ──
@@ -571,10 +1302,12 @@ async def list_friends(user: dict = Depends(get_current_user)):
     accepted = []
     pending_sent = []
     pending_received = []
-    for f in friends_docs:
-        other_id = f["to_user_id"] if f["from_user_id"] == user["user_id"] else f["from_user_id"]
-        other = await db.users.find_one({"user_id": other_id},
-            {"_id": 0, "user_id": 1, "display_name": 1, "picture": 1, "level": 1, "streak": 1})
+    other_ids = [f["to_user_id"] if f["from_user_id"] == user["user_id"] else f["from_user_id"]
+                 for f in friends_docs]
+    others = await fetch_users_by_id(other_ids,
+        {"display_name": 1, "picture": 1, "level": 1, "streak": 1})
+    for f, other_id in zip(friends_docs, other_ids):
+        other = others.get(other_id)
         if not other:
             continue
         entry = {**f, "other_user": other}
@@ -628,24 +1361,43 @@ async def respond_friend_request(data: FriendRespond, user: dict = Depends(get_c
 async def set_rival(target_user_id: str, user: dict = Depends(get_current_user)):
     await db.users.update_one({"user_id": user["user_id"]},
                                {"$set": {"rival_id": target_user_id}})
+    session_cache.invalidate_user(user["user_id"])
+    push_hub.update_user(user["user_id"], rival_id=target_user_id)
     return {"message": "Rival definido!"}
 
+# Search runs on display_name_key (lower-cased, accent-folded): an anchored prefix scan
+# on its index first, then, when that leaves room, an infix lookup on the trigram index.
+# Candidates are ranked by match quality (exact, prefix, word start, infix), then level.
+SEARCH_LIMIT = 20
+SEARCH_SCAN_LIMIT = int(os.environ.get("SEARCH_SCAN_LIMIT", "100"))
+SEARCH_TRIGRAMS = os.environ.get("SEARCH_TRIGRAMS", "1") == "1"
+
 @api_router.get("/friends/search")
 async def search_users(q: str = "", user: dict = Depends(get_current_user)):
-    if len(q) < 2:
+    key = normalize_name(q)
+    if len(key) < 2:
         return []
-    users = await db.users.find(
-        {"display_name": {"$regex": q, "$options": "i"},
-         "user_id": {"$ne": user["user_id"]}, "onboarding_complete": True},
-        {"_id": 0, "user_id": 1, "display_name": 1, "picture": 1, "level": 1}
-    ).to_list(20)
+    base = {"user_id": {"$ne": user["user_id"]}, "onboarding_complete": True}
+    projection = {"_id": 0, "user_id": 1, "display_name": 1, "picture": 1, "level": 1, "display_name_key": 1}
+    docs = await db.users.find({"display_name_key": {"$regex": prefix_pattern(key)}, **base},
+                               projection).to_list(SEARCH_SCAN_LIMIT)
+    if SEARCH_TRIGRAMS and len(key) >= 3 and len(docs) < SEARCH_LIMIT:
+        seen = {d["user_id"] for d in docs}
+        candidates = await db.users.find({"display_name_trigrams": {"$all": name_trigrams(key)}, **base},
+                                         projection).to_list(SEARCH_SCAN_LIMIT)
+        docs += [d for d in candidates if d["user_id"] not in seen]
+    users = rank_matches(docs, key, "display_name_key", SEARCH_LIMIT)
+    for u in users:
+        del u["display_name_key"]
     return users
 
 # ── CLANS ──
 @api_router.get("/clans")
-async def list_clans():
-    clans = await db.clans.find({}, {"_id": 0}).sort("total_xp", -1).to_list(50)
-    return clans
+async def list_clans(request: Request):
+    return await cached_response(request, "clans", load_clans)
+
+async def load_clans():
+    return await db.clans.find({}, CLAN_PROJECTION).sort("total_xp", -1).to_list(50)
 
 @api_router.post("/clans")
 async def create_clan(data: ClanCreate, user: dict = Depends(get_current_user)):
@@ -653,35 +1405,48 @@ async def create_clan(data: ClanCreate, user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=400, detail="Você já está em um clã")
     if user.get("total_xp", 0) < 500:
         raise HTTPException(status_code=400, detail="Precisa de 500 Total XP para criar um clã")
-    existing = await db.clans.find_one({"name": {"$regex": f"^{re.escape(data.name)}$", "$options": "i"}}, {"_id": 0})
-    if existing:
-        raise HTTPException(status_code=400, detail="Nome de clã já existe")
+    name_key = normalize_name(data.name)
+    if not name_key:
+        raise HTTPException(status_code=400, detail="Nome de clã inválido")
+    media = {field: await media_field(getattr(data, field) or "", kind, user["user_id"])
+             for field, kind in CLAN_MEDIA_FIELDS.items()}
     clan = {
         "clan_id": f"clan_{uuid.uuid4().hex[:12]}",
-        "name": data.name, "description": data.description,
-        "photo": data.photo, "banner": data.banner,
+        "name": data.name, "name_key": name_key, "description": data.description, **media,
         "leader_id": user["user_id"],
         "members": [user["user_id"]], "total_xp": 0,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
-    await db.clans.insert_one(clan)
-    await db.users.update_one({"user_id": user["user_id"]},
-                               {"$set": {"clan_id": clan["clan_id"]},
-                                "$inc": {"total_xp": -500}})
+    # The checks above ran on the cached user; the fee and membership are claimed by the
+    # update itself, like buy_item, so concurrent requests cannot overdraw or found two clans.
+    result = await db.users.update_one(
+        {"user_id": user["user_id"], "total_xp": {"$gte": 500}, "clan_id": {"$in": ["", None]}},
+        {"$set": {"clan_id": clan["clan_id"]}, "$inc": {"total_xp": -500}})
+    if not result.modified_count:
+        await media_store.delete_refs(media.values(), user["user_id"])
+        current = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0, "clan_id": 1})
+        if (current or {}).get("clan_id"):
+            raise HTTPException(status_code=400, detail="Você já está em um clã")
+        raise HTTPException(status_code=400, detail="Precisa de 500 Total XP para criar um clã")
+    try:
+        await db.clans.insert_one(clan)
+    except DuplicateKeyError:
+        await db.users.update_one({"user_id": user["user_id"], "clan_id": clan["clan_id"]},
+                                   {"$set": {"clan_id": ""}, "$inc": {"total_xp": 500}})
+        await media_store.delete_refs(media.values(), user["user_id"])
+        raise HTTPException(status_code=400, detail="Nome de clã já existe")
+    session_cache.invalidate_user(user["user_id"])
+    response_cache.invalidate(*CLAN_CACHE_KEYS)
+    push_hub.update_user(user["user_id"], clan_id=clan["clan_id"])
     return {k: v for k, v in clan.items() if k != "_id"}
 
 @api_router.get("/clans/{clan_id}")
 async def get_clan(clan_id: str):
-    clan = await db.clans.find_one({"clan_id": clan_id}, {"_id": 0})
+    clan = await db.clans.find_one({"clan_id": clan_id}, CLAN_PROJECTION)
     if not clan:
         raise HTTPException(status_code=404, detail="Clã não encontrado")
-    members = []
-    for mid in clan.get("members", []):
-        m = await db.users.find_one({"user_id": mid},
-            {"_id": 0, "user_id": 1, "display_name": 1, "picture": 1, "level": 1, "streak": 1})
-        if m:
-            members.append(m)
-    clan["member_details"] = members
+    clan["member_details"] = await hydrate_users(clan.get("members", []),
+        {"display_name": 1, "picture": 1, "level": 1, "streak": 1})
     return clan
 
 @api_router.post("/clans/{clan_id}/join")
@@ -691,10 +1456,20 @@ async def join_clan(clan_id: str, user: dict = Depends(get_current_user)):
     clan = await db.clans.find_one({"clan_id": clan_id}, {"_id": 0})
     if not clan:
         raise HTTPException(status_code=404, detail="Clã não encontrado")
-    await db.clans.update_one({"clan_id": clan_id},
-                               {"$push": {"members": user["user_id"]}})
-    await db.users.update_one({"user_id": user["user_id"]},
-                               {"$set": {"clan_id": clan_id}})
+    # Membership is claimed on the user doc first, as in create_clan: the check above ran on
+    # the cached user, which another worker may have put in a clan since.
+    result = await db.users.update_one({"user_id": user["user_id"], "clan_id": {"$in": ["", None]}},
+                                       {"$set": {"clan_id": clan_id}})
+    if not result.modified_count:
+        raise HTTPException(status_code=400, detail="Você já está em um clã")
+    if not (await db.clans.update_one({"clan_id": clan_id},
+                                      {"$addToSet": {"members": user["user_id"]}})).matched_count:
+        # The clan was deleted in between.
+        await db.users.update_one({"user_id": user["user_id"], "clan_id": clan_id}, {"$set": {"clan_id": ""}})
+        raise HTTPException(status_code=404, detail="Clã não encontrado")
+    session_cache.invalidate_user(user["user_id"])
+    response_cache.invalidate(*CLAN_CACHE_KEYS)
+    push_hub.update_user(user["user_id"], clan_id=clan_id)
     return {"message": "Entrou no clã!"}
 
 @api_router.post("/clans/{clan_id}/leave")
@@ -708,135 +1483,204 @@ async def leave_clan(clan_id: str, user: dict = Depends(get_current_user)):
                                {"$pull": {"members": user["user_id"]}})
     await db.users.update_one({"user_id": user["user_id"]},
                                {"$set": {"clan_id": ""}})
+    session_cache.invalidate_user(user["user_id"])
+    push_hub.update_user(user["user_id"], clan_id="")
     if clan["leader_id"] == user["user_id"]:
         await db.clans.delete_one({"clan_id": clan_id})
+        await media_store.delete_refs([clan.get(f) for f in CLAN_MEDIA_FIELDS], user["user_id"])
+    response_cache.invalidate(*CLAN_CACHE_KEYS)
     return {"message": "Saiu do clã"}
 
 # ── MISSIONS ──
-async def generate_daily_missions(user: dict) -> list:
-    today = get_today_str()
-    existing = await db.missions.find_one(
-        {"user_id": user["user_id"], "date": today}, {"_id": 0})
-    if existing:
-        return existing.get("missions", [])
+# One missions doc per (user_id, local day), unique on that pair. The rollover job creates
+# the day's docs for recently active users in bulk; anyone it skipped gets theirs on first
+# read or completion. A new doc is seeded ($setOnInsert) from the day's completed
+# activities, and each later completion $incs its `progress` counters, so reading missions
+# is a single find; each mission's progress and `completed` are derived on read from the
+# counter its type tracks. `counted` lists the activities already in the counters: a seed
+# and a completion racing each other both see the activity, and only one counts it.
+MISSION_ACTIVE_DAYS = int(os.environ.get("MISSION_ACTIVE_DAYS", "30"))
+MISSION_PROGRESS = {"activities": "activities", "subject": "activities", "time": "minutes"}
+DAILY_MISSIONS = {
+    "m1": {"title": "Complete 3 atividades", "type": "activities", "target": 3, "reward": 100},
+    "m2": {"title": "Estude {subject}", "type": "subject", "target": 1, "reward": 75},
+    "m3": {"title": "Estude por 60 minutos", "type": "time", "target": 60, "reward": 150},
+}
+
+def new_daily_missions(user: dict) -> list:
     subjects = user.get("subjects", ["Matemática"])
-    missions = [
-        {"id": "m1", "title": "Complete 3 atividades", "type": "activities",
-         "target": 3, "reward": 100, "completed": False},
-        {"id": "m2", "title": f"Estude {random.choice(subjects) if subjects else 'uma matéria'}",
-         "type": "subject", "target": 1, "reward": 75, "completed": False},
-        {"id": "m3", "title": "Estude por 60 minutos", "type": "time",
-         "target": 60, "reward": 150, "completed": False},
-    ]
-    await db.missions.insert_one({
-        "user_id": user["user_id"], "date": today, "missions": missions
-    })
+    subject = random.choice(subjects) if subjects else "uma matéria"
+    return [{"id": mission_id, **m, "title": m["title"].format(subject=subject)}
+            for mission_id, m in DAILY_MISSIONS.items()]
+
+def new_mission_progress() -> dict:
+    return {"progress": {"activities": 0, "minutes": 0}, "counted": []}
+
+async def count_mission_progress(user_ids: List[str], day: str) -> Dict[str, dict]:
+    done = await db.activities.aggregate([
+        {"$match": {"user_id": {"$in": user_ids}, "date": day, "status": "completed"}},
+        {"$group": {"_id": "$user_id", "activities": {"$sum": 1},
+                    "minutes": {"$sum": "$estimated_time"}, "counted": {"$push": "$activity_id"}}},
+    ]).to_list(None)
+    return {d["_id"]: {"progress": {"activities": d["activities"], "minutes": d["minutes"]},
+                       "counted": d["counted"]} for d in done}
+
+def mission_seed(user: dict, counts: Optional[dict]) -> dict:
+    return {"$setOnInsert": {"missions": new_daily_missions(user), **(counts or new_mission_progress())}}
+
+def mission_view(doc: dict) -> list:
+    progress = doc.get("progress") or {}
+    missions = []
+    for m in doc.get("missions", []):
+        value = progress.get(MISSION_PROGRESS.get(m["type"]), 0)
+        missions.append({**m, "progress": min(value, m["target"]), "completed": value >= m["target"]})
     return missions
 
+async def seed_daily_missions(user: dict, day: str) -> dict:
+    query = {"user_id": user["user_id"], "date": day}
+    counts = (await count_mission_progress([user["user_id"]], day)).get(user["user_id"])
+    try:
+        return await db.missions.find_one_and_update(
+            query, mission_seed(user, counts), projection={"_id": 0, "missions": 1, "progress": 1},
+            upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # A concurrent seed inserted it first.
+        return await db.missions.find_one(query, {"_id": 0, "missions": 1, "progress": 1})
+
+async def get_daily_missions(user: dict, today: str) -> list:
+    doc = await db.missions.find_one({"user_id": user["user_id"], "date": today},
+                                     {"_id": 0, "missions": 1, "progress": 1})
+    return mission_view(doc or await seed_daily_missions(user, today))
+
+async def record_mission_progress(user: dict, day: str, activity_id: str, minutes: int):
+    query = {"user_id": user["user_id"], "date": day, "counted": {"$ne": activity_id}}
+    update = {"$inc": {"progress.activities": 1, "progress.minutes": minutes},
+              "$push": {"counted": activity_id}}
+    if (await db.missions.update_one(query, update)).matched_count:
+        return
+    # No doc yet, or it already counts the activity. The activity is completed by now, so
+    # a seed includes it; if another seed won without it, the retry counts it.
+    await seed_daily_missions(user, day)
+    await db.missions.update_one(query, update)
+
 @api_router.get("/missions")
-async def get_missions(user: dict = Depends(get_current_user)):
-    missions = await generate_daily_missions(user)
-    today = get_today_str()
-    completed_today = await db.activities.count_documents(
-        {"user_id": user["user_id"], "date": today, "status": "completed"})
-    total_time = 0
-    completed_activities = await db.activities.find(
-        {"user_id": user["user_id"], "date": today, "status": "completed"}, {"_id": 0}).to_list(100)
-    for a in completed_activities:
-        total_time += a.get("estimated_time", 0)
-    for m in missions:
-        if m["type"] == "activities":
-            m["progress"] = min(completed_today, m["target"])
-            m["completed"] = completed_today >= m["target"]
-        elif m["type"] == "time":
-            m["progress"] = min(total_time, m["target"])
-            m["completed"] = total_time >= m["target"]
-        elif m["type"] == "subject":
-            m["progress"] = 1 if completed_today > 0 else 0
-            m["completed"] = completed_today > 0
-    await db.missions.update_one(
-        {"user_id": user["user_id"], "date": today},
-        {"$set": {"missions": missions}})
-    return missions
+async def get_missions(user: dict = Depends(get_current_user), clock: Clock = Depends(get_clock)):
+    return await get_daily_missions(user, clock.today)
 
 @api_router.post("/missions/{mission_id}/claim")
-async def claim_mission(mission_id: str, user: dict = Depends(get_current_user)):
-    today = get_today_str()
-    doc = await db.missions.find_one(
-        {"user_id": user["user_id"], "date": today}, {"_id": 0})
-    if not doc:
-        raise HTTPException(status_code=404, detail="Missões não encontradas")
-    mission = None
-    for m in doc.get("missions", []):
-        if m["id"] == mission_id:
-            mission = m
-            break
+async def claim_mission(mission_id: str, user: dict = Depends(get_current_user),
+                        clock: Clock = Depends(get_clock)):
+    mission = DAILY_MISSIONS.get(mission_id)
     if not mission:
         raise HTTPException(status_code=404, detail="Missão não encontrada")
-    if not mission.get("completed"):
+    query = {"user_id": user["user_id"], "date": clock.today}
+    # The claim is one conditional update: it matches only while the mission's counter has
+    # reached the target and the mission is unclaimed, so of concurrent claims one wins.
+    result = await db.missions.update_one(
+        {**query, f"progress.{MISSION_PROGRESS[mission['type']]}": {"$gte": mission["target"]},
+         "missions": {"$elemMatch": {"id": mission_id, "claimed": {"$ne": True}}}},
+        {"$set": {"missions.$[m].claimed": True}},
+        array_filters=[{"m.id": mission_id, "m.claimed": {"$ne": True}}])
+    if not result.modified_count:
+        doc = await db.missions.find_one(query, {"_id": 0, "missions": 1, "progress": 1})
+        if not doc:
+            raise HTTPException(status_code=404, detail="Missões não encontradas")
+        current = next((m for m in mission_view(doc) if m["id"] == mission_id), None)
+        if not current:
+            raise HTTPException(status_code=404, detail="Missão não encontrada")
+        if current.get("claimed"):
+            raise HTTPException(status_code=400, detail="Recompensa já coletada")
         raise HTTPException(status_code=400, detail="Missão não concluída")
-    if mission.get("claimed"):
-        raise HTTPException(status_code=400, detail="Recompensa já coletada")
     xp = mission["reward"]
-    await db.users.update_one({"user_id": user["user_id"]}, {
-        "$inc": {"level_xp": xp, "total_xp": xp}
-    })
-    for m in doc["missions"]:
-        if m["id"] == mission_id:
-            m["claimed"] = True
-    await db.missions.update_one(
-        {"user_id": user["user_id"], "date": today},
-        {"$set": {"missions": doc["missions"]}})
-    updated_user = await db.users.find_one({"user_id": user["user_id"]}, {"_id": 0})
+    updated_user, _, weekly = await asyncio.gather(
+        db.users.find_one_and_update(
+            {"user_id": user["user_id"]}, {"$inc": {"level_xp": xp, "total_xp": xp}},
+            projection={**BADGE_USER_PROJECTION, "level_xp": 1}, return_document=ReturnDocument.AFTER),
+        award_daily_xp(user, clock.board_day, xp),
+        record_weekly_progress(user["user_id"], clock.week, xp=xp),
+    )
     new_level = get_level_info(updated_user.get("level_xp", 0))["level"]
-    await db.users.update_one({"user_id": user["user_id"]}, {"$set": {"level": new_level}})
+    if new_level > updated_user.get("level", 0):
+        await db.users.update_one({"user_id": user["user_id"]}, {"$max": {"level": new_level}})
+        updated_user["level"] = new_level
+    session_cache.invalidate_user(user["user_id"])
+    await award_badges(updated_user, weekly, {"level", "weekly_goals"})
     return {"message": "Recompensa coletada!", "xp": xp}
 
 # ── WEEKLY GOALS ──
-async def get_weekly_goals_data(user: dict) -> dict:
-    now = datetime.now(timezone.utc) - timedelta(hours=3)
-    week_start = (now - timedelta(days=now.weekday())).strftime("%Y-%m-%d")
-    goals_doc = await db.weekly_goals.find_one(
-        {"user_id": user["user_id"], "week": week_start}, {"_id": 0})
+# weekly_goals holds the goals and running progress counters for one (user_id, week).
+# Completions and mission claims $inc the counters; reconcile_weekly_progress rebuilds
+# them from activities + daily_xp history for docs that predate the counters.
+WEEKLY_GOAL_DEFAULTS = {"xp_goal": 500, "minutes_goal": 120, "activities_goal": 10}
+WEEKLY_PROGRESS_VERSION = 1
+
+def new_weekly_goals_fields(exclude=()) -> dict:
+    fields = {**WEEKLY_GOAL_DEFAULTS, "xp_progress": 0, "minutes_progress": 0,
+              "activities_progress": 0, "progress_version": WEEKLY_PROGRESS_VERSION}
+    return {k: v for k, v in fields.items() if k not in exclude}
+
+async def record_weekly_progress(user_id: str, week: str, xp: int = 0, minutes: int = 0,
+                                 activities: int = 0):
+    inc = {"xp_progress": xp, "minutes_progress": minutes, "activities_progress": activities}
+    return await db.weekly_goals.find_one_and_update(
+        {"user_id": user_id, "week": week},
+        {"$inc": inc, "$setOnInsert": new_weekly_goals_fields(exclude=inc)},
+        projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER)
+
+async def reconcile_weekly_progress(user_id: Optional[str] = None, week: Optional[str] = None):
+    match = {}
+    if user_id:
+        match["user_id"] = user_id
+    if week:
+        week_end = (datetime.strptime(week, "%Y-%m-%d") + timedelta(days=6)).strftime("%Y-%m-%d")
+        match["date"] = {"$gte": week, "$lte": week_end}
+    await db.activities.aggregate([
+        {"$match": {**match, "status": "completed"}},
+        {"$project": {"user_id": 1, "date": 1, "xp": {"$literal": 0},
+                      "minutes": {"$ifNull": ["$estimated_time", 0]}, "activities": {"$literal": 1}}},
+        {"$unionWith": {"coll": "daily_xp", "pipeline": [
+            {"$match": match},
+            {"$project": {"user_id": 1, "date": 1, "xp": 1,
+                          "minutes": {"$literal": 0}, "activities": {"$literal": 0}}}]}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "week": {"$dateToString": {"format": "%Y-%m-%d", "date": {
+                "$dateTrunc": {"date": {"$dateFromString": {"dateString": "$date"}},
+                               "unit": "week", "startOfWeek": "monday"}}}}},
+            "xp_progress": {"$sum": "$xp"}, "minutes_progress": {"$sum": "$minutes"},
+            "activities_progress": {"$sum": "$activities"}}},
+        {"$project": {"_id": 0, "user_id": "$_id.user_id", "week": "$_id.week",
+                      "xp_progress": 1, "minutes_progress": 1, "activities_progress": 1,
+                      "progress_version": {"$literal": WEEKLY_PROGRESS_VERSION}}},
+        {"$merge": {"into": "weekly_goals", "on": ["user_id", "week"],
+                    "whenMatched": "merge", "whenNotMatched": "insert"}},
+    ]).to_list(None)
+
+async def get_weekly_goals_data(user: dict, week: str) -> dict:
+    query = {"user_id": user["user_id"], "week": week}
+    goals_doc = await db.weekly_goals.find_one(query, {"_id": 0})
     if not goals_doc:
-        goals_doc = {
-            "user_id": user["user_id"], "week": week_start,
-            "xp_goal": 500, "minutes_goal": 120, "activities_goal": 10
-        }
-        await db.weekly_goals.insert_one(goals_doc)
-    week_xp = 0
-    week_minutes = 0
-    week_activities = 0
-    for i in range(7):
-        d = (now - timedelta(days=now.weekday()) + timedelta(days=i)).strftime("%Y-%m-%d")
-        if d > now.strftime("%Y-%m-%d"):
-            break
-        xp_doc = await db.daily_xp.find_one(
-            {"user_id": user["user_id"], "date": d}, {"_id": 0})
-        if xp_doc:
-            week_xp += xp_doc.get("xp", 0)
-        acts = await db.activities.find(
-            {"user_id": user["user_id"], "date": d, "status": "completed"}, {"_id": 0}).to_list(100)
-        week_activities += len(acts)
-        for a in acts:
-            week_minutes += a.get("estimated_time", 0)
+        goals_doc = await db.weekly_goals.find_one_and_update(
+            query, {"$setOnInsert": new_weekly_goals_fields()},
+            projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER)
+    elif goals_doc.get("progress_version") != WEEKLY_PROGRESS_VERSION:
+        await reconcile_weekly_progress(user["user_id"], week)
+        goals_doc = await db.weekly_goals.find_one(query, {"_id": 0})
     return {
         "xp_goal": goals_doc.get("xp_goal", 500),
         "minutes_goal": goals_doc.get("minutes_goal", 120),
         "activities_goal": goals_doc.get("activities_goal", 10),
-        "xp_progress": week_xp,
-        "minutes_progress": week_minutes,
-        "activities_progress": week_activities
+        "xp_progress": goals_doc.get("xp_progress", 0),
+        "minutes_progress": goals_doc.get("minutes_progress", 0),
+        "activities_progress": goals_doc.get("activities_progress", 0)
     }
 
 @api_router.get("/goals")
-async def get_goals(user: dict = Depends(get_current_user)):
-    return await get_weekly_goals_data(user)
+async def get_goals(user: dict = Depends(get_current_user), clock: Clock = Depends(get_clock)):
+    return await get_weekly_goals_data(user, clock.week)
 
 @api_router.put("/goals")
-async def update_goals(data: WeeklyGoalUpdate, user: dict = Depends(get_current_user)):
-    now = datetime.now(timezone.utc) - timedelta(hours=3)
-    week_start = (now - timedelta(days=now.weekday())).strftime("%Y-%m-%d")
+async def update_goals(data: WeeklyGoalUpdate, user: dict = Depends(get_current_user),
+                       clock: Clock = Depends(get_clock)):
     update = {}
     if data.xp_goal is not None:
         update["xp_goal"] = data.xp_goal
@@ -845,9 +1689,123 @@ async def update_goals(data: WeeklyGoalUpdate, user: dict = Depends(get_current_
     if data.activities_goal is not None:
         update["activities_goal"] = data.activities_goal
     await db.weekly_goals.update_one(
-        {"user_id": user["user_id"], "week": week_start},
-        {"$set": update}, upsert=True)
-    return await get_weekly_goals_data(user)
+        {"user_id": user["user_id"], "week": clock.week},
+        {"$set": update, "$setOnInsert": new_weekly_goals_fields(exclude=update)}, upsert=True)
+    return await get_weekly_goals_data(user, clock.week)
+
+# ── DAY ROLLOVER ──
+# Each worker sleeps until the next local midnight among the timezones in use (checking
+# for new ones every ROLLOVER_CHECK_SECONDS). At the platform midnight every worker
+# rebuilds its in-memory leaderboard; the shared work in ROLLOVER_STEPS runs once per
+# (timezone, day), on whichever worker claims it in scheduled_jobs. The current day is
+# also rolled over at startup, so a deploy across midnight catches up.
+ROLLOVER_CHECK_SECONDS = float(os.environ.get("ROLLOVER_CHECK_SECONDS", "300"))
+ROLLOVER_GRACE_SECONDS = float(os.environ.get("ROLLOVER_GRACE_SECONDS", "5"))
+ROLLOVER_BATCH_SIZE = 1000
+LEADERBOARD_ARCHIVE_SIZE = int(os.environ.get("LEADERBOARD_ARCHIVE_SIZE", "100"))
+
+async def active_timezones() -> List[str]:
+    zones = await db.users.distinct("timezone")
+    return sorted({DEFAULT_TIMEZONE, *filter(is_valid_timezone, zones)})
+
+def timezone_users_query(tz_name: str) -> dict:
+    if tz_name == DEFAULT_TIMEZONE:
+        return {"timezone": {"$in": [tz_name, None, ""]}, "onboarding_complete": True}
+    return {"timezone": tz_name, "onboarding_complete": True}
+
+async def bulk_upsert(collection, ops: list):
+    try:
+        await collection.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        # A request that created the same document first wins the unique index.
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+
+async def upsert_for_timezone_users(tz_name: str, collection, make_ops, query: Optional[dict] = None,
+                                    projection: Optional[dict] = None):
+    # `make_ops` turns a batch of user docs into the upserts for them.
+    batch = []
+    async for doc in db.users.find({**timezone_users_query(tz_name), **(query or {})},
+                                   {"_id": 0, "user_id": 1, **(projection or {})}):
+        batch.append(doc)
+        if len(batch) >= ROLLOVER_BATCH_SIZE:
+            await bulk_upsert(collection, await make_ops(batch))
+            batch = []
+    if batch:
+        await bulk_upsert(collection, await make_ops(batch))
+
+async def archive_daily_leaderboard(tz_name: str, keys: DayKeys):
+    if tz_name != DEFAULT_TIMEZONE:
+        return
+    for counter in WRITE_BEHIND_COUNTERS:
+        await counter.flush()
+    rows = await db.daily_xp.find(
+        {"date": keys.yesterday}, {"_id": 0, "user_id": 1, "xp": 1, "display_name": 1, "picture": 1}
+    ).sort("xp", -1).to_list(LEADERBOARD_ARCHIVE_SIZE)
+    await db.leaderboard_archive.update_one(
+        {"date": keys.yesterday},
+        {"$set": {"entries": [{**r, "position": i + 1} for i, r in enumerate(rows)],
+                  "archived_at": datetime.now(timezone.utc)}}, upsert=True)
+
+async def pregenerate_weekly_goals(tz_name: str, keys: DayKeys):
+    if keys.today != keys.week:
+        return
+    async def make_ops(users: List[dict]) -> list:
+        return [UpdateOne({"user_id": u["user_id"], "week": keys.week},
+                          {"$setOnInsert": new_weekly_goals_fields()}, upsert=True) for u in users]
+
+    await upsert_for_timezone_users(tz_name, db.weekly_goals, make_ops)
+
+async def pregenerate_daily_missions(tz_name: str, keys: DayKeys):
+    active_since = (datetime.strptime(keys.today, "%Y-%m-%d") -
+                    timedelta(days=MISSION_ACTIVE_DAYS)).strftime("%Y-%m-%d")
+
+    async def make_ops(users: List[dict]) -> list:
+        # Seeded from completions already made today: at midnight there are none, but the
+        # startup rollover can run mid-day.
+        counts = await count_mission_progress([u["user_id"] for u in users], keys.today)
+        return [UpdateOne({"user_id": u["user_id"], "date": keys.today},
+                          mission_seed(u, counts.get(u["user_id"])), upsert=True) for u in users]
+
+    await upsert_for_timezone_users(tz_name, db.missions, make_ops,
+                                    query={"last_activity_date": {"$gte": active_since}},
+                                    projection={"subjects": 1})
+
+ROLLOVER_STEPS = [archive_daily_leaderboard, pregenerate_weekly_goals, pregenerate_daily_missions]
+
+async def run_rollover(tz_name: str, keys: DayKeys):
+    if tz_name == DEFAULT_TIMEZONE:
+        await get_leaderboard()
+    job_id = f"rollover:{tz_name}:{keys.today}"
+    try:
+        await db.scheduled_jobs.insert_one({"_id": job_id, "started_at": datetime.now(timezone.utc)})
+    except DuplicateKeyError:
+        return
+    try:
+        for step in ROLLOVER_STEPS:
+            await step(tz_name, keys)
+    except Exception:
+        # Release the claim so the next check (on any worker) retries the day.
+        await db.scheduled_jobs.delete_one({"_id": job_id})
+        raise
+    await db.scheduled_jobs.update_one({"_id": job_id}, {"$set": {"finished_at": datetime.now(timezone.utc)}})
+    logger.info(f"Day rollover for {tz_name} on {keys.today} done")
+
+async def rollover_loop():
+    rolled: Dict[str, datetime] = {}
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            for tz_name in await active_timezones():
+                keys = day_keys(tz_name, now)
+                if rolled.get(tz_name) != keys.ends_at:
+                    await run_rollover(tz_name, keys)
+                    rolled[tz_name] = keys.ends_at
+        except Exception:
+            logger.exception("Day rollover failed")
+        next_at = min(rolled.values(), default=now)
+        delay = min((next_at - datetime.now(timezone.utc)).total_seconds(), ROLLOVER_CHECK_SECONDS)
+        await asyncio.sleep(max(delay, 0) + ROLLOVER_GRACE_SECONDS)
 
 # ── BADGES ──
 BADGE_DEFINITIONS = [
@@ -862,29 +1820,84 @@ BADGE_DEFINITIONS = [
     {"badge_id": "weekly_goal", "name": "Meta Semanal", "description": "Complete todas as metas semanais", "icon": "star"},
 ]
 
-async def check_badges(user_id: str):
-    user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
-    if not user:
+# Badges are evaluated from per-user running counters kept in users.stats (plus level and
+# the current weekly_goals doc). Each rule names the counters it reads, so an event only
+# evaluates the rules whose inputs it changed, and nothing rescans activity history.
+BADGE_RULES = [
+    {"badge_id": "first_activity", "depends_on": {"completed_activities"},
+     "earned": lambda s: s["completed_activities"] >= 1},
+    {"badge_id": "streak_7", "depends_on": {"max_streak"}, "earned": lambda s: s["max_streak"] >= 7},
+    {"badge_id": "streak_30", "depends_on": {"max_streak"}, "earned": lambda s: s["max_streak"] >= 30},
+    {"badge_id": "activities_100", "depends_on": {"completed_activities"},
+     "earned": lambda s: s["completed_activities"] >= 100},
+    {"badge_id": "hours_10", "depends_on": {"total_minutes"}, "earned": lambda s: s["total_minutes"] >= 600},
+    {"badge_id": "level_10", "depends_on": {"level"}, "earned": lambda s: s["level"] >= 10},
+    {"badge_id": "level_25", "depends_on": {"level"}, "earned": lambda s: s["level"] >= 25},
+    {"badge_id": "level_50", "depends_on": {"level"}, "earned": lambda s: s["level"] >= 50},
+    {"badge_id": "weekly_goal", "depends_on": {"weekly_goals"}, "earned": lambda s: s["weekly_goal_met"]},
+]
+BADGE_RULES_BY_COUNTER: Dict[str, list] = {}
+for _rule in BADGE_RULES:
+    for _counter in _rule["depends_on"]:
+        BADGE_RULES_BY_COUNTER.setdefault(_counter, []).append(_rule)
+BADGE_USER_PROJECTION = {"_id": 0, "user_id": 1, "level": 1, "streak": 1, "stats": 1, "earned_badges": 1}
+
+async def ensure_user_stats(user: dict):
+    # One-off backfill for users created before users.stats existed.
+    if "stats" in user:
         return
-    earned = await db.user_badges.find({"user_id": user_id}, {"_id": 0}).to_list(100)
-    earned_ids = {b["badge_id"] for b in earned}
-    total_activities = await db.activities.count_documents(
-        {"user_id": user_id, "status": "completed"})
-    checks = {
-        "first_activity": total_activities >= 1,
-        "streak_7": user.get("streak", 0) >= 7,
-        "streak_30": user.get("streak", 0) >= 30,
-        "activities_100": total_activities >= 100,
-        "level_10": user.get("level", 0) >= 10,
-        "level_25": user.get("level", 0) >= 25,
-        "level_50": user.get("level", 0) >= 50,
+    totals = await db.activities.aggregate([
+        {"$match": {"user_id": user["user_id"], "status": "completed"}},
+        {"$group": {"_id": None, "count": {"$sum": 1}, "minutes": {"$sum": "$estimated_time"}}}
+    ]).to_list(1)
+    totals = totals[0] if totals else {}
+    await db.users.update_one({"user_id": user["user_id"], "stats": {"$exists": False}}, {"$set": {"stats": {
+        "completed_activities": totals.get("count", 0), "total_minutes": totals.get("minutes", 0),
+        "max_streak": user.get("streak", 0)
+    }}})
+
+def weekly_goal_met(weekly: Optional[dict]) -> bool:
+    if not weekly:
+        return False
+    return (weekly.get("xp_progress", 0) >= weekly.get("xp_goal", 500)
+            and weekly.get("minutes_progress", 0) >= weekly.get("minutes_goal", 120)
+            and weekly.get("activities_progress", 0) >= weekly.get("activities_goal", 10))
+
+def evaluate_badges(counters: dict, changed: set, earned) -> List[str]:
+    new = []
+    for counter in changed:
+        for rule in BADGE_RULES_BY_COUNTER.get(counter, []):
+            badge_id = rule["badge_id"]
+            if badge_id not in earned and badge_id not in new and rule["earned"](counters):
+                new.append(badge_id)
+    return new
+
+async def award_badges(user: dict, weekly: Optional[dict], changed: set) -> List[str]:
+    stats = user.get("stats") or {}
+    counters = {
+        "completed_activities": stats.get("completed_activities", 0),
+        "total_minutes": stats.get("total_minutes", 0),
+        "max_streak": max(stats.get("max_streak", 0), user.get("streak", 0)),
+        "level": user.get("level", 0),
+        "weekly_goal_met": weekly_goal_met(weekly),
     }
-    for badge_id, condition in checks.items():
-        if condition and badge_id not in earned_ids:
-            await db.user_badges.insert_one({
-                "user_id": user_id, "badge_id": badge_id,
-                "earned_at": datetime.now(timezone.utc).isoformat()
-            })
+    new = evaluate_badges(counters, changed, set(user.get("earned_badges", [])))
+    if not new:
+        return []
+    now = datetime.now(timezone.utc).isoformat()
+    try:
+        await db.user_badges.bulk_write([
+            UpdateOne({"user_id": user["user_id"], "badge_id": badge_id},
+                      {"$setOnInsert": {"earned_at": now}}, upsert=True)
+            for badge_id in new], ordered=False)
+    except BulkWriteError as e:
+        # A concurrent award of the same badge loses the upsert race on the unique index.
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+    await db.users.update_one({"user_id": user["user_id"]},
+                               {"$addToSet": {"earned_badges": {"$each": new}}})
+    session_cache.invalidate_user(user["user_id"])
+    return new
 
 @api_router.get("/badges")
 async def get_badges(user: dict = Depends(get_current_user)):
@@ -895,6 +1908,32 @@ async def get_badges(user: dict = Depends(get_current_user)):
         result.append({**b, "earned": b["badge_id"] in earned_ids})
     return result
 
+# ── CACHE STATS ──
+@api_router.get("/cache/stats")
+async def cache_stats():
+    return {"session_cache": session_cache.stats(), "response_cache": response_cache.stats(),
+            "oauth_sessions": oauth_client.stats()}
+
+# ── METRICS ──
+def collect_app_gauges() -> list:
+    gauges = [(f"session_cache_{k}", {}, v) for k, v in session_cache.stats().items()]
+    gauges += [(f"response_cache_{k}", {}, v) for k, v in response_cache.stats().items()]
+    for counter in WRITE_BEHIND_COUNTERS:
+        for k, v in counter.metrics().items():
+            if k != "mode":
+                gauges.append((f"write_behind_{k}", {"counter": counter.name}, v))
+    gauges.append(("leaderboard_entries", {}, len(daily_leaderboard)))
+    gauges.append(("revoked_tokens", {}, len(token_denylist)))
+    gauges += [(f"push_{k}", {}, v) for k, v in push_hub.metrics().items()]
+    gauges += [(f"oauth_sessions_{k}", {}, v) for k, v in oauth_client.stats().items()]
+    return gauges
+
+metrics_registry.add_collector(collect_app_gauges)
+
+@api_router.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
 # ── SEED DATA ──
 SHOP_ITEMS = [
     {"item_id": "frame_basic", "name": "Moldura Básica", "type": "frame", "rarity": "common", "price": 500, "description": "Uma moldura simples e elegante", "preview": "border-zinc-400"},
@@ -914,36 +1953,296 @@ SHOP_ITEMS = [
     {"item_id": "banner_legendary", "name": "Banner Lendário", "type": "banner", "rarity": "legendary", "price": 12000, "description": "O banner mais exclusivo", "preview": "linear-gradient(135deg, #232526, #ffd700)"},
 ]
 
-async def seed_shop():
-    count = await db.shop_items.count_documents({})
-    if count == 0:
-        for item in SHOP_ITEMS:
-            await db.shop_items.insert_one(item)
-        logger.info("Shop items seeded")
+# ── MIGRATIONS ──
+# Schema changes are versioned: append a Migration, never edit an applied one. Workers
+# run `migrate` on boot and only the lock holder applies them; `python migrations.py`
+# runs them (or `status` / `explain`) from the command line.
+async def create_indexes(specs: Dict[str, List[IndexModel]]):
+    for collection, indexes in specs.items():
+        await db[collection].create_indexes(indexes)
+
+async def migration_initial_indexes():
+    await create_indexes({
+        "users": [IndexModel("user_id", unique=True), IndexModel("email", unique=True),
+                  IndexModel("display_name")],
+        "activities": [IndexModel([("user_id", ASCENDING), ("date", DESCENDING)])],
+        "daily_xp": [IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], unique=True)],
+        "user_sessions": [IndexModel("session_token")],
+        "friends": [IndexModel("request_id", unique=True)],
+        "clans": [IndexModel("clan_id", unique=True)],
+    })
+
+async def migration_session_expiry():
+    await create_indexes({
+        "user_sessions": [IndexModel("expires_at", expireAfterSeconds=0)],
+        "revoked_tokens": [IndexModel("jti", unique=True), IndexModel("expires_at", expireAfterSeconds=0)],
+    })
+
+async def migration_hot_query_indexes():
+    await create_indexes({
+        "users": [IndexModel([("onboarding_complete", ASCENDING), ("streak", DESCENDING)])],
+        "activities": [
+            IndexModel("activity_id", unique=True),
+            IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("date", ASCENDING)]),
+            IndexModel([("user_id", ASCENDING), ("title", ASCENDING), ("created_at", ASCENDING)]),
+            IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("activity_id", DESCENDING)]),
+            IndexModel([("user_id", ASCENDING), ("status", ASCENDING),
+                        ("created_at", DESCENDING), ("activity_id", DESCENDING)]),
+        ],
+        "daily_xp": [IndexModel([("date", ASCENDING), ("xp", DESCENDING)]),
+                     IndexModel([("date", ASCENDING), ("updated_at", ASCENDING)])],
+        "friends": [IndexModel([("from_user_id", ASCENDING), ("status", ASCENDING)]),
+                    IndexModel([("to_user_id", ASCENDING), ("status", ASCENDING)])],
+        "clans": [IndexModel([("total_xp", DESCENDING)]), IndexModel("name")],
+        "missions": [IndexModel([("user_id", ASCENDING), ("date", ASCENDING)])],
+    })
+
+async def migration_unique_counters():
+    await drop_duplicates(db.weekly_goals, ["user_id", "week"])
+    await drop_duplicates(db.user_badges, ["user_id", "badge_id"])
+    await create_indexes({
+        "weekly_goals": [IndexModel([("user_id", ASCENDING), ("week", ASCENDING)], unique=True)],
+        "user_badges": [IndexModel([("user_id", ASCENDING), ("badge_id", ASCENDING)], unique=True)],
+    })
+
+async def migration_seed_shop():
+    await db.shop_items.create_index("item_id", unique=True)
+    await db.shop_items.bulk_write(
+        [UpdateOne({"item_id": item["item_id"]}, {"$set": item}, upsert=True) for item in SHOP_ITEMS],
+        ordered=False)
+
+async def migration_externalize_media():
+    # Moves inline data URLs written before the media store into it.
+    for collection, fields, owner_field in ((db.users, PROFILE_MEDIA_FIELDS, "user_id"),
+                                            (db.clans, CLAN_MEDIA_FIELDS, "leader_id")):
+        query = {"$or": [{field: {"$regex": "^data:"}} for field in fields]}
+        async for doc in collection.find(query, {"_id": 1, owner_field: 1, **{f: 1 for f in fields}}):
+            update = {}
+            for field, kind in fields.items():
+                value = doc.get(field) or ""
+                if not value.startswith("data:"):
+                    continue
+                try:
+                    update[field] = media_store.ref(
+                        await media_store.save(decode_data_url(value), kind, doc.get(owner_field, "")))
+                except InvalidMedia:
+                    logger.warning(f"Dropping unreadable {collection.name}.{field} on {doc['_id']}")
+                    update[field] = ""
+            await collection.update_one({"_id": doc["_id"]}, {"$set": update})
+
+async def migration_xp_rollups():
+    batch = []
+    async for doc in db.users.find({"school": {"$gt": ""}}, {"_id": 1, "school": 1}):
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"school_key": normalize_name(doc["school"])}}))
+        if len(batch) >= 1000:
+            await db.users.bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        await db.users.bulk_write(batch, ordered=False)
+    specs = {}
+    for (scope, period), counter in rollup_counters.items():
+        specs[counter.collection.name] = [
+            IndexModel([(ROLLUP_SCOPES[scope], ASCENDING), (period, ASCENDING)], unique=True),
+            IndexModel([(period, ASCENDING), ("xp", DESCENDING)])]
+    await create_indexes(specs)
+    await backfill_xp_rollups()
+
+async def migration_day_rollover():
+    await create_indexes({
+        "users": [IndexModel([("timezone", ASCENDING), ("onboarding_complete", ASCENDING)])],
+        "leaderboard_archive": [IndexModel("date", unique=True)],
+        "scheduled_jobs": [IndexModel("started_at", expireAfterSeconds=30 * 24 * 3600)],
+    })
+
+async def migration_missions_progress():
+    # Duplicate docs came from concurrent first reads of the day; progress used to be
+    # recomputed on every read, so docs still in use get their counters seeded.
+    await drop_duplicates(db.missions, ["user_id", "date"])
+    try:
+        await db.missions.drop_index("user_id_1_date_1")
+    except OperationFailure:
+        pass
+    await create_indexes({
+        "missions": [IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], unique=True)]})
+    await reseed_recent_missions({})
+
+async def reseed_recent_missions(query: dict):
+    recent = (datetime.now(timezone.utc) - timedelta(days=2)).strftime("%Y-%m-%d")
+    async for doc in db.missions.find({**query, "date": {"$gte": recent}}, {"_id": 1, "user_id": 1, "date": 1}):
+        counts = (await count_mission_progress([doc["user_id"]], doc["date"])).get(doc["user_id"])
+        await db.missions.update_one({"_id": doc["_id"], **query}, {"$set": counts or new_mission_progress()})
+
+async def migration_missions_counted():
+    # The first rollover after 012 created today's docs with zero progress even where the
+    # user had already completed activities. Docs without `counted` predate the seeding
+    # fix and are recounted.
+    await reseed_recent_missions({"counted": {"$exists": False}})
+
+async def migration_session_expiry_dates():
+    # Sessions written before 002 stored expires_at as an ISO string, which the TTL index
+    # ignores, so they were never purged. Live ones become dates; expired or unreadable
+    # ones are deleted.
+    now = datetime.now(timezone.utc)
+    batch = []
+    async for doc in db.user_sessions.find({"expires_at": {"$type": "string"}}, {"_id": 1, "expires_at": 1}):
+        try:
+            expires_at = datetime.fromisoformat(doc["expires_at"])
+        except ValueError:
+            expires_at = now
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        batch.append(DeleteOne({"_id": doc["_id"]}) if expires_at <= now else
+                     UpdateOne({"_id": doc["_id"]}, {"$set": {"expires_at": expires_at}}))
+        if len(batch) >= 1000:
+            await db.user_sessions.bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        await db.user_sessions.bulk_write(batch, ordered=False)
+
+async def migration_search_keys():
+    # Names that only differed by case or accents were allowed before; the oldest keeps
+    # the plain key and the rest get "<key> #<id>" so the unique index builds and they
+    # still show up in prefix search.
+    for collection, name_field, id_field, key_field, trigram_field in (
+            (db.users, "display_name", "user_id", "display_name_key", "display_name_trigrams"),
+            (db.clans, "name", "clan_id", "name_key", None)):
+        seen, batch = set(), []
+        cursor = collection.find({name_field: {"$gt": ""}},
+                                 {"_id": 1, id_field: 1, name_field: 1}).sort("created_at", 1)
+        async for doc in cursor:
+            key = normalize_name(doc[name_field])
+            if not key:
+                continue
+            update = {key_field: key if key not in seen else f"{key} #{doc.get(id_field, doc['_id'])}"}
+            if trigram_field:
+                update[trigram_field] = name_trigrams(key)
+            seen.add(key)
+            batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+            if len(batch) >= 1000:
+                await collection.bulk_write(batch, ordered=False)
+                batch = []
+        if batch:
+            await collection.bulk_write(batch, ordered=False)
+    await create_indexes({
+        "users": [IndexModel("display_name_key", unique=True, sparse=True),
+                  IndexModel("display_name_trigrams")],
+        "clans": [IndexModel("name_key", unique=True, sparse=True)],
+    })
+    # Only the case-insensitive regex checks used these.
+    for collection, index in ((db.users, "display_name_1"), (db.clans, "name_1")):
+        try:
+            await collection.drop_index(index)
+        except OperationFailure:
+            pass
+
+MIGRATIONS = [
+    Migration(1, "initial_indexes", migration_initial_indexes),
+    Migration(2, "session_expiry", migration_session_expiry),
+    Migration(3, "hot_query_indexes", migration_hot_query_indexes),
+    Migration(4, "unique_counters", migration_unique_counters),
+    Migration(5, "seed_shop", migration_seed_shop),
+    Migration(6, "backfill_user_levels", recompute_user_levels),
+    Migration(7, "backfill_weekly_progress", reconcile_weekly_progress),
+    Migration(8, "externalize_media", migration_externalize_media),
+    Migration(9, "search_keys", migration_search_keys),
+    Migration(10, "xp_rollups", migration_xp_rollups),
+    Migration(11, "day_rollover", migration_day_rollover),
+    Migration(12, "missions_progress", migration_missions_progress),
+    Migration(13, "missions_counted", migration_missions_counted),
+    Migration(14, "session_expiry_dates", migration_session_expiry_dates),
+]
+
+# Query shapes issued by the routes above; `python migrations.py explain` and
+# tests/test_migrations.py fail if any of them is planned as a COLLSCAN.
+HOT_QUERIES = [
+    {"name": "users by user_id", "collection": "users", "filter": {"user_id": "u"}},
+    {"name": "users by email", "collection": "users", "filter": {"email": "e"}},
+    {"name": "users streak ranking", "collection": "users", "filter": {"onboarding_complete": True},
+     "sort": {"streak": -1}},
+    {"name": "sessions by token", "collection": "user_sessions", "filter": {"session_token": "t"}},
+    {"name": "activity by id", "collection": "activities", "filter": {"activity_id": "a", "user_id": "u"}},
+    {"name": "activities today by title", "collection": "activities",
+     "filter": {"user_id": "u", "title": "t", "date": "2026-01-01"}},
+    {"name": "activities weekly title count", "collection": "activities",
+     "filter": {"user_id": "u", "title": "t", "created_at": {"$gte": "2026-01-01"}}},
+    {"name": "activities by status and date", "collection": "activities",
+     "filter": {"user_id": "u", "date": "2026-01-01", "status": "completed"}},
+    {"name": "pending activities", "collection": "activities", "filter": {"user_id": "u", "status": "pending"}},
+    {"name": "activities page", "collection": "activities", "filter": {"user_id": "u"},
+     "sort": {"created_at": -1, "activity_id": -1}},
+    {"name": "daily_xp chart range", "collection": "daily_xp",
+     "filter": {"user_id": "u", "date": {"$gte": "2026-01-01", "$lte": "2026-01-07"}}},
+    {"name": "daily_xp today ranking", "collection": "daily_xp", "filter": {"date": "2026-01-01"},
+     "sort": {"xp": -1}},
+    {"name": "daily_xp leaderboard delta", "collection": "daily_xp",
+     "filter": {"date": "2026-01-01", "updated_at": {"$gte": datetime(2026, 1, 1)}}},
+    {"name": "friends of user", "collection": "friends",
+     "filter": {"$or": [{"from_user_id": "u"}, {"to_user_id": "u"}], "status": "accepted"}},
+    {"name": "friend request by id", "collection": "friends", "filter": {"request_id": "r", "to_user_id": "u"}},
+    {"name": "clan by id", "collection": "clans", "filter": {"clan_id": "c"}},
+    {"name": "user search prefix", "collection": "users",
+     "filter": {"display_name_key": {"$regex": "^jo"}, "onboarding_complete": True}},
+    {"name": "user search trigrams", "collection": "users",
+     "filter": {"display_name_trigrams": {"$all": ["ao ", "o s"]}, "onboarding_complete": True}},
+    {"name": "clans by total_xp", "collection": "clans", "filter": {}, "sort": {"total_xp": -1}},
+    {"name": "weekly_xp ranking", "collection": "weekly_xp", "filter": {"week": "2026-01-05"},
+     "sort": {"xp": -1}},
+    {"name": "monthly_xp friends", "collection": "monthly_xp",
+     "filter": {"month": "2026-01", "user_id": {"$in": ["u", "v"]}}},
+    {"name": "clan_weekly_xp ranking", "collection": "clan_weekly_xp", "filter": {"week": "2026-01-05"},
+     "sort": {"xp": -1}},
+    {"name": "school_monthly_xp ranking", "collection": "school_monthly_xp", "filter": {"month": "2026-01"},
+     "sort": {"xp": -1}},
+    {"name": "users by timezone", "collection": "users",
+     "filter": {"timezone": "America/Manaus", "onboarding_complete": True}},
+    {"name": "missions today", "collection": "missions", "filter": {"user_id": "u", "date": "2026-01-01"}},
+    {"name": "weekly goals", "collection": "weekly_goals", "filter": {"user_id": "u", "week": "2026-01-01"}},
+    {"name": "user badges", "collection": "user_badges", "filter": {"user_id": "u"}},
+    {"name": "shop item", "collection": "shop_items", "filter": {"item_id": "i"}},
+]
 
 @app.on_event("startup")
 async def startup():
-    await seed_shop()
-    await db.users.create_index("user_id", unique=True)
-    await db.users.create_index("email", unique=True)
-    await db.users.create_index("display_name")
-    await db.activities.create_index([("user_id", 1), ("date", -1)])
-    await db.daily_xp.create_index([("user_id", 1), ("date", 1)], unique=True)
-    await db.user_sessions.create_index("session_token")
-    await db.friends.create_index("request_id", unique=True)
-    await db.clans.create_index("clan_id", unique=True)
-    logger.info("Database indexes created")
+    await migrate(db, MIGRATIONS)
+    await token_denylist.sync()
+    app.state.denylist_sync = asyncio.create_task(denylist_sync_loop())
+    await get_leaderboard()
+    app.state.leaderboard_sync = asyncio.create_task(leaderboard_sync_loop())
+    app.state.rollover = asyncio.create_task(rollover_loop())
+    for counter in WRITE_BEHIND_COUNTERS:
+        counter.start()
+    push_hub.start()
+    oauth_client.start()
 
 app.include_router(api_router)
 
+# Read-heavy GETs get an ETag and answer If-None-Match with 304; compression wraps it,
+# so the ETag is computed on the identity body and is weak across encodings.
+ETAG_ROUTES = ["/api/shop", "/api/badges", "/api/profile/{user_id}", "/api/dashboard",
+               "/api/rankings/global", "/api/rankings/global/around-me", "/api/rankings/streak",
+               "/api/rankings/friends", "/api/rankings/clans", "/api/clans"]
+app.add_middleware(ConditionalGetMiddleware, routes=ETAG_ROUTES)
+app.add_middleware(CompressionMiddleware,
+                   minimum_size=int(os.environ.get("COMPRESSION_MIN_SIZE", "1024")))
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
+app.add_middleware(MetricsMiddleware, registry=metrics_registry,
+                   server_timing=os.environ.get("METRICS_SERVER_TIMING", "0") == "1")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.denylist_sync.cancel()
+    app.state.leaderboard_sync.cancel()
+    app.state.rollover.cancel()
+    await push_hub.close()
+    await oauth_client.close()
+    for counter in WRITE_BEHIND_COUNTERS:
+        await counter.close()
     client.close()
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+# The backend is a flat set of modules run from backend/; tests import them the same way.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test")
+
+import query_budget  # noqa: E402
+from tests import mongomock_shims  # noqa: E402
+
+# Both must be in place before server creates its client.
+query_budget.install()
+mongomock_shims.install()
+
+import fake_oauth  # noqa: E402
+import server  # noqa: E402
+from leaderboard import DailyLeaderboard  # noqa: E402
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+from oauth_client import OAuthSessionClient  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def use_database(monkeypatch, client, bucket_class=mongomock_shims.AsyncGridFSBucket):
+    # Points server and everything that captured its db at import onto `client`.
+    db = client[os.environ["DB_NAME"]]
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", db)
+    for counter in server.WRITE_BEHIND_COUNTERS:
+        monkeypatch.setattr(counter, "collection", db[counter.collection.name])
+        monkeypatch.setattr(counter, "_flush_lock", asyncio.Lock())
+    monkeypatch.setattr(server.media_store, "files", db["media.files"])
+    monkeypatch.setattr(server.media_store, "chunks", db["media.chunks"])
+    monkeypatch.setattr(server.media_store, "bucket", bucket_class(db, bucket_name="media"))
+    return db
+
+
+@pytest.fixture
+async def app(monkeypatch):
+    # server.app started against a fresh in-memory database, with per-process state
+    # (caches, leaderboard, locks bound to an event loop) reset for every test.
+    use_database(monkeypatch, AsyncMongoMockClient())
+    monkeypatch.setattr(server, "session_cache", server.SessionCache(max_size=1000, ttl=30))
+    monkeypatch.setattr(server, "response_cache", server.ResponseCache(ttl=5, stale_ttl=30))
+    monkeypatch.setattr(server, "daily_leaderboard", DailyLeaderboard())
+    monkeypatch.setattr(server, "leaderboard_lock", asyncio.Lock())
+    monkeypatch.setattr(server, "oauth_client", OAuthSessionClient(
+        transport=httpx.ASGITransport(app=fake_oauth.app)))
+    await server.app.router.startup()
+    try:
+        yield server
+    finally:
+        await server.app.router.shutdown()
+
+
+@pytest.fixture
+async def http(app):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://test") as client:
+        yield client
+
+
+@pytest.fixture
+def query_budget_guard(app):
+    # Non-strict so a test sees every violation at once; they are asserted at teardown.
+    guard = query_budget.QueryBudgetGuard(app.app, strict=False)
+    yield guard
+    assert not guard.violations, "\n".join(guard.violations)
+
+
+@pytest.fixture
+async def budget_http(app, query_budget_guard):
+    # query_budget's seed data, signed in as its main user, with every request guarded.
+    await query_budget.seed(app.db, app.get_today_str())
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=query_budget_guard), base_url="http://test",
+                                 cookies={"session_token": "qb_token"}) as client:
+        yield client
@@ -0,0 +1,236 @@
+import asyncio
+import functools
+import inspect
+import threading
+from datetime import datetime, timedelta
+
+import gridfs
+import mongomock
+import mongomock.gridfs
+import mongomock_motor
+from mongomock import aggregate, filtering
+from pymongo.results import UpdateResult
+
+import query_budget
+
+# mongomock lacks a few things the server relies on: the $unionWith/$merge stages,
+# $lookup sub-pipelines, $substrCP/$dateFromString/$dateTrunc, update arrayFilters,
+# findAndModify whose update falsifies its filter and an async GridFS bucket. These shims
+# cover exactly the shapes server.py uses, and map mongomock calls onto server commands so
+# query budgets can be counted without a mongod.
+
+# ── Command counting ──
+MONGOMOCK_COMMANDS = {
+    "find": "find", "find_one": "find", "aggregate": "aggregate",
+    "count_documents": "aggregate", "distinct": "distinct",
+    "insert_one": "insert", "insert_many": "insert",
+    "update_one": "update", "update_many": "update", "replace_one": "update",
+    "bulk_write": "update", "delete_one": "delete", "delete_many": "delete",
+    "find_one_and_update": "findAndModify", "find_one_and_replace": "findAndModify",
+    "find_one_and_delete": "findAndModify",
+}
+_depth = threading.local()
+
+
+def _count_commands():
+    Collection = mongomock.collection.Collection
+    for method_name, command_name in MONGOMOCK_COMMANDS.items():
+        original = getattr(Collection, method_name)
+
+        def wrapper(self, *args, _original=original, _command=command_name, **kwargs):
+            # Only the outermost call is a command; shims and nested lookups are not.
+            log = query_budget.current_log.get()
+            depth = getattr(_depth, "value", 0)
+            if log is not None and depth == 0:
+                query = args[0] if args else kwargs.get("filter", kwargs.get("pipeline"))
+                if _command == "aggregate" and isinstance(query, list):
+                    query = (query or [{}])[0].get("$match")
+                log.add(query_budget.query_shape(_command, self.name, query if isinstance(query, dict) else None))
+            _depth.value = depth + 1
+            try:
+                return _original(self, *args, **kwargs)
+            finally:
+                _depth.value = depth
+
+        setattr(Collection, method_name, functools.wraps(original)(wrapper))
+
+
+# ── Scheduling ──
+def _yield_on_io():
+    # mongomock-motor runs every call to completion without suspending. A real driver
+    # round-trip suspends the caller, so concurrent requests interleave between commands;
+    # tests of races rely on that.
+    for cls in (mongomock_motor.AsyncMongoMockCollection, mongomock_motor.AsyncCursor,
+                mongomock_motor.AsyncCommandCursor, mongomock_motor.AsyncLatentCommandCursor):
+        for name, method in inspect.getmembers(cls, inspect.iscoroutinefunction):
+            if name.startswith("_"):
+                continue
+
+            async def wrapper(self, *args, _method=method, **kwargs):
+                await asyncio.sleep(0)
+                return await _method(self, *args, **kwargs)
+
+            setattr(cls, name, functools.wraps(method)(wrapper))
+
+
+# ── Aggregation ──
+def _union_with(in_collection, database, options):
+    if isinstance(options, str):
+        options = {"coll": options}
+    other = database.get_collection(options["coll"]).aggregate(options.get("pipeline", []))
+    return list(in_collection) + list(other)
+
+
+def _merge(in_collection, database, options):
+    target = database.get_collection(options["into"] if isinstance(options, dict) else options)
+    on = options.get("on", "_id")
+    on = [on] if isinstance(on, str) else on
+    when_matched = options.get("whenMatched", "merge")
+    for doc in in_collection:
+        key = {field: doc.get(field) for field in on}
+        if target.find_one(key) is None:
+            if options.get("whenNotMatched", "insert") == "insert":
+                target.insert_one(dict(doc))
+        elif when_matched == "merge":
+            target.update_one(key, {"$set": {k: v for k, v in doc.items() if k != "_id"}})
+        elif isinstance(when_matched, list):
+            for stage in when_matched:
+                values = {k: doc.get(v[len("$$new."):]) if isinstance(v, str) and v.startswith("$$new.") else v
+                          for k, v in stage["$set"].items()}
+                target.update_one(key, {"$set": values})
+    return []
+
+
+_lookup = aggregate._handle_lookup_stage
+
+
+def _lookup_with_pipeline(in_collection, database, options):
+    pipeline = options.get("pipeline")
+    out = _lookup(in_collection, database, {k: v for k, v in options.items() if k != "pipeline"})
+    if pipeline:
+        for doc in out:
+            doc[options["as"]] = list(aggregate.process_pipeline(doc[options["as"]], database, pipeline, None))
+    return out
+
+
+def _expressions():
+    Parser = aggregate._Parser
+    string_operator = Parser._handle_string_operator
+    date_operator = Parser._handle_date_operator
+
+    def handle_string(self, operator, values):
+        if operator == "$substrCP":
+            string, start, length = self.parse_many(values)
+            return (string or "")[start:start + length]
+        return string_operator(self, operator, values)
+
+    def handle_date(self, operator, values):
+        if operator == "$dateFromString":
+            return datetime.fromisoformat(self.parse(values["dateString"]))
+        if operator == "$dateTrunc":
+            date = self.parse(values["date"]).replace(hour=0, minute=0, second=0, microsecond=0)
+            if values["unit"] == "week":
+                first = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday",
+                         "sunday"].index(values.get("startOfWeek", "sunday").lower())
+                return date - timedelta(days=(date.weekday() - first) % 7)
+            if values["unit"] == "month":
+                return date.replace(day=1)
+            return date
+        return date_operator(self, operator, values)
+
+    aggregate.date_operators.append("$dateTrunc")
+    Parser._handle_string_operator = handle_string
+    Parser._handle_date_operator = handle_date
+
+
+# ── findAndModify ──
+def _find_and_modify_by_id():
+    # mongomock re-reads the AFTER document by _id only when the projection keeps _id;
+    # otherwise it re-runs the filter, which the update itself may have made false.
+    Collection = mongomock.collection.Collection
+    find_and_modify = Collection._find_and_modify
+
+    def wrapper(self, query, projection=None, *args, **kwargs):
+        if not isinstance(projection, dict) or projection.get("_id", 1):
+            return find_and_modify(self, query, projection, *args, **kwargs)
+        doc = find_and_modify(self, query, {k: v for k, v in projection.items() if k != "_id"} or None,
+                              *args, **kwargs)
+        if doc is not None:
+            doc.pop("_id", None)
+        return doc
+
+    Collection._find_and_modify = wrapper
+
+
+# ── arrayFilters ──
+def _array_filters():
+    Collection = mongomock.collection.Collection
+    update_one = Collection.update_one
+
+    def wrapper(self, filter, update, upsert=False, *args, array_filters=None, **kwargs):
+        if not array_filters:
+            return update_one(self, filter, update, upsert, *args, **kwargs)
+        doc = self.find_one(filter)
+        if doc is None:
+            return UpdateResult({"n": 0, "nModified": 0}, True)
+        sets = {}
+        for path, value in update.get("$set", {}).items():
+            field, identifier, sub = path.split(".", 2)
+            name = identifier[2:-1]
+            condition = next(f for f in array_filters if all(k.startswith(name + ".") for k in f))
+            condition = {k[len(name) + 1:]: v for k, v in condition.items()}
+            items = [dict(item) for item in doc.get(field, [])]
+            for item in items:
+                if filtering.filter_applies(condition, item):
+                    item[sub] = value
+            sets[field] = items
+        if all(sets[f] == doc.get(f) for f in sets):
+            return UpdateResult({"n": 1, "nModified": 0}, True)
+        return update_one(self, {"_id": doc["_id"]}, {"$set": sets})
+
+    Collection.update_one = wrapper
+
+
+# ── GridFS ──
+class _GridOut:
+    def __init__(self, grid_out):
+        self._grid_out = grid_out
+
+    def __getattr__(self, name):
+        return getattr(self._grid_out, name)
+
+    async def read(self, size: int = -1) -> bytes:
+        return self._grid_out.read(size)
+
+
+class AsyncGridFSBucket:
+    # The subset of AsyncIOMotorGridFSBucket that MediaStore uses, over mongomock's sync GridFS.
+    def __init__(self, async_db, bucket_name: str = "media"):
+        self._bucket = gridfs.GridFSBucket(async_db._AsyncMongoMockDatabase__database, bucket_name=bucket_name)
+
+    async def upload_from_stream_with_id(self, *args, **kwargs):
+        return self._bucket.upload_from_stream_with_id(*args, **kwargs)
+
+    async def open_download_stream(self, file_id):
+        return _GridOut(self._bucket.open_download_stream(file_id))
+
+
+_installed = False
+
+
+def install():
+    global _installed
+    if _installed:
+        return
+    aggregate._PIPELINE_HANDLERS.update({"$unionWith": _union_with, "$merge": _merge,
+                                         "$lookup": _lookup_with_pipeline})
+    _expressions()
+    _array_filters()
+    _find_and_modify_by_id()
+    _count_commands()
+    _yield_on_io()
+    # Motor builds its GridFS classes from pymongo's at import; that has to happen before
+    # mongomock swaps them out.
+    import motor.motor_asyncio  # noqa: F401
+    mongomock.gridfs.enable_gridfs_integration()
+    _installed = True
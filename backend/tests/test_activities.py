@@ -0,0 +1,61 @@
+import asyncio
+import base64
+import json
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+PARALLEL = 8
+
+
+async def test_parallel_completes_award_xp_once(app, budget_http):
+    before = await app.db.users.find_one({"user_id": "qb_0"})
+    responses = await asyncio.gather(*(budget_http.post("/api/activities/qb_act_3/complete")
+                                       for _ in range(PARALLEL)))
+    statuses = sorted(r.status_code for r in responses)
+    assert statuses == [200] + [400] * (PARALLEL - 1)
+    xp = next(r.json()["xp_earned"] for r in responses if r.status_code == 200)
+    assert xp > 0
+
+    after = await app.db.users.find_one({"user_id": "qb_0"})
+    assert after["total_xp"] - before["total_xp"] == xp
+    completed = await app.db.activities.count_documents({"user_id": "qb_0", "status": "completed"})
+    assert after["stats"]["completed_activities"] == completed
+    activity = await app.db.activities.find_one({"activity_id": "qb_act_3"})
+    assert activity["status"] == "completed" and activity["xp_earned"] == xp
+    daily = await app.db.daily_xp.find_one({"user_id": "qb_0", "date": app.get_today_str()})
+    assert daily["xp"] == xp
+
+
+async def test_complete_invalidates_each_ranking_once(app, budget_http, monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(app.response_cache, "invalidate", lambda *keys: invalidated.extend(keys))
+    r = await budget_http.post("/api/activities/qb_act_3/complete")
+    assert r.status_code == 200
+    assert sorted(invalidated) == sorted(app.RANKING_CACHE_KEYS)
+
+
+async def test_pages_follow_cursor(app, budget_http):
+    everything = [a["activity_id"] for a in (await budget_http.get("/api/activities")).json()]
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        r = await budget_http.get("/api/activities", params=params)
+        seen += [a["activity_id"] for a in r.json()]
+        cursor = r.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert seen == everything and len(seen) == 6
+
+
+@pytest.mark.parametrize("key", [[{"$ne": None}, "x"], ["2026-01-01", {"$gt": ""}],
+                                 {"created_at": "x", "activity_id": "y"}, ["x"], ["x", "y", "z"], "xy"])
+async def test_malformed_cursor_is_rejected(budget_http, key):
+    cursor = base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+    r = await budget_http.get("/api/activities", params={"cursor": cursor})
+    assert r.status_code == 400 and r.json()["detail"] == "Cursor inválido"
+
+
+async def test_undecodable_cursor_is_rejected(budget_http):
+    r = await budget_http.get("/api/activities", params={"cursor": "not json!"})
+    assert r.status_code == 400
@@ -0,0 +1,44 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+COUNTERS = {"completed_activities": 150, "total_minutes": 900, "max_streak": 40, "level": 60,
+            "weekly_goal_met": True}
+
+
+def test_every_badge_has_a_rule_on_a_known_counter():
+    assert [r["badge_id"] for r in server.BADGE_RULES] == [b["badge_id"] for b in server.BADGE_DEFINITIONS]
+    assert set(server.BADGE_RULES_BY_COUNTER) == {"completed_activities", "total_minutes", "max_streak",
+                                               "level", "weekly_goals"}
+
+
+@pytest.mark.parametrize("changed, expected", [
+    (set(), []),
+    ({"level"}, ["level_10", "level_25", "level_50"]),
+    ({"max_streak"}, ["streak_7", "streak_30"]),
+    ({"completed_activities", "total_minutes"}, ["first_activity", "activities_100", "hours_10"]),
+    ({"weekly_goals"}, ["weekly_goal"]),
+])
+def test_only_rules_on_changed_counters_run(changed, expected):
+    assert sorted(server.evaluate_badges(COUNTERS, changed, set())) == sorted(expected)
+
+
+def test_rules_on_one_counter_run_in_declared_order():
+    assert server.evaluate_badges(COUNTERS, {"level"}, set()) == ["level_10", "level_25", "level_50"]
+
+
+def test_earned_badges_are_not_reawarded():
+    assert server.evaluate_badges(COUNTERS, {"level"}, {"level_10", "level_25"}) == ["level_50"]
+
+
+async def test_completion_skips_rules_on_unchanged_counters(app, budget_http):
+    # qb_0 already qualifies for the streak badges, but a second completion today leaves the
+    # streak unchanged, so their rules must not run.
+    await app.db.users.update_one({"user_id": "qb_0"}, {"$set": {
+        "stats": {"completed_activities": 0, "total_minutes": 0, "max_streak": 40},
+        "streak": 1, "last_activity_date": app.Clock().today}})
+    assert (await budget_http.post("/api/activities/qb_act_3/complete")).status_code == 200
+    badges = {b["badge_id"] for b in (await budget_http.get("/api/badges")).json() if b["earned"]}
+    assert "first_activity" in badges
+    assert not badges & {"streak_7", "streak_30"}
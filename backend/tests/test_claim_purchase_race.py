@@ -0,0 +1,47 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import query_budget
+
+pytestmark = pytest.mark.anyio
+RACE_COPIES = 4
+USERS = [f"qb_{i}" for i in range(4)]
+
+
+async def test_claims_and_purchases_race_without_violations(app, http):
+    # Every user fires each mission claim and each purchase RACE_COPIES times at once.
+    # Duplicates must be rejected: no reward paid twice, no item owned twice, no XP below 0.
+    today = app.Clock().today
+    await query_budget.seed(app.db, app.get_today_str())
+    await app.db.user_sessions.insert_many([
+        {"user_id": user_id, "session_token": f"{user_id}_token",
+         "expires_at": datetime.now(timezone.utc) + timedelta(days=1)} for user_id in USERS])
+    await app.db.missions.insert_many([
+        {"user_id": user_id, "date": today, "missions": app.new_daily_missions({"subjects": ["Matemática"]}),
+         "progress": {"activities": 3, "minutes": 60}} for user_id in USERS])
+    projection = {"_id": 0, "user_id": 1, "total_xp": 1, "inventory": 1}
+    before = {u["user_id"]: u for u in await app.db.users.find({"user_id": {"$in": USERS}}, projection).to_list(None)}
+    prices = {item["item_id"]: item["price"] for item in app.SHOP_ITEMS}
+    paths = [f"/api/missions/{m}/claim" for m in app.DAILY_MISSIONS] + [f"/api/shop/buy/{i}" for i in prices]
+
+    responses = await asyncio.gather(*(
+        http.post(path, headers={"Authorization": f"Bearer {user_id}_token"})
+        for user_id in USERS for path in paths * RACE_COPIES))
+    assert {r.status_code for r in responses} <= {200, 400}
+
+    claimed = {d["user_id"]: sum(m["reward"] for m in d["missions"] if m.get("claimed"))
+               for d in await app.db.missions.find({"user_id": {"$in": USERS}, "date": today}).to_list(None)}
+    assert all(claimed.values())
+    violations, bought = [], 0
+    for u in await app.db.users.find({"user_id": {"$in": USERS}}, projection).to_list(None):
+        old = before[u["user_id"]]
+        new_items = [item for item in u.get("inventory", []) if item not in old.get("inventory", [])]
+        expected = old["total_xp"] + claimed[u["user_id"]] - sum(prices[item] for item in new_items)
+        if u["total_xp"] != expected or u["total_xp"] < 0 or len(set(u["inventory"])) != len(u["inventory"]):
+            violations.append(u["user_id"])
+        bought += len(new_items)
+    assert violations == []
+    # Exactly one copy of every successful claim or purchase got through.
+    assert sum(r.status_code == 200 for r in responses) == len(USERS) * len(app.DAILY_MISSIONS) + bought
@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_parallel_create_clan_charges_once(app, budget_http):
+    await app.db.users.update_one({"user_id": "qb_0"}, {"$set": {"total_xp": 1200}})
+    responses = await asyncio.gather(*(budget_http.post("/api/clans", json={"name": f"Clã {i}"})
+                                       for i in range(5)))
+    assert sorted(r.status_code for r in responses) == [200, 400, 400, 400, 400]
+    user = await app.db.users.find_one({"user_id": "qb_0"})
+    clan = next(r.json() for r in responses if r.status_code == 200)
+    assert user["total_xp"] == 700
+    assert user["clan_id"] == clan["clan_id"]
+    assert await app.db.clans.count_documents({"leader_id": "qb_0"}) == 1
+
+
+async def test_create_clan_needs_xp_at_write_time(app, budget_http):
+    await budget_http.get("/api/auth/me")  # caches the user with 100000 XP
+    await app.db.users.update_one({"user_id": "qb_0"}, {"$set": {"total_xp": 499}})
+    r = await budget_http.post("/api/clans", json={"name": "Sem XP"})
+    assert r.status_code == 400
+    assert (await app.db.users.find_one({"user_id": "qb_0"}))["total_xp"] == 499
+
+
+async def test_duplicate_clan_name_refunds(app, budget_http):
+    r = await budget_http.post("/api/clans", json={"name": "Budget Clan"})
+    assert r.status_code == 400
+    user = await app.db.users.find_one({"user_id": "qb_0"})
+    assert user["total_xp"] == 100000 and user["clan_id"] == ""
+
+
+async def test_join_rechecks_membership_at_write_time(app, budget_http):
+    await budget_http.get("/api/auth/me")  # caches the user outside any clan
+    await app.db.users.update_one({"user_id": "qb_0"}, {"$set": {"clan_id": "clan_elsewhere"}})
+    r = await budget_http.post("/api/clans/qb_clan/join")
+    assert r.status_code == 400
+    assert "qb_0" not in (await app.db.clans.find_one({"clan_id": "qb_clan"}))["members"]
+    assert (await app.db.users.find_one({"user_id": "qb_0"}))["clan_id"] == "clan_elsewhere"
+
+
+async def test_parallel_joins_add_member_once(app, budget_http):
+    responses = await asyncio.gather(*(budget_http.post("/api/clans/qb_clan/join") for _ in range(4)))
+    assert sorted(r.status_code for r in responses) == [200, 400, 400, 400]
+    members = (await app.db.clans.find_one({"clan_id": "qb_clan"}))["members"]
+    assert members.count("qb_0") == 1
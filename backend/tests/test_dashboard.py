@@ -0,0 +1,27 @@
+import pytest
+
+import query_budget
+
+pytestmark = pytest.mark.anyio
+DASHBOARD = ("GET", "/api/dashboard")
+
+
+async def test_dashboard_cold_within_budget(app, budget_http, query_budget_guard):
+    # Cold session cache, a leaderboard rebuild and first-of-day missions and goals.
+    app.daily_leaderboard.date = None
+    r = await budget_http.get("/api/dashboard")
+    assert r.status_code == 200
+    assert query_budget_guard.observed[DASHBOARD] <= query_budget.QUERY_BUDGETS[DASHBOARD]
+    body = r.json()
+    assert len(body["global_top"]) == 10
+    assert len(body["missions"]) == 3
+    assert body["today_activities_count"] == 3
+
+
+async def test_dashboard_warm_is_cheaper(app, budget_http, query_budget_guard):
+    await budget_http.get("/api/dashboard")
+    cold = query_budget_guard.observed[DASHBOARD]
+    query_budget_guard.observed.clear()
+    await budget_http.get("/api/dashboard")
+    # The session, board, missions and goals are cached or already exist now.
+    assert query_budget_guard.observed[DASHBOARD] < cold
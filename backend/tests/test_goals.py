@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_completions_increment_weekly_counters(app, budget_http):
+    before = (await budget_http.get("/api/goals")).json()
+    xp = 0
+    for activity_id in ("qb_act_3", "qb_act_4"):
+        xp += (await budget_http.post(f"/api/activities/{activity_id}/complete")).json()["xp_earned"]
+    after = (await budget_http.get("/api/goals")).json()
+    assert after["xp_progress"] - before["xp_progress"] == xp
+    assert after["minutes_progress"] - before["minutes_progress"] == 60
+    assert after["activities_progress"] - before["activities_progress"] == 2
+
+
+async def test_legacy_doc_is_reconciled_from_history(app, budget_http):
+    # qb_0 completed qb_act_0..2 (30 minutes each) today; a completion from last week and
+    # another user's XP must not leak into this week's counters.
+    week = app.Clock().week
+    today = app.get_today_str()
+    last_week = (datetime.strptime(week, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+    await app.db.daily_xp.insert_one({"user_id": "qb_0", "date": today, "xp": 150})
+    await app.db.activities.insert_one({"activity_id": "qb_old", "user_id": "qb_0", "status": "completed",
+                                        "estimated_time": 45, "date": last_week})
+    # Replaces any doc the startup rollover made, when the test runs on a Monday.
+    await app.db.weekly_goals.replace_one({"user_id": "qb_0", "week": week},
+                                          {"user_id": "qb_0", "week": week, "xp_goal": 800}, upsert=True)
+
+    goals = (await budget_http.get("/api/goals")).json()
+    assert goals == {"xp_goal": 800, "minutes_goal": 120, "activities_goal": 10,
+                     "xp_progress": 150, "minutes_progress": 90, "activities_progress": 3}
+    doc = await app.db.weekly_goals.find_one({"user_id": "qb_0", "week": week})
+    assert doc["progress_version"] == app.WEEKLY_PROGRESS_VERSION
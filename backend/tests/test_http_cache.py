@@ -0,0 +1,74 @@
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from http_cache import CompressionMiddleware
+
+pytestmark = pytest.mark.anyio
+LINE = b'{"rank": 1, "user_id": "user_0123456789", "xp": 1200}\n'
+
+
+async def chunks():
+    for _ in range(50):
+        yield LINE
+
+
+def stream(media_type: str):
+    async def endpoint(request):
+        return StreamingResponse(chunks(), media_type=media_type)
+    return endpoint
+
+
+async def big_json(request):
+    return JSONResponse({"rows": [LINE.decode()] * 50})
+
+
+app = CompressionMiddleware(Starlette(routes=[
+    Route("/events", stream("text/event-stream")),
+    Route("/ndjson", stream("application/x-ndjson")),
+    Route("/text", stream("text/plain")),
+    Route("/json", big_json),
+]))
+
+
+@pytest.fixture
+async def http():
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test",
+                                 headers={"Accept-Encoding": "gzip"}) as client:
+        yield client
+
+
+@pytest.mark.parametrize("path", ["/events", "/text"])
+async def test_streams_outside_allow_list_are_identity(http, path):
+    r = await http.get(path)
+    assert "content-encoding" not in r.headers
+    assert r.content == LINE * 50
+
+
+@pytest.mark.parametrize("path", ["/ndjson", "/json"])
+async def test_ndjson_streams_and_whole_bodies_are_encoded(http, path):
+    r = await http.get(path)
+    assert r.headers["content-encoding"] == "gzip"
+    assert r.num_bytes_downloaded < len(r.content)
+
+
+@pytest.mark.parametrize("path, mutation", [
+    ("/api/shop", ("POST", "/api/shop/buy/frame_basic")),
+    ("/api/rankings/global", ("POST", "/api/activities/qb_act_3/complete")),
+])
+async def test_etag_routes_answer_304_until_changed(app, budget_http, path, mutation):
+    assert path in app.ETAG_ROUTES
+    first = await budget_http.get(path)
+    etag = first.headers["etag"]
+    assert first.status_code == 200 and etag.startswith('W/"')
+
+    again = await budget_http.get(path, headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.content == b""
+    assert again.headers["etag"] == etag
+
+    assert (await budget_http.request(*mutation)).status_code == 200
+    changed = await budget_http.get(path, headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.content
+    assert changed.headers["etag"] != etag
@@ -0,0 +1,46 @@
+import random
+
+import server
+
+
+def iterative_level_info(total_level_xp: int) -> dict:
+    # The loop get_level_info replaced; the closed form must agree with it everywhere.
+    level = 0
+    xp_remaining = total_level_xp
+    while level < 100 and xp_remaining >= (level + 1) * 100:
+        xp_remaining -= (level + 1) * 100
+        level += 1
+    next_level_xp = (level + 1) * 100 if level < 100 else 0
+    rank = "Bronze"
+    if level >= 100:
+        rank = "Platina Lendário"
+    elif level >= 75:
+        rank = "Rubi"
+    elif level >= 50:
+        rank = "Ouro"
+    elif level >= 25:
+        rank = "Prata"
+    return {"level": level, "current_xp": xp_remaining, "next_level_xp": next_level_xp, "rank": rank}
+
+
+def xp_samples():
+    # Every value through the level-100 cap, each threshold's neighbours, and random
+    # values far past the cap.
+    rng = random.Random(6)
+    samples = list(range(-500, server.LEVEL_THRESHOLDS[-1] + 2000))
+    samples += [t + d for t in server.LEVEL_THRESHOLDS for d in (-1, 0, 1)]
+    samples += [rng.randrange(10 ** 9) for _ in range(20000)]
+    return samples
+
+
+def test_closed_form_matches_loop():
+    for xp in xp_samples():
+        assert server.get_level_info(xp) == iterative_level_info(xp), xp
+
+
+def test_batch_matches_loop():
+    samples = xp_samples()
+    batch = server.get_level_info_batch(samples)
+    for i, xp in enumerate(samples):
+        expected = iterative_level_info(xp)
+        assert {key: batch[key][i] for key in expected} == expected, xp
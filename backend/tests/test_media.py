@@ -0,0 +1,59 @@
+import io
+
+import pytest
+from PIL import Image
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def media(app, budget_http):
+    # A 300x200 PNG uploaded as an avatar; yields its id and the stored full-size bytes.
+    png = io.BytesIO()
+    Image.new("RGB", (300, 200), (200, 40, 40)).save(png, "PNG")
+    r = await budget_http.post("/api/media", params={"kind": "avatar"},
+                               files={"file": ("a.png", png.getvalue(), "image/png")})
+    assert r.status_code == 200
+    media_id = r.json()["media_id"]
+    assert r.json()["thumbnail_url"] == f"/api/media/{media_id}/thumb"
+    full = await budget_http.get(f"/api/media/{media_id}")
+    assert full.status_code == 200 and full.headers["content-type"] == "image/webp"
+    yield media_id, full.content
+
+
+async def test_variants_are_fitted_and_cropped(budget_http, media):
+    media_id, full = media
+    assert Image.open(io.BytesIO(full)).size == (300, 200)
+    thumb = await budget_http.get(f"/api/media/{media_id}/thumb")
+    assert thumb.status_code == 200
+    assert Image.open(io.BytesIO(thumb.content)).size == (96, 96)
+    assert (await budget_http.get(f"/api/media/{media_id}/huge")).status_code == 404
+
+
+@pytest.mark.parametrize("header, start, end", [("bytes=0-9", 0, 9), ("bytes=-5", -5, None),
+                                                ("bytes=10-", 10, None)])
+async def test_single_range_is_partial(budget_http, media, header, start, end):
+    media_id, full = media
+    r = await budget_http.get(f"/api/media/{media_id}", headers={"Range": header})
+    expected = full[start:end + 1 if end is not None else None]
+    first = start % len(full)
+    assert r.status_code == 206
+    assert r.content == expected
+    assert r.headers["content-range"] == f"bytes {first}-{first + len(expected) - 1}/{len(full)}"
+    assert r.headers["content-length"] == str(len(expected))
+
+
+async def test_range_past_the_end_is_416(budget_http, media):
+    media_id, full = media
+    r = await budget_http.get(f"/api/media/{media_id}", headers={"Range": f"bytes={len(full)}-"})
+    assert r.status_code == 416
+    assert r.headers["content-range"] == f"bytes */{len(full)}"
+
+
+async def test_stale_if_range_and_revalidation(budget_http, media):
+    media_id, full = media
+    r = await budget_http.get(f"/api/media/{media_id}", headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+    assert r.status_code == 200 and r.content == full
+    etag = r.headers["etag"]
+    r = await budget_http.get(f"/api/media/{media_id}", headers={"If-None-Match": etag})
+    assert r.status_code == 304 and r.content == b""
@@ -0,0 +1,124 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import migrations
+from migrations import Migration, MigrationError, migrate
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # A lock that would expire several times over during one slow migration.
+    monkeypatch.setattr(migrations, "LOCK_TTL", timedelta(seconds=0.1))
+    monkeypatch.setattr(migrations, "LOCK_HEARTBEAT", 0.02)
+    monkeypatch.setattr(migrations, "FOLLOWER_POLL", 0.01)
+    return AsyncMongoMockClient()["migrations"]
+
+
+def slow_migration(applied: list, seconds: float = 0.4):
+    async def apply():
+        applied.append(1)
+        await asyncio.sleep(seconds)
+    return [Migration(1, "slow", apply)]
+
+
+async def test_heartbeat_keeps_lock_through_slow_migration(db):
+    applied = []
+    leader = asyncio.create_task(migrate(db, slow_migration(applied)))
+    await asyncio.sleep(0.05)
+    follower = asyncio.create_task(migrate(db, slow_migration(applied)))
+    assert await asyncio.gather(leader, follower) == [1, 1]
+    assert applied == [1]
+    assert await db.schema_migrations.find_one({"_id": "lock"}) is None
+
+
+async def test_follower_fails_instead_of_continuing(db, monkeypatch):
+    monkeypatch.setattr(migrations, "FOLLOWER_TIMEOUT", 0.1)
+    await db.schema_migrations.insert_one({"_id": "lock", "owner": "elsewhere",
+                                           "expires_at": datetime.now(timezone.utc) + timedelta(hours=1)})
+    with pytest.raises(MigrationError):
+        await migrate(db, slow_migration([]))
+
+
+async def test_follower_takes_over_freed_lock(db):
+    await db.schema_migrations.insert_one({"_id": "lock", "owner": "crashed",
+                                           "expires_at": datetime.now(timezone.utc) + timedelta(seconds=0.1)})
+    applied = []
+    assert await migrate(db, slow_migration(applied, 0)) == 1
+    assert applied == [1]
+
+
+async def test_lost_lock_aborts_migration(db):
+    leader = asyncio.create_task(migrate(db, slow_migration([])))
+    await asyncio.sleep(0.05)
+    await db.schema_migrations.update_one({"_id": "lock"}, {"$set": {"owner": "thief"}})
+    with pytest.raises(MigrationError):
+        await leader
+    assert await migrations.get_schema_version(db) == 0
+
+
+async def test_old_server_refused_before_locking(db, monkeypatch):
+    monkeypatch.setattr(migrations, "MIN_SERVER_VERSION", (99, 0))
+    with pytest.raises(MigrationError, match="99.0 or newer"):
+        await migrate(db, slow_migration([]))
+    assert await db.schema_migrations.count_documents({}) == 0
+
+
+async def test_string_session_expiry_converted_or_deleted(app):
+    now = datetime.now(timezone.utc)
+    live = now + timedelta(days=3)
+    await app.db.user_sessions.insert_many([
+        {"session_token": "live", "user_id": "u", "expires_at": live.isoformat()},
+        {"session_token": "naive", "user_id": "u", "expires_at": live.replace(tzinfo=None).isoformat()},
+        {"session_token": "expired", "user_id": "u", "expires_at": (now - timedelta(days=1)).isoformat()},
+        {"session_token": "garbage", "user_id": "u", "expires_at": "amanhã"},
+        {"session_token": "date", "user_id": "u", "expires_at": live},
+    ])
+    await app.migration_session_expiry_dates()
+    sessions = {s["session_token"]: s["expires_at"] async for s in app.db.user_sessions.find()}
+    assert sorted(sessions) == ["date", "live", "naive"]
+    assert all(isinstance(v, datetime) for v in sessions.values())
+    assert abs(sessions["live"].replace(tzinfo=timezone.utc) - live) < timedelta(seconds=1)
+
+
+# ── Hot query plans ──
+def usable_index(indexes: dict, query: dict) -> bool:
+    # The planner can only avoid a COLLSCAN with an index whose leading field is
+    # constrained by the filter (every $or branch needs one) or, with no filter, sorted on.
+    filter, sort = query["filter"], query.get("sort") or {}
+    leading = {list(spec["key"])[0][0] for spec in indexes.values()}
+    if "$or" in filter:
+        return all(usable_index(indexes, {"filter": branch}) for branch in filter["$or"])
+    return bool(leading & set(filter)) or (not filter and bool(leading & set(sort)))
+
+
+async def test_hot_queries_have_an_index(app):
+    missing = []
+    for q in app.HOT_QUERIES:
+        indexes = await app.db[q["collection"]].index_information()
+        indexes.pop("_id_", None)
+        if not usable_index(indexes, q):
+            missing.append(q["name"])
+    assert missing == []
+
+
+@pytest.mark.skipif(not os.environ.get("MONGO_TEST_URL"), reason="explain needs a real mongod (MONGO_TEST_URL)")
+async def test_explain_hot_queries(monkeypatch):
+    from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+    import server
+    from tests.conftest import use_database
+    monkeypatch.setenv("DB_NAME", f"explain_{os.getpid()}")
+    client = AsyncIOMotorClient(os.environ["MONGO_TEST_URL"])
+    db = use_database(monkeypatch, client, AsyncIOMotorGridFSBucket)
+    try:
+        await migrate(db, server.MIGRATIONS)
+        assert await migrations.explain_hot_queries(db, server.HOT_QUERIES) == []
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from clock import DEFAULT_TIMEZONE
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def today(app, budget_http):
+    # qb_0 has completed qb_act_0..2 (30 minutes each) today and has qb_act_3..5 pending.
+    day = app.Clock().today
+    await app.db.users.update_one({"user_id": "qb_0"}, {"$set": {"last_activity_date": day}})
+    await app.db.missions.delete_many({})
+    return day
+
+
+async def progress(app, day: str) -> dict:
+    doc = await app.db.missions.find_one({"user_id": "qb_0", "date": day})
+    return {**doc["progress"], "counted": sorted(doc["counted"])}
+
+
+async def test_midday_pregeneration_counts_earlier_completions(app, today):
+    await app.pregenerate_daily_missions(DEFAULT_TIMEZONE, app.Clock().local)
+    assert await progress(app, today) == {"activities": 3, "minutes": 90,
+                                          "counted": ["qb_act_0", "qb_act_1", "qb_act_2"]}
+
+
+async def test_completion_without_doc_seeds_it(app, budget_http, today):
+    r = await budget_http.post("/api/activities/qb_act_3/complete")
+    assert r.status_code == 200
+    assert (await progress(app, today))["activities"] == 4
+    missions = (await budget_http.get("/api/missions")).json()
+    assert next(m for m in missions if m["id"] == "m1")["completed"]
+
+
+async def test_seeding_races_completions(app, budget_http, today):
+    # First reads seed the doc while completions land; every completion is counted once.
+    calls = [budget_http.get("/api/missions") for _ in range(3)] + \
+        [budget_http.post(f"/api/activities/qb_act_{i}/complete") for i in (3, 4, 5)]
+    responses = await asyncio.gather(*calls)
+    assert all(r.status_code == 200 for r in responses)
+    assert await progress(app, today) == {"activities": 6, "minutes": 180,
+                                          "counted": [f"qb_act_{i}" for i in range(6)]}
+
+
+async def test_migration_recounts_docs_without_counted(app, today):
+    await app.db.missions.insert_one({"user_id": "qb_0", "date": today, "missions": [],
+                                      "progress": {"activities": 0, "minutes": 0}})
+    await app.migration_missions_counted()
+    assert (await progress(app, today))["activities"] == 3
@@ -0,0 +1,110 @@
+import asyncio
+
+import httpx
+import pytest
+
+from oauth_client import OAuthSessionClient, OAuthUnavailable
+
+pytestmark = pytest.mark.anyio
+
+
+class Upstream:
+    # httpx transport that answers from `respond(session_id)` and records every call.
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls = []
+        self.transport = httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        session_id = request.headers["x-session-id"]
+        self.calls.append(session_id)
+        return await self.respond(session_id)
+
+
+async def ok(session_id):
+    return httpx.Response(200, json={"email": f"{session_id}@test", "name": "", "picture": ""})
+
+
+async def test_one_client_and_one_exchange_per_session_id():
+    upstream = Upstream(ok)
+    oauth = OAuthSessionClient(url="http://oauth/session", transport=upstream.transport)
+    oauth.start()
+    client = oauth.client
+    results = await asyncio.gather(*(oauth.session_data("s1") for _ in range(5)))
+    assert results == [{"email": "s1@test", "name": "", "picture": ""}] * 5
+    assert await oauth.session_data("s1") == results[0]
+    await oauth.session_data("s2")
+    assert upstream.calls == ["s1", "s2"]
+    assert oauth.client is client
+    assert oauth.stats()["hits"] == 1
+    await oauth.close()
+
+
+async def test_timeout_is_not_retried():
+    async def slow(session_id):
+        raise httpx.ReadTimeout("read timed out")
+
+    upstream = Upstream(slow)
+    oauth = OAuthSessionClient(url="http://oauth/session", transport=upstream.transport, retries=2)
+    with pytest.raises(OAuthUnavailable, match="timed out"):
+        await oauth.session_data("s1")
+    assert upstream.calls == ["s1"]
+    await oauth.close()
+
+
+async def test_connection_error_is_retried():
+    async def flaky(session_id):
+        if len(upstream.calls) == 1:
+            raise httpx.RemoteProtocolError("keep-alive socket closed by peer")
+        return await ok(session_id)
+
+    upstream = Upstream(flaky)
+    oauth = OAuthSessionClient(url="http://oauth/session", transport=upstream.transport, retries=1)
+    assert (await oauth.session_data("s1"))["email"] == "s1@test"
+    assert upstream.calls == ["s1", "s1"]
+    await oauth.close()
+
+
+async def test_full_queue_is_rejected_after_queue_timeout():
+    release = asyncio.Event()
+
+    async def held(session_id):
+        await release.wait()
+        return await ok(session_id)
+
+    oauth = OAuthSessionClient(url="http://oauth/session", transport=Upstream(held).transport,
+                               max_concurrency=1, queue_timeout=0.05)
+    first = asyncio.create_task(oauth.session_data("s1"))
+    await asyncio.sleep(0.01)
+    with pytest.raises(OAuthUnavailable):
+        await oauth.session_data("s2")
+    release.set()
+    assert (await first)["email"] == "s1@test"
+    assert oauth.stats()["rejected"] == 1
+    await oauth.close()
+
+
+async def test_rejected_ids_are_not_cached():
+    async def reject(session_id):
+        return httpx.Response(401)
+
+    upstream = Upstream(reject)
+    oauth = OAuthSessionClient(url="http://oauth/session", transport=upstream.transport)
+    assert await oauth.session_data("s1") is None
+    assert await oauth.session_data("s1") is None
+    assert upstream.calls == ["s1", "s1"]
+    await oauth.close()
+
+
+async def test_login_reuses_the_started_client_and_maps_timeouts_to_503(app, http, monkeypatch):
+    client = app.oauth_client.client
+    assert client is not None
+    assert (await http.post("/api/auth/session", json={"session_id": "qb_1_login"})).status_code == 200
+    assert app.oauth_client.client is client
+
+    async def slow(session_id):
+        raise httpx.ConnectTimeout("connect timed out")
+
+    monkeypatch.setattr(app, "oauth_client", OAuthSessionClient(transport=Upstream(slow).transport))
+    r = await http.post("/api/auth/session", json={"session_id": "qb_2_login"})
+    assert r.status_code == 503
@@ -0,0 +1,20 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+PROFILE = {"city": "Recife", "school": "Escola", "grade": "3º ano", "subjects": ["Matemática"]}
+
+
+@pytest.mark.parametrize("name", ["     ", "\u0301" * 3])
+async def test_name_without_key_is_rejected(app, budget_http, name):
+    # Both would be stored with display_name_key "", which then collides for every later user.
+    r = await budget_http.post("/api/onboarding", json={"display_name": name, **PROFILE})
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Nome de exibição inválido"
+    user = await app.db.users.find_one({"user_id": "qb_0"})
+    assert user["display_name"] == "Budget 0" and user["display_name_key"] == "budget 0"
+
+
+async def test_onboarding_stores_name_key(app, budget_http):
+    r = await budget_http.post("/api/onboarding", json={"display_name": "  Zé  DA Silva", **PROFILE})
+    assert r.status_code == 200
+    assert r.json()["display_name_key"] == "ze da silva"
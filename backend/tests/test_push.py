@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import query_budget
+from push import PushHub, Subscriber
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_stream_is_not_compressed(app):
+    # Drives /api/stream through the full middleware stack until its first event, then
+    # disconnects; httpx's ASGI transport would wait for the (endless) body.
+    await query_budget.seed(app.db, app.get_today_str())
+    disconnected = asyncio.Event()
+    requested = []
+    messages = []
+
+    async def receive():
+        if not requested:
+            requested.append(True)
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.body" and message.get("body"):
+            disconnected.set()
+
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": "/api/stream", "raw_path": b"/api/stream", "query_string": b"",
+             "root_path": "", "server": ("test", 80), "client": ("127.0.0.1", 1234),
+             "headers": [(b"host", b"test"), (b"accept-encoding", b"gzip, br"),
+                         (b"cookie", b"session_token=qb_token")]}
+    await asyncio.wait_for(app.app(scope, receive, send), 5)
+
+    start = messages[0]
+    headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    assert start["status"] == 200
+    assert headers["content-type"].startswith("text/event-stream")
+    assert "content-encoding" not in headers
+    assert messages[1]["body"].startswith(b"event: ")
+
+
+class Board:
+    def __init__(self, users: int):
+        self.scores = {f"u{i}": users - i for i in range(users)}
+
+    def top(self, n):
+        return [{"user_id": u, "xp": xp} for u, xp in list(self.scores.items())[:n]]
+
+    def rank(self, user_id):
+        return list(self.scores).index(user_id) + 1 if user_id in self.scores else 0
+
+    def score(self, user_id):
+        return self.scores.get(user_id)
+
+
+async def test_tick_yields_between_chunks():
+    board = Board(50)
+
+    async def get_board():
+        return board
+
+    hub = PushHub(get_board, None, top_n=5, chunk_size=100)
+    subs = [Subscriber(f"u{i % 50}", "u0", "") for i in range(1000)]
+    hub._subscribers.update(subs)
+    hub.notify_leaderboard()
+
+    turns = 0
+
+    async def other_work():
+        nonlocal turns
+        while True:
+            turns += 1
+            await asyncio.sleep(0)
+
+    other = asyncio.create_task(other_work())
+    await asyncio.sleep(0)
+    before = turns
+    await hub.tick()
+    other.cancel()
+    assert turns - before >= 9
+    assert all(sub.pending.get("top") for sub in subs)
+    assert all(sub.pending["rank"] == {"position": board.rank(sub.user_id), "xp": board.score(sub.user_id)}
+               for sub in subs)
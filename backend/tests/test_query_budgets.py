@@ -0,0 +1,47 @@
+import httpx
+import pytest
+
+import query_budget
+from leaderboard import DailyLeaderboard
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_every_route_has_a_budget(app):
+    assert query_budget.undeclared_routes(app.app) == []
+
+
+async def test_budget_scenario(app, budget_http):
+    for method, path, body in query_budget.budget_scenario():
+        app.session_cache.invalidate_token("qb_token")
+        r = await budget_http.request(method, path, json=body)
+        assert r.status_code < 400, f"{method} {path}: HTTP {r.status_code} {r.text[:120]}"
+
+
+FLAT_ROUTES = ["/api/dashboard", "/api/rankings/friends", "/api/rankings/friends?period=month",
+               "/api/rankings/clans", "/api/rankings/clans?period=week", "/api/clans/qb_clan"]
+
+
+async def commands_per_route(app, monkeypatch, friends: int) -> dict:
+    # A fresh seed and cold per-process caches for each size, so only the data differs.
+    for name in await app.db.list_collection_names():
+        if name not in ("schema_migrations", "shop_items"):
+            await app.db[name].delete_many({})
+    monkeypatch.setattr(app, "response_cache", app.ResponseCache(ttl=5, stale_ttl=30))
+    monkeypatch.setattr(app, "daily_leaderboard", DailyLeaderboard())
+    await query_budget.seed(app.db, app.get_today_str(), friends=friends)
+    counts = {}
+    for path in FLAT_ROUTES:
+        guard = query_budget.QueryBudgetGuard(app.app, strict=False)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=guard), base_url="http://test",
+                                     cookies={"session_token": "qb_token"}) as http:
+            app.session_cache.invalidate_token("qb_token")
+            assert (await http.get(path)).status_code == 200
+        counts[path], = guard.observed.values()
+    return counts
+
+
+async def test_command_count_does_not_grow_with_friends_and_members(app, monkeypatch):
+    small = await commands_per_route(app, monkeypatch, friends=3)
+    large = await commands_per_route(app, monkeypatch, friends=30)
+    assert large == small
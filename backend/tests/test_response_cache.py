@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from server import ResponseCache
+
+pytestmark = pytest.mark.anyio
+
+
+class Loader:
+    # Returns "v1", "v2", ... and holds each load until `release` is set.
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self):
+        self.calls += 1
+        value = f"v{self.calls}"
+        await self.release.wait()
+        return value
+
+
+async def test_concurrent_misses_share_one_load():
+    cache, loader = ResponseCache(ttl=5, stale_ttl=30), Loader()
+    loader.release.clear()
+    waiters = [asyncio.create_task(cache.get("k", loader)) for _ in range(10)]
+    await asyncio.sleep(0)
+    loader.release.set()
+    assert await asyncio.gather(*waiters) == ["v1"] * 10
+    assert loader.calls == 1
+    assert cache.stats()["misses"] == 1 and cache.stats()["coalesced"] == 9
+
+
+async def test_stale_entry_is_served_while_one_refresh_runs():
+    cache, loader = ResponseCache(ttl=0.01, stale_ttl=30), Loader()
+    assert await cache.get("k", loader) == "v1"
+    await asyncio.sleep(0.02)
+    loader.release.clear()
+    # Expired: every reader gets the old value at once, and only the first starts a refresh.
+    assert [await cache.get("k", loader) for _ in range(5)] == ["v1"] * 5
+    await asyncio.sleep(0)
+    assert loader.calls == 2
+    loader.release.set()
+    await asyncio.sleep(0)
+    assert await cache.get("k", loader) == "v2"
+    assert cache.stats()["stale_hits"] == 5
+
+
+async def test_invalidation_during_load_discards_the_result():
+    cache, loader = ResponseCache(ttl=5, stale_ttl=30), Loader()
+    loader.release.clear()
+    first = asyncio.create_task(cache.get("k", loader))
+    await asyncio.sleep(0)
+    cache.invalidate("k")
+    loader.release.set()
+    assert await first == "v1"
+    assert await cache.get("k", loader) == "v2"
+
+
+async def test_failed_load_reaches_every_waiter_and_is_not_cached():
+    cache, calls = ResponseCache(ttl=5, stale_ttl=30), []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0)
+        raise RuntimeError("mongo down")
+
+    results = await asyncio.gather(*(cache.get("k", failing) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results) and len(calls) == 1
+    with pytest.raises(RuntimeError):
+        await cache.get("k", failing)
+    assert len(calls) == 2 and cache.stats()["load_errors"] == 2
@@ -0,0 +1,60 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from clock import day_keys
+
+pytestmark = pytest.mark.anyio
+NOW = datetime(2026, 3, 2, 2, 30, tzinfo=timezone.utc)
+
+
+def test_day_keys_follow_each_zone():
+    sp, tokyo = day_keys("America/Sao_Paulo", NOW), day_keys("Asia/Tokyo", NOW)
+    assert (sp.today, sp.yesterday, sp.week, sp.month) == ("2026-03-01", "2026-02-28", "2026-02-23", "2026-03")
+    assert sp.last_7 == tuple(f"2026-02-{d}" for d in range(23, 29)) + ("2026-03-01",)
+    assert (sp.starts_at, sp.ends_at) == (datetime(2026, 3, 1, 3, tzinfo=timezone.utc),
+                                          datetime(2026, 3, 2, 3, tzinfo=timezone.utc))
+    assert (tokyo.today, tokyo.week) == ("2026-03-02", "2026-03-02")
+    assert tokyo.starts_at == datetime(2026, 3, 1, 15, tzinfo=timezone.utc)
+
+
+def test_day_keys_are_reused_within_the_day_and_span_dst():
+    keys = day_keys("America/New_York", datetime(2026, 3, 8, 12, tzinfo=timezone.utc))
+    assert keys.ends_at - keys.starts_at == timedelta(hours=23)  # spring forward
+    assert day_keys("America/New_York", keys.ends_at - timedelta(seconds=1)) is keys
+    assert day_keys("America/New_York", keys.ends_at).today == "2026-03-09"
+
+
+async def test_rollover_runs_once_per_zone_and_day(app, monkeypatch):
+    runs = []
+
+    async def step(tz_name, keys):
+        runs.append((tz_name, keys.today))
+        await asyncio.sleep(0.01)
+
+    monkeypatch.setattr(app, "ROLLOVER_STEPS", [step])
+    sp, tokyo = day_keys("America/Sao_Paulo", NOW), day_keys("Asia/Tokyo", NOW)
+    await asyncio.gather(*(app.run_rollover(tz, keys) for tz, keys in [("America/Sao_Paulo", sp)] * 3
+                           + [("Asia/Tokyo", tokyo)] * 3))
+    await app.run_rollover("America/Sao_Paulo", sp)
+    assert sorted(runs) == [("America/Sao_Paulo", "2026-03-01"), ("Asia/Tokyo", "2026-03-02")]
+    job = await app.db.scheduled_jobs.find_one({"_id": "rollover:Asia/Tokyo:2026-03-02"})
+    assert "finished_at" in job
+
+
+async def test_failed_rollover_releases_its_claim(app, monkeypatch):
+    runs = []
+
+    async def step(tz_name, keys):
+        runs.append(keys.today)
+        if len(runs) == 1:
+            raise RuntimeError("mongo down")
+
+    monkeypatch.setattr(app, "ROLLOVER_STEPS", [step])
+    keys = day_keys("Asia/Tokyo", NOW)
+    with pytest.raises(RuntimeError):
+        await app.run_rollover("Asia/Tokyo", keys)
+    assert await app.db.scheduled_jobs.find_one({"_id": "rollover:Asia/Tokyo:2026-03-02"}) is None
+    await app.run_rollover("Asia/Tokyo", keys)
+    assert runs == ["2026-03-02", "2026-03-02"]
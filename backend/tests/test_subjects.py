@@ -0,0 +1,25 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def stored_subjects(app) -> list:
+    return (await app.db.users.find_one({"user_id": "qb_0"}))["subjects"]
+
+
+async def test_add_keeps_subjects_changed_by_another_worker(app, budget_http):
+    await budget_http.get("/api/auth/me")  # caches subjects == ["Matemática"]
+    await app.db.users.update_one({"user_id": "qb_0"}, {"$push": {"subjects": "Física"}})
+    r = await budget_http.post("/api/subjects", json={"name": "Química"})
+    assert r.json() == {"subjects": ["Matemática", "Física", "Química"]}
+    assert await stored_subjects(app) == ["Matemática", "Física", "Química"]
+    r = await budget_http.post("/api/subjects", json={"name": "Física"})
+    assert r.status_code == 400
+
+
+async def test_remove_keeps_subjects_changed_by_another_worker(app, budget_http):
+    await budget_http.get("/api/auth/me")
+    await app.db.users.update_one({"user_id": "qb_0"}, {"$push": {"subjects": "Física"}})
+    r = await budget_http.delete("/api/subjects/Matemática")
+    assert r.json() == {"subjects": ["Física"]}
+    assert await stored_subjects(app) == ["Física"]
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from write_behind import OPS_FIELD, WriteBehindCounter
+
+pytestmark = pytest.mark.anyio
+KEYS = 20
+INCREMENTS = 50
+
+
+class FlakyCollection:
+    # Fails chosen bulk_write calls: "after" applies the batch and then loses the reply,
+    # "partial" applies every other op and reports the rest as failed.
+    def __init__(self, collection, failures):
+        self.collection = collection
+        self.failures = list(failures)
+        self.name = collection.name
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    async def bulk_write(self, requests, ordered=True):
+        failure = self.failures.pop(0) if self.failures else None
+        if failure == "partial":
+            for op in requests[::2]:
+                await self.collection.bulk_write([op])
+            raise BulkWriteError({"writeErrors": [{"index": i, "code": 91, "errmsg": "shutdown"}
+                                                  for i in range(1, len(requests), 2)]})
+        result = await self.collection.bulk_write(requests, ordered=ordered)
+        if failure == "after":
+            raise AutoReconnect("connection reset")
+        return result
+
+
+@pytest.fixture
+async def collection():
+    db = AsyncMongoMockClient()["write_behind"]
+    await db.counters.create_index("key", unique=True)
+    return db.counters
+
+
+async def increment_all(counter: WriteBehindCounter):
+    async def worker(k):
+        for _ in range(INCREMENTS):
+            await counter.increment({"key": k}, {"n": 1})
+            await asyncio.sleep(0)
+    await asyncio.gather(*(worker(k) for k in range(KEYS)))
+
+
+async def totals(collection) -> dict:
+    return {d["key"]: d["n"] for d in await collection.find({}).to_list(None)}
+
+
+@pytest.mark.parametrize("failures", [[], ["after"], ["partial"], ["after", "partial", "after"]])
+async def test_no_lost_or_doubled_increments(collection, failures):
+    counter = WriteBehindCounter("test", FlakyCollection(collection, failures), flush_interval=0.001,
+                                 max_keys=7, upsert=True)
+    counter.start()
+    await increment_all(counter)
+    await counter.close()
+    assert await totals(collection) == {k: INCREMENTS for k in range(KEYS)}
+    assert counter.metrics()["queue_depth"] == 0
+
+
+async def test_retry_of_applied_upsert_is_skipped(collection):
+    counter = WriteBehindCounter("test", FlakyCollection(collection, ["after"]), flush_interval=60, upsert=True)
+    await counter.increment({"key": 1}, {"n": 5})
+    with pytest.raises(AutoReconnect):
+        await counter.flush()
+    await counter.increment({"key": 1}, {"n": 2})
+    await counter.flush()
+    doc = await collection.find_one({"key": 1})
+    assert doc["n"] == 7
+    assert len(doc[OPS_FIELD]) == 2
+
+
+async def test_interrupted_flush_keeps_batch(collection):
+    class HangingCollection(FlakyCollection):
+        # Applies the batch, then never replies.
+        async def bulk_write(self, requests, ordered=True):
+            await self.collection.bulk_write(requests, ordered=ordered)
+            await asyncio.Event().wait()
+
+    counter = WriteBehindCounter("test", HangingCollection(collection, []), flush_interval=60, upsert=True)
+    await counter.increment({"key": 1}, {"n": 3})
+    flush = asyncio.create_task(counter.flush())
+    await asyncio.sleep(0.01)
+    flush.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await flush
+    assert counter.metrics()["pending_increments"] == 1
+    counter.collection = collection
+    await counter.flush()
+    assert await totals(collection) == {1: 3}
+
+
+async def test_close_waits_for_running_flush(collection):
+    class SlowCollection(FlakyCollection):
+        async def bulk_write(self, requests, ordered=True):
+            await asyncio.sleep(0.05)
+            return await self.collection.bulk_write(requests, ordered=ordered)
+
+    counter = WriteBehindCounter("test", SlowCollection(collection, []), flush_interval=0.001, upsert=True)
+    counter.start()
+    await counter.increment({"key": 1}, {"n": 4})
+    await asyncio.sleep(0.01)  # the loop is now inside bulk_write
+    await counter.close()
+    assert await totals(collection) == {1: 4}
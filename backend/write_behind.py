@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+# Every buffered write stamps its batch id onto the document it updates and skips
+# documents that already carry it, so re-sending a batch that may have partly applied
+# does not count anything twice. Readers returning counter documents should project
+# OPS_FIELD out.
+OPS_FIELD = "_write_ops"
+OPS_HISTORY = 32
+
+
+class WriteBehindCounter:
+    # Coalesces $inc updates per document key and writes them as one unordered
+    # bulk_write every `flush_interval` seconds, or as soon as `max_keys` distinct
+    # documents are pending. With flush_interval <= 0 every increment is written
+    # straight through. A batch that fails, or is interrupted, is kept as is and re-sent
+    # under the same id before anything newer, so an increment is only dropped once Mongo
+    # has acknowledged it and never applied twice. `on_write` runs after increments have
+    # reached Mongo, e.g. to invalidate caches derived from the totals.
+    def __init__(self, name: str, collection, flush_interval: float, max_keys: int = 500,
+                 upsert: bool = False, on_write: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.upsert = upsert
+        self.on_write = on_write
+        self._pending: Dict[tuple, dict] = {}
+        self._oldest: Optional[float] = None
+        # (batch id, entries, buffered since) of a batch not yet acknowledged.
+        self._unacked: Optional[Tuple[str, List[dict], float]] = None
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self.flushes = 0
+        self.flushed_ops = 0
+        self.failures = 0
+        self.last_flush_seconds = 0.0
+
+    @property
+    def synchronous(self) -> bool:
+        return self.flush_interval <= 0
+
+    async def increment(self, key: dict, inc: dict, set_fields: Optional[dict] = None) -> Optional[dict]:
+        if self.synchronous:
+            doc = await self.collection.find_one_and_update(
+                key, self._update(inc, set_fields), projection={"_id": 0},
+                upsert=self.upsert, return_document=ReturnDocument.AFTER)
+            self._written()
+            return doc
+        self._merge(key, inc, set_fields)
+        if len(self._pending) >= self.max_keys:
+            try:
+                await self.flush()
+            except Exception:
+                # The increment is already buffered and a failed batch is kept for retry.
+                logger.exception(f"Write-behind {self.name} flush failed")
+        return None
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self._unacked is None and not self._pending:
+                return
+            # An unacknowledged batch goes first, then whatever was buffered meanwhile.
+            while self._unacked is not None or self._pending:
+                if self._unacked is None:
+                    self._unacked = (uuid.uuid4().hex, list(self._pending.values()), self._oldest)
+                    self._pending, self._oldest = {}, None
+                await self._send(*self._unacked)
+        self._written()
+
+    async def _send(self, batch_id: str, entries: List[dict], since: float):
+        started = time.monotonic()
+        try:
+            await self.collection.bulk_write(
+                [UpdateOne({**e["key"], OPS_FIELD: {"$ne": batch_id}},
+                           self._update(e["inc"], e["set"], batch_id), upsert=self.upsert)
+                 for e in entries], ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            failed = {err["index"] for err in errors}
+            failed -= await self._already_applied(
+                batch_id, {err["index"]: entries[err["index"]] for err in errors if err.get("code") == 11000})
+            if failed:
+                self.failures += 1
+                logger.error(f"Write-behind {self.name}: {len(failed)} of {len(entries)} ops failed, kept for retry")
+                self.flushed_ops += len(entries) - len(failed)
+                self._unacked = (batch_id, [entries[i] for i in sorted(failed)], since)
+                raise
+        except BaseException:
+            # Includes cancellation: any op may or may not have applied, so the whole
+            # batch stays unacknowledged and its id makes the retry safe.
+            self.failures += 1
+            raise
+        finally:
+            self.last_flush_seconds = time.monotonic() - started
+        self._unacked = None
+        self.flushes += 1
+        self.flushed_ops += len(entries)
+
+    def start(self):
+        if not self.synchronous and self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # Lets a flush that is already writing finish instead of cancelling it mid-write,
+        # then writes whatever is still buffered.
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def metrics(self) -> dict:
+        unacked = self._unacked[1] if self._unacked else []
+        oldest = self._unacked[2] if self._unacked else self._oldest
+        return {
+            "mode": "sync" if self.synchronous else "write_behind",
+            "queue_depth": len(self._pending) + len(unacked),
+            "pending_increments": sum(e["count"] for e in [*self._pending.values(), *unacked]),
+            "lag_seconds": round(time.monotonic() - oldest, 3) if oldest else 0.0,
+            "flushes": self.flushes, "flushed_ops": self.flushed_ops,
+            "failures": self.failures, "last_flush_seconds": round(self.last_flush_seconds, 4),
+        }
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception(f"Write-behind {self.name} flush failed")
+
+    def _written(self):
+        if self.on_write is not None:
+            self.on_write()
+
+    def _merge(self, key: dict, inc: dict, set_fields: Optional[dict]):
+        slot = self._slot(key)
+        entry = self._pending.get(slot)
+        if entry is None:
+            entry = self._pending[slot] = {"key": key, "inc": {}, "set": {}, "count": 0}
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+        for field, amount in inc.items():
+            entry["inc"][field] = entry["inc"].get(field, 0) + amount
+        entry["set"].update(set_fields or {})
+        entry["count"] += 1
+
+    async def _already_applied(self, batch_id: str, duplicates: Dict[int, dict]) -> Set[int]:
+        # A retried upsert whose first attempt did apply misses the `$ne` filter and
+        # collides with the document it created. Other duplicates come from a concurrent
+        # first insert of the key, and the retry will update that document instead.
+        if not duplicates:
+            return set()
+        fields = list(next(iter(duplicates.values()))["key"])
+        docs = await self.collection.find(
+            {"$or": [e["key"] for e in duplicates.values()], OPS_FIELD: batch_id},
+            {"_id": 0, **{f: 1 for f in fields}}).to_list(None)
+        applied = {self._slot({f: d.get(f) for f in fields}) for d in docs}
+        return {i for i, e in duplicates.items() if self._slot(e["key"]) in applied}
+
+    @staticmethod
+    def _slot(key: dict) -> tuple:
+        return tuple(sorted(key.items()))
+
+    @staticmethod
+    def _update(inc: dict, set_fields: Optional[dict], batch_id: Optional[str] = None) -> dict:
+        update = {"$inc": inc, "$currentDate": {"updated_at": True}}
+        if batch_id is not None:
+            update["$push"] = {OPS_FIELD: {"$each": [batch_id], "$slice": -OPS_HISTORY}}
+        if set_fields:
+            update["$set"] = set_fields
+        return update